@@ -0,0 +1,5 @@
+"""Scripts for measuring the cost of the tools in src/. Each script can be run
+directly as a module from the root of the project, e.g.
+
+python -m benchmarks.jacobian
+"""
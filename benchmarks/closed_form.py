@@ -0,0 +1,109 @@
+"""Measures the savings of the closed-form solves of small gram matrices
+(at most 3 constraints) over the Cholesky factorization, both for the solve
+alone and for a full computation of the multipliers on a batch of the wave
+experiment (experiment A)"""
+
+import numpy as np
+import torch
+
+from experiments.A_constrained_training.reductions import Huber_Reduction
+from src.lagrange.exact import compute_exact_multipliers
+from src.lagrange.linalg import _closed_form_solve
+from benchmarks.sketching import wave_batch
+from benchmarks.utils import time_function
+
+
+def random_gram_matrices(batch_size, num_constraints):
+    """A batch of well-conditioned gram matrices and right hand sides"""
+    jac = torch.rand(batch_size, num_constraints, num_constraints + 10)
+    gram = jac @ jac.transpose(-1, -2)
+    rhs = torch.rand(batch_size, num_constraints, 1)
+    return gram, rhs
+
+
+def benchmark_solve(batch_size, num_constraints, repeats=100):
+    """Times the closed-form and Cholesky solves of a batch of gram matrices
+
+    :returns: median time of the closed-form solve, median time of the
+        Cholesky solve
+    """
+    gram, rhs = random_gram_matrices(batch_size, num_constraints)
+
+    def cholesky():
+        return torch.cholesky_solve(rhs, torch.cholesky(gram))
+
+    closed_form_time = np.median(
+        time_function(lambda: _closed_form_solve(gram, rhs), repeats=repeats)
+    )
+    cholesky_time = np.median(time_function(cholesky, repeats=repeats))
+    return closed_form_time, cholesky_time
+
+
+def benchmark_multipliers(batch_size, sizes, reduction=None, repeats=10):
+    """Times the computation of the multipliers of the Helmholtz constraint
+    with and without the closed-form solve
+
+    :param reduction: optional reduction of the constraints, as for the
+        "reduction" method. Otherwise, the multipliers are computed per-sample
+        as for the "constrained" method
+    :returns: median time with the closed-form solve, median time without
+    """
+    loss, constraints, parameters = wave_batch(batch_size, sizes)
+    if reduction is not None:
+        loss = torch.mean(loss)
+        constraints = reduction(constraints)
+
+    times = list()
+    for closed_form in [True, False]:
+
+        def fn():
+            return compute_exact_multipliers(
+                loss,
+                constraints,
+                parameters,
+                create_graph=False,
+                closed_form=closed_form,
+            )
+
+        times.append(np.median(time_function(fn, repeats=repeats)))
+    return tuple(times)
+
+
+if __name__ == "__main__":
+
+    print("Solve only")
+    print(
+        f"{'batch':>6} {'constraints':>12} {'closed-form (ms)':>17} "
+        f"{'cholesky (ms)':>14} {'speedup':>8}"
+    )
+    for batch_size in [1, 100, 1000]:
+        for num_constraints in [1, 2, 3]:
+            closed_form_time, cholesky_time = benchmark_solve(
+                batch_size, num_constraints
+            )
+            print(
+                f"{batch_size:>6} {num_constraints:>12} "
+                f"{1000 * closed_form_time:>17.4f} "
+                f"{1000 * cholesky_time:>14.4f} "
+                f"{cholesky_time / closed_form_time:>7.2f}x"
+            )
+
+    print("Multipliers of the Helmholtz constraint")
+    print(
+        f"{'batch':>6} {'method':>12} {'closed-form (ms)':>17} "
+        f"{'cholesky (ms)':>14} {'speedup':>8}"
+    )
+    for batch_size in [10, 100]:
+        for method, reduction in [
+            ("constrained", None),
+            ("reduction", Huber_Reduction(6)),
+        ]:
+            closed_form_time, cholesky_time = benchmark_multipliers(
+                batch_size, [20, 20], reduction=reduction
+            )
+            print(
+                f"{batch_size:>6} {method:>12} "
+                f"{1000 * closed_form_time:>17.3f} "
+                f"{1000 * cholesky_time:>14.3f} "
+                f"{cholesky_time / closed_form_time:>7.2f}x"
+            )
@@ -0,0 +1,248 @@
+"""Measures the wall time and peak memory of the functions in src.derivatives
+over a sweep of problem sizes and writes a JSON report. Two reports can then be
+compared to flag regressions
+
+python -m benchmarks.derivatives run --output baseline.json
+python -m benchmarks.derivatives run --output new.json
+python -m benchmarks.derivatives compare baseline.json new.json
+"""
+
+import argparse
+from datetime import datetime
+import itertools
+import json
+import sys
+
+import numpy as np
+import torch
+
+from src.derivatives import (
+    divergence,
+    jacobian,
+    jacobian_and_hessian,
+    jacobian_and_laplacian,
+)
+from benchmarks.jacobian import make_model
+from benchmarks.utils import measure_peak_memory, time_function
+
+__all__ = ["run_benchmarks", "compare_reports"]
+
+
+# Each benchmarked function takes the outputs, inputs, batched and create_graph
+FUNCTIONS = {
+    "jacobian": jacobian,
+    "jacobian_and_hessian": jacobian_and_hessian,
+    "jacobian_and_laplacian": jacobian_and_laplacian,
+    "divergence": divergence,
+}
+
+# Fields which identify a single benchmark case
+CASE_KEYS = [
+    "function",
+    "batch_size",
+    "in_size",
+    "out_size",
+    "depth",
+    "create_graph",
+]
+
+
+def benchmark_case(
+    function,
+    batch_size,
+    in_size,
+    out_size,
+    depth,
+    create_graph,
+    repeats=10,
+    device="cpu",
+):
+    """Times a single function of src.derivatives on a dense model
+
+    :returns: a dictionary describing the case and its measurements
+    """
+    model = make_model(in_size, out_size, depth=depth).to(device)
+    xb = torch.rand(batch_size, in_size, requires_grad=True, device=device)
+    out = model(xb)
+
+    def fn():
+        FUNCTIONS[function](out, xb, batched=True, create_graph=create_graph)
+
+    times = time_function(fn, repeats=repeats)
+    return {
+        "function": function,
+        "batch_size": batch_size,
+        "in_size": in_size,
+        "out_size": out_size,
+        "depth": depth,
+        "create_graph": create_graph,
+        "median_time": float(np.median(times)),
+        "times": times,
+        "peak_memory": measure_peak_memory(fn, device=device),
+    }
+
+
+def run_benchmarks(
+    functions=None,
+    batch_sizes=(100, 1000),
+    sizes=((1, 1), (3, 4), (10, 10)),
+    depths=(3,),
+    create_graphs=(False, True),
+    repeats=10,
+    device="cpu",
+    verbose=True,
+):
+    """Runs the full sweep of benchmarks
+
+    :param functions: names of the functions to benchmark. Defaults to all
+    :param batch_sizes: batch sizes to sweep
+    :param sizes: (input dimension, output dimension) pairs to sweep. The
+        divergence is only benchmarked when these are equal
+    :param depths: numbers of hidden layers of the model to sweep
+    :param create_graphs: values of create_graph to sweep
+    :param repeats: number of timed calls of each case
+    :param device: "cuda" or "cpu"
+    :param verbose: whether to print each case as it completes
+    :returns: the report as a dictionary
+    """
+    if functions is None:
+        functions = list(FUNCTIONS.keys())
+    results = list()
+    for function, batch_size, (in_size, out_size), depth, create_graph in (
+        itertools.product(functions, batch_sizes, sizes, depths, create_graphs)
+    ):
+        if function == "divergence" and in_size != out_size:
+            continue
+        result = benchmark_case(
+            function,
+            batch_size,
+            in_size,
+            out_size,
+            depth,
+            create_graph,
+            repeats=repeats,
+            device=device,
+        )
+        if verbose:
+            print(
+                f"{function:>22} {batch_size:>6} {in_size:>3} {out_size:>4} "
+                f"{depth:>3} {str(create_graph):>6} "
+                f"{1000 * result['median_time']:>10.3f} ms "
+                f"{_format_memory(result['peak_memory']):>12}"
+            )
+        results.append(result)
+
+    return {
+        "metadata": {
+            "date": datetime.now().isoformat(),
+            "torch_version": torch.__version__,
+            "device": device,
+            "repeats": repeats,
+        },
+        "results": results,
+    }
+
+
+def _format_memory(memory):
+    if memory is None:
+        return "n/a"
+    return f"{memory / 2 ** 20:.2f} MiB"
+
+
+def _case_key(result):
+    return tuple(result[key] for key in CASE_KEYS)
+
+
+def compare_reports(baseline, new, threshold=0.1, verbose=True):
+    """Compares two reports, flagging the cases whose median time or peak
+    memory grew by more than the threshold
+
+    :param baseline: report (dictionary) to compare against
+    :param new: report (dictionary) to check for regressions
+    :param threshold: allowed relative increase before a case is flagged
+    :param verbose: whether to print the comparison of every case
+    :returns: a list of (case, metric, baseline value, new value) for each
+        regression
+    """
+    baseline_results = {
+        _case_key(result): result for result in baseline["results"]
+    }
+    regressions = list()
+    for result in new["results"]:
+        key = _case_key(result)
+        if key not in baseline_results:
+            continue
+        old = baseline_results[key]
+        for metric in ["median_time", "peak_memory"]:
+            if old[metric] is None or result[metric] is None:
+                continue
+            ratio = result[metric] / max(old[metric], 1e-12)
+            regressed = ratio > 1 + threshold
+            if regressed:
+                case = dict(zip(CASE_KEYS, key))
+                regressions.append((case, metric, old[metric], result[metric]))
+            if verbose:
+                print(
+                    f"{'REGRESSION' if regressed else 'ok':>10} "
+                    f"{' '.join(str(k) for k in key):>45} {metric:>12} "
+                    f"{ratio:>8.2f}x"
+                )
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    subparsers = parser.add_subparsers(dest="command")
+
+    run_parser = subparsers.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("--output", default="derivatives_benchmark.json")
+    run_parser.add_argument(
+        "--functions", nargs="+", choices=list(FUNCTIONS.keys())
+    )
+    run_parser.add_argument(
+        "--batch-sizes", nargs="+", type=int, default=[100, 1000]
+    )
+    run_parser.add_argument(
+        "--sizes",
+        nargs="+",
+        default=["1x1", "3x4", "10x10"],
+        help="input and output dimensions as INxOUT",
+    )
+    run_parser.add_argument("--depths", nargs="+", type=int, default=[3])
+    run_parser.add_argument("--repeats", type=int, default=10)
+    run_parser.add_argument("--device", default="cpu")
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="flag regressions between two reports"
+    )
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=0.1)
+
+    args = parser.parse_args()
+    if args.command == "run":
+        report = run_benchmarks(
+            functions=args.functions,
+            batch_sizes=args.batch_sizes,
+            sizes=[
+                tuple(int(dim) for dim in size.split("x"))
+                for size in args.sizes
+            ],
+            depths=args.depths,
+            repeats=args.repeats,
+            device=args.device,
+        )
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+    elif args.command == "compare":
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        regressions = compare_reports(baseline, new, threshold=args.threshold)
+        print(f"{len(regressions)} regression(s) found")
+        sys.exit(1 if len(regressions) > 0 else 0)
+    else:
+        parser.print_help()
@@ -0,0 +1,66 @@
+"""Compares the vectorized computation of the jacobian to the original loop
+over the rows of the jacobian"""
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from src.derivatives import jacobian
+from benchmarks.utils import time_function
+
+
+def make_model(in_size, out_size, width=20, depth=3):
+    layers = [nn.Linear(in_size, width), nn.Tanh()]
+    for _ in range(depth - 1):
+        layers.extend([nn.Linear(width, width), nn.Tanh()])
+    layers.append(nn.Linear(width, out_size))
+    return nn.Sequential(*layers)
+
+
+def benchmark(batch_size, in_size, out_size, create_graph, repeats=10):
+    """Times the computation of the batched jacobian with and without
+    vectorization
+
+    :returns: median time of the loop, median time of the vectorized version
+    """
+    model = make_model(in_size, out_size)
+    xb = torch.rand(batch_size, in_size, requires_grad=True)
+    out = model(xb)
+
+    def compute(vectorize):
+        def fn():
+            jacobian(
+                out,
+                xb,
+                batched=True,
+                create_graph=create_graph,
+                vectorize=vectorize,
+            )
+
+        return fn
+
+    loop_time = np.median(time_function(compute(False), repeats=repeats))
+    vectorized_time = np.median(time_function(compute(True), repeats=repeats))
+    return loop_time, vectorized_time
+
+
+if __name__ == "__main__":
+
+    print(
+        f"{'batch':>6} {'in':>3} {'out':>4} {'graph':>6} "
+        f"{'loop (ms)':>10} {'vector (ms)':>12} {'speedup':>8}"
+    )
+    for batch_size in [100, 1000]:
+        # (3, 4) is the size of the turbulence problem and (3, 12) the size of
+        # its hessian
+        for in_size, out_size in [(1, 1), (3, 4), (3, 12), (10, 30)]:
+            for create_graph in [False, True]:
+                loop_time, vectorized_time = benchmark(
+                    batch_size, in_size, out_size, create_graph
+                )
+                print(
+                    f"{batch_size:>6} {in_size:>3} {out_size:>4} "
+                    f"{str(create_graph):>6} {1000 * loop_time:>10.3f} "
+                    f"{1000 * vectorized_time:>12.3f} "
+                    f"{loop_time / vectorized_time:>8.2f}"
+                )
@@ -0,0 +1,87 @@
+"""Compares the cost and constraint satisfaction of enforcing the constraints
+with respect to only a subset of the parameters (see
+src.lagrange.select_parameters) to enforcing them with respect to all of the
+parameters, when training on the wave experiment (experiment A)"""
+
+import itertools
+import numpy as np
+import torch
+import torch.nn as nn
+
+try:
+    from time import perf_counter
+except ImportError:
+    from time import time as perf_counter
+
+from experiments.A_constrained_training.constraints import helmholtz_equation
+from experiments.A_constrained_training.dataloader import (
+    get_multiwave_dataloaders,
+)
+from experiments.A_constrained_training.model import ParameterizedDense
+from src.lagrange import constrain_loss, select_parameters
+
+
+def train(selector, sizes, batch_size=100, num_steps=100, seed=0):
+    """Trains a freshly initialized model with the "constrained" method
+
+    :param selector: parameter selector. See select_parameters()
+    :returns: median time per step, mean absolute constraint and mean loss
+        over the last 10 steps
+    """
+    torch.manual_seed(seed)
+    parameterization = {
+        "amplitudes": np.linspace(0.2, 5.0, num=5),
+        "frequencies": np.linspace(0.2, 5.0, num=5),
+        "phases": [0.0],
+        "num_points": 20,
+        "sampling": "random",
+    }
+    train_dl, __ = get_multiwave_dataloaders(
+        parameterization, parameterization, seed=seed, batch_size=batch_size
+    )
+    model = ParameterizedDense(1, 3, 1, sizes=sizes, activation=nn.Tanh())
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    parameters = select_parameters(model, selector)
+    loss_fn = nn.MSELoss(reduction="none")
+
+    times = list()
+    constraint_errors = list()
+    losses = list()
+    batches = itertools.chain.from_iterable(itertools.repeat(train_dl))
+    for xb, yb in itertools.islice(batches, num_steps):
+        start_time = perf_counter()
+        optimizer.zero_grad()
+        out = model(*xb)
+        loss = loss_fn(out, yb)
+        constraints, __ = helmholtz_equation(out, xb, model, True)
+        constrained_loss = constrain_loss(loss, constraints, parameters)
+        torch.mean(constrained_loss).backward()
+        optimizer.step()
+        times.append(perf_counter() - start_time)
+        constraint_errors.append(float(torch.mean(torch.abs(constraints))))
+        losses.append(float(torch.mean(loss)))
+    return (
+        np.median(times),
+        np.mean(constraint_errors[-10:]),
+        np.mean(losses[-10:]),
+    )
+
+
+if __name__ == "__main__":
+
+    sizes = [20, 20, 20]
+    print(
+        f"{'selector':>20} {'params':>7} {'step (ms)':>10} "
+        f"{'mean |constraint|':>18} {'mean loss':>10}"
+    )
+    for selector in [None, "layer3", ["layer2", "layer3"], "param_layer"]:
+        model = ParameterizedDense(1, 3, 1, sizes=sizes)
+        num_parameters = sum(
+            param.numel() for param in select_parameters(model, selector)
+        )
+        step_time, constraint_error, loss = train(selector, sizes)
+        print(
+            f"{str(selector):>20} {num_parameters:>7} "
+            f"{1000 * step_time:>10.3f} {constraint_error:>18.5f} "
+            f"{loss:>10.5f}"
+        )
@@ -0,0 +1,96 @@
+"""Compares the cost and accuracy of the sketched Lagrange multipliers to the
+exact multipliers on a batch of the wave experiment (experiment A)"""
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from experiments.A_constrained_training.constraints import helmholtz_equation
+from experiments.A_constrained_training.dataloader import (
+    get_multiwave_dataloaders,
+)
+from experiments.A_constrained_training.model import Dense
+from src.lagrange.exact import compute_exact_multipliers
+from src.lagrange.sketching import compute_sketched_multipliers
+from benchmarks.utils import time_function
+
+
+def wave_batch(batch_size, sizes):
+    """Computes the loss and constraints of a freshly initialized model on a
+    single batch of the wave experiment
+
+    :returns: loss, constraints, parameters
+    """
+    parameterization = {
+        "amplitudes": [1.0],
+        "frequencies": [1.0],
+        "phases": [0.0],
+        "num_points": batch_size,
+        "sampling": "uniform",
+    }
+    train_dl, __ = get_multiwave_dataloaders(
+        parameterization, parameterization, batch_size=batch_size
+    )
+    xb, yb = next(iter(train_dl))
+    model = Dense(1, 3, 1, sizes=sizes, activation=nn.Tanh())
+    out = model(*xb)
+    loss = nn.MSELoss(reduction="none")(out, yb)
+    constraints, __ = helmholtz_equation(out, xb, model, True)
+    return loss, constraints, list(model.parameters())
+
+
+def benchmark(batch_size, sizes, sketch_sizes, sketch="gaussian", repeats=5):
+    """Times the exact and sketched multipliers and measures the relative error
+    of the sketched multipliers
+
+    :returns: time of the exact multipliers, list of (sketch size, time,
+        relative error) for the sketched multipliers
+    """
+    loss, constraints, parameters = wave_batch(batch_size, sizes)
+    exact = compute_exact_multipliers(loss, constraints, parameters)
+    exact_time = np.median(
+        time_function(
+            lambda: compute_exact_multipliers(loss, constraints, parameters),
+            repeats=repeats,
+        )
+    )
+
+    results = list()
+    for sketch_size in sketch_sizes:
+
+        def fn():
+            return compute_sketched_multipliers(
+                loss,
+                constraints,
+                parameters,
+                sketch_size=sketch_size,
+                sketch=sketch,
+                warn=False,
+            )
+
+        sketched_time = np.median(time_function(fn, repeats=repeats))
+        error = float(torch.norm(fn() - exact) / torch.norm(exact))
+        results.append((sketch_size, sketched_time, error))
+    return exact_time, results
+
+
+if __name__ == "__main__":
+
+    print(
+        f"{'batch':>6} {'params':>7} {'sketch':>10} {'k':>6} "
+        f"{'exact (ms)':>11} {'sketch (ms)':>12} {'rel. error':>11}"
+    )
+    for batch_size in [10, 100]:
+        for sizes in [[20], [20, 20, 20]]:
+            model = Dense(1, 3, 1, sizes=sizes)
+            num_parameters = sum(param.numel() for param in model.parameters())
+            for sketch in ["gaussian", "subsample"]:
+                exact_time, results = benchmark(
+                    batch_size, sizes, [10, 50, 200, 1000], sketch=sketch
+                )
+                for sketch_size, sketched_time, error in results:
+                    print(
+                        f"{batch_size:>6} {num_parameters:>7} {sketch:>10} "
+                        f"{sketch_size:>6} {1000 * exact_time:>11.3f} "
+                        f"{1000 * sketched_time:>12.3f} {error:>11.4f}"
+                    )
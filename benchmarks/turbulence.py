@@ -0,0 +1,101 @@
+"""Compares the steady-state turbulence residual to the code path of the
+original implementation over 10^3 to 10^5 collocation points. Also times the
+convective term alone, with and without materializing the jacobian
+
+The residual needs the full jacobian for the exact divergence and laplacian,
+so its convective term contracts the cached jacobian. The forward-mode pass of
+src.derivatives.jvp() only runs in the residual if the laplacian is estimated
+(each probe of Hutchinson's estimator is one jacobian-vector product). If the
+context is seeded with the jacobian and laplacian of a Taylor-mode forward
+pass, as in the experiments, no derivative is computed at all
+"""
+
+import numpy as np
+import torch
+
+from src.derivatives import DerivativeContext, jacobian, jvp, trace
+from src.pdes import steady_state_turbulence
+from benchmarks.jacobian import make_model
+from benchmarks.utils import measure_peak_memory, time_function
+
+
+def baseline_steady_state_turbulence(outputs, inputs, nu=0.01):
+    """The code path of the original steady_state_turbulence: the jacobian and
+    the full hessian, one row at a time, the trace of the jacobian for the
+    divergence, and the einsum for the convective term (which contracted the
+    output index, and is timed as it was)"""
+    jac = jacobian(
+        outputs, inputs, batched=True, create_graph=True, vectorize=False
+    )
+    hes = jacobian(
+        jac, inputs, batched=True, create_graph=True, vectorize=False
+    )
+    lap = trace(hes)
+    div = trace(jac)
+    lhs = torch.einsum("...j,...jk->...k", outputs, jac)
+    sst = lhs - nu * lap
+    return torch.cat([div.unsqueeze(-1), sst], dim=-1)
+
+
+def _seeded_context(outputs, inputs):
+    """A context which already holds the jacobian and laplacian, as after a
+    Taylor-mode forward pass"""
+    context = DerivativeContext()
+    jac = context.jacobian(outputs, inputs, batched=True)
+    lap = context.laplacian(outputs, inputs, batched=True)
+    seeded = DerivativeContext()
+    seeded.set_derivatives(outputs, inputs, jacobian=jac, laplacian=lap)
+    return seeded
+
+
+def benchmark(batch_size, repeats=5, device="cpu"):
+    """Times the residual and its convective term
+
+    :returns: dictionary of the median times and peak memory of each variant
+    """
+    model = make_model(3, 3).to(device)
+    xb = torch.rand(batch_size, 3, requires_grad=True, device=device)
+    out = model(xb)
+
+    seeded = _seeded_context(out, xb)
+    variants = {
+        "baseline residual": lambda: baseline_steady_state_turbulence(
+            out, xb
+        ),
+        "residual": lambda: steady_state_turbulence(out, xb),
+        # Hutchinson's estimator runs jvp() once per probe
+        "estimated residual": lambda: steady_state_turbulence(
+            out, xb, num_probes=1
+        ),
+        # Only contracts the seeded jacobian
+        "seeded residual": lambda: steady_state_turbulence(
+            out, xb, context=seeded
+        ),
+        "jacobian convection": lambda: torch.einsum(
+            "...jk,...k->...j",
+            DerivativeContext().jacobian(out, xb, batched=True),
+            out,
+        ),
+        "jvp convection": lambda: jvp(out, xb, out, create_graph=True),
+    }
+    return {
+        name: (
+            np.median(time_function(fn, repeats=repeats)),
+            measure_peak_memory(fn, device=device),
+        )
+        for name, fn in variants.items()
+    }
+
+
+if __name__ == "__main__":
+
+    print(
+        f"{'points':>7} {'variant':>20} {'time (ms)':>10} {'peak memory':>12}"
+    )
+    for batch_size in [1000, 10000, 100000]:
+        for name, (time, memory) in benchmark(batch_size).items():
+            memory = "n/a" if memory is None else f"{memory / 2 ** 20:.2f} MiB"
+            print(
+                f"{batch_size:>7} {name:>20} {1000 * time:>10.3f} "
+                f"{memory:>12}"
+            )
@@ -0,0 +1,68 @@
+"""Common tools for timing the benchmarks"""
+
+import torch
+from torch.autograd import profiler
+
+try:
+    from time import perf_counter
+except ImportError:
+    from time import time as perf_counter
+
+__all__ = ["time_function", "measure_peak_memory"]
+
+
+def time_function(fn, repeats=10, warmup=1):
+    """Times a function by calling it several times
+
+    :param fn: function of no arguments to time
+    :param repeats: number of times to call the function for timing
+    :param warmup: number of times to call the function before timing
+    :returns: a list of the wall times (in seconds) of each call
+    """
+    for _ in range(warmup):
+        fn()
+    times = list()
+    for _ in range(repeats):
+        start_time = perf_counter()
+        fn()
+        times.append(perf_counter() - start_time)
+    return times
+
+
+def measure_peak_memory(fn, device="cpu"):
+    """Measures the peak memory allocated by a single call of a function
+
+    :param fn: function of no arguments to measure
+    :param device: device on which the function allocates its tensors
+    :returns: peak memory in bytes allocated during the call (above what was
+        already allocated), or None if it cannot be measured. On the CPU, this
+        requires a version of PyTorch whose profiler records memory
+    """
+    device = torch.device(device)
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        baseline = torch.cuda.memory_allocated(device)
+        if hasattr(torch.cuda, "reset_peak_memory_stats"):
+            torch.cuda.reset_peak_memory_stats(device)
+        else:
+            torch.cuda.reset_max_memory_allocated(device)
+        fn()
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - baseline
+
+    try:
+        with profiler.profile(profile_memory=True) as prof:
+            fn()
+    except TypeError:
+        # This version of the profiler doesn't record memory
+        return None
+    # Replay the allocations and frees of each operation in order
+    events = sorted(
+        prof.function_events, key=lambda event: event.time_range.start
+    )
+    current = 0
+    peak = 0
+    for event in events:
+        current += event.self_cpu_memory_usage
+        peak = max(peak, current)
+    return peak
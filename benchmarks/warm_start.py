@@ -0,0 +1,120 @@
+"""Compares the time per training step of the warm-started multipliers to the
+exact multipliers on the wave experiment (experiment A), both for a single
+reduced constraint (the "reduction" and "warm-started" methods) and for the
+many constraints of batchwise constraining"""
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from experiments.A_constrained_training.constraints import helmholtz_equation
+from experiments.A_constrained_training.dataloader import (
+    get_multiwave_dataloaders,
+)
+from experiments.A_constrained_training.model import Dense
+from experiments.A_constrained_training.reductions import Huber_Reduction
+from src.lagrange.exact import compute_exact_multipliers
+from src.lagrange.warm_start import (
+    Warm_Start_State,
+    compute_warm_started_multipliers,
+)
+
+try:
+    from time import perf_counter
+except ImportError:
+    from time import time as perf_counter
+
+
+def benchmark(batch_size, sizes, reduction=None, num_steps=20, lr=1e-3):
+    """Times the multipliers along a short training trajectory, on which every
+    solver sees the same sequence of parameters
+
+    :param reduction: optional reduction of the constraints. Otherwise, all of
+        the constraints of the batch are enforced as for batchwise
+        constraining
+    :returns: dictionary of the median time per step of the exact multipliers,
+        of the warm-started multipliers which always correct, and of the
+        warm-started multipliers with the default fallback to exact
+    """
+    parameterization = {
+        "amplitudes": [1.0],
+        "frequencies": [1.0],
+        "phases": [0.0],
+        "num_points": batch_size,
+        "sampling": "uniform",
+    }
+    train_dl, __ = get_multiwave_dataloaders(
+        parameterization, parameterization, batch_size=batch_size
+    )
+    xb, yb = next(iter(train_dl))
+    torch.manual_seed(0)
+    model = Dense(1, 3, 1, sizes=sizes, activation=nn.Tanh())
+    initial_state = {
+        key: value.clone() for key, value in model.state_dict().items()
+    }
+    parameters = list(model.parameters())
+
+    def problem():
+        out = model(*xb)
+        loss = torch.mean(nn.MSELoss(reduction="none")(out, yb))
+        constraints, __ = helmholtz_equation(out, xb, model, True)
+        if reduction is not None:
+            constraints = reduction(constraints)
+        return loss, constraints.view(-1)
+
+    solvers = {
+        "exact": lambda loss, constraints: compute_exact_multipliers(
+            loss, constraints.view(1, -1), parameters, create_graph=False
+        ),
+        "warm-started (always correct)": None,
+        "warm-started (default)": None,
+    }
+    states = {
+        "warm-started (always correct)": Warm_Start_State(min_constraints=1),
+        "warm-started (default)": Warm_Start_State(),
+    }
+
+    times = dict()
+    for name, solver in solvers.items():
+        model.load_state_dict(initial_state)
+        step_times = list()
+        for __ in range(num_steps):
+            loss, constraints = problem()
+            start_time = perf_counter()
+            if solver is None:
+                compute_warm_started_multipliers(
+                    loss, constraints, parameters, states[name]
+                )
+            else:
+                solver(loss, constraints)
+            step_times.append(perf_counter() - start_time)
+            # A small step of the unconstrained loss keeps the trajectory the
+            # same for every solver
+            model.zero_grad()
+            loss.backward()
+            with torch.no_grad():
+                for param in parameters:
+                    param.sub_(lr * param.grad)
+        times[name] = np.median(step_times)
+    return times
+
+
+if __name__ == "__main__":
+
+    print(
+        f"{'method':>11} {'constraints':>12} {'solver':>30} {'time (ms)':>10}"
+    )
+    for method, batch_size, reduction in [
+        ("reduction", 100, Huber_Reduction(6)),
+        ("batchwise", 4, None),
+        ("batchwise", 16, None),
+        ("batchwise", 64, None),
+    ]:
+        num_constraints = 1 if reduction is not None else batch_size
+        for name, time in benchmark(
+            batch_size, [20, 20], reduction=reduction
+        ).items():
+            print(
+                f"{method:>11} {num_constraints:>12} {name:>30} "
+                f"{1000 * time:>10.3f}"
+            )
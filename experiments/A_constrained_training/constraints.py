@@ -2,14 +2,105 @@
 correctly handle the passing of arguments"""
 
 from src import pdes
+from src.derivatives import (
+    DerivativeContext,
+    finite_difference_jacobian_and_laplacian,
+)
 
 __all__ = ["helmholtz_equation", "pythagorean_equation"]
 
 
-def helmholtz_equation(out, xb, model, return_diagnostics):
-    return pdes.helmholtz_equation(out, *xb, return_diagnostics)
+def _add_model_derivatives(
+    out,
+    xb,
+    model,
+    context,
+    taylor_mode=True,
+    derivative_backend=None,
+    num_probes=None,
+):
+    """Stores derivatives of the model output w.r.t. the inputs in the context,
+    if they can be computed more cheaply than by differentiating the output.
+    The engines already store the Taylor-mode derivatives of their forward
+    pass (see supports_taylor_mode below), in which case nothing is done
 
+    :param out: output of the model
+    :param xb: inputs to the model (inputs, parameterization)
+    :param model: the model
+    :param context: src.derivatives.DerivativeContext for this batch
+    :param taylor_mode: whether to propagate the derivatives through the model
+        alongside its activations, if the model supports it
+    :param derivative_backend: optional dictionary selecting how derivatives
+        are computed, e.g. {"backend": "finite-difference", "step": 1e-2}
+    :param num_probes: number of random probes if the laplacian is estimated.
+        Taylor mode is skipped in that case, since it computes the exact
+        laplacian
+    """
+    if context.has_laplacian(out, xb[0]):
+        return
+    if derivative_backend is not None:
+        options = dict(derivative_backend)
+        backend = options.pop("backend")
+        if backend == "finite-difference":
+            __, jac, lap = finite_difference_jacobian_and_laplacian(
+                model, xb[0], args=xb[1:], **options
+            )
+            context.set_derivatives(out, xb[0], jacobian=jac, laplacian=lap)
+            return
+        elif backend != "autograd":
+            raise ValueError(f"Derivative backend {backend} not recognized!")
+    if (
+        taylor_mode
+        and num_probes is None
+        and hasattr(model, "forward_with_derivatives")
+    ):
+        # Propagate the derivatives alongside the activations rather than
+        # differentiating the output twice
+        __, jac, lap = model.forward_with_derivatives(*xb)
+        context.set_derivatives(out, xb[0], jacobian=jac, laplacian=lap)
 
-def pythagorean_equation(out, xb, model, return_diagnostics):
-    return pdes.helmholtz_equation(out, *xb, return_diagnostics)
+
+def helmholtz_equation(
+    out,
+    xb,
+    model,
+    return_diagnostics,
+    taylor_mode=True,
+    derivative_backend=None,
+    context=None,
+    num_probes=None,
+    **kwargs,
+):
+    if context is None:
+        context = DerivativeContext()
+    _add_model_derivatives(
+        out,
+        xb,
+        model,
+        context,
+        taylor_mode=taylor_mode,
+        derivative_backend=derivative_backend,
+        num_probes=num_probes,
+    )
+    return pdes.helmholtz_equation(
+        out,
+        *xb,
+        return_diagnostics,
+        num_probes=num_probes,
+        context=context,
+        **kwargs,
+    )
+
+
+def pythagorean_equation(out, xb, model, return_diagnostics, **kwargs):
+    return helmholtz_equation(out, xb, model, return_diagnostics, **kwargs)
+
+
+# Both differentiate the model with respect to its inputs. See create_engine()
+helmholtz_equation.uses_input_derivatives = True
+pythagorean_equation.uses_input_derivatives = True
+# Both read the exact jacobian and laplacian of the model from the context, so
+# the engines may compute them alongside the forward pass in Taylor mode
+helmholtz_equation.supports_taylor_mode = True
+pythagorean_equation.supports_taylor_mode = True
 
@@ -12,7 +12,15 @@ try:
 except ImportError:
     from time import time as perf_counter
 
-from src.lagrange import constrain_loss
+from src.derivatives import DerivativeContext
+from src.lagrange import (
+    PerSampleGradients,
+    ProjectedOptimizer,
+    compute_projected_gradients,
+    constrain_loss,
+    select_parameters,
+)
+from src.lagrange.warm_start import Warm_Start_State
 
 __all__ = ["create_engine", "Sub_Batch_Events"]
 
@@ -41,6 +49,26 @@ def prepare_batch(batch, device=None, non_blocking=False):
     )
 
 
+def forward(model, xb, context, taylor_mode=False):
+    """Runs the forward pass of the model. In Taylor mode, the jacobian and
+    laplacian of the output with respect to the inputs are propagated
+    alongside it and stored in the context, so that the constraint needn't run
+    the model again
+
+    :param model: the model. Must have forward_with_derivatives() in Taylor
+        mode
+    :param xb: inputs to the model (inputs, parameterization)
+    :param context: src.derivatives.DerivativeContext for this batch
+    :param taylor_mode: whether to use the Taylor-mode forward pass
+    :returns: output of the model
+    """
+    if not taylor_mode:
+        return model(*xb)
+    out, jac, lap = model.forward_with_derivatives(*xb)
+    context.set_derivatives(out, xb[0], jacobian=jac, laplacian=lap)
+    return out
+
+
 def create_engine(
     model,
     loss_fn,
@@ -52,6 +80,11 @@ def create_engine(
     method="unconstrained",
     reduction=None,
     device="cpu",
+    derivative_backend=None,
+    parameter_selector=None,
+    linear_gram=False,
+    select_constraints=False,
+    verify_per_sample=True,
 ):
     """Creates an engine with the necessary components. If optimizer is not
     provided, then will run inference
@@ -74,6 +107,18 @@ def create_engine(
             all constraints within the batch
         "reduction" - apply reduction before computing constraints. If no 
             reduction is specified, will throw error
+        "warm-started" - same as "batchwise" (or as "reduction" if a
+            reduction is specified), but the multipliers of the previous step
+            are corrected rather than recomputed from scratch, with periodic
+            exact recomputations. The solver state is kept on the engine.
+            Fewer than 8 constraints (e.g. any single reduced constraint) are
+            always recomputed exactly, since correcting costs more autograd
+            passes. The multipliers are reused best if consecutive batches
+            hold the same points, e.g. for full-batch training. See
+            src.lagrange.warm_start.Warm_Start_State
+        "projected" - same update as "constrained", but the optimizer steps
+            with the projected gradients directly, computed from first-order
+            jacobians without backpropagating through the constrained loss
         "unconstrained" - don't constrain. Used as a control method
         "soft-constrained" - use soft constraints
         "no-loss" - intended entirely for debugging. Ignores the loss function
@@ -83,10 +128,110 @@ def create_engine(
             for debugging
     :param reduction: reduction to apply to constraints before computing 
         constrained loss if method == "reduction"
+    :param device: "cuda" or "cpu"
+    :param derivative_backend: optional dictionary passed to the constraint
+        function to select how it computes derivatives with respect to the
+        inputs, e.g. {"backend": "finite-difference", "step": 1e-2, "order": 2}.
+        Defaults to None for the constraint's own choice
+    :param parameter_selector: optional selector of the subset of the model
+        parameters with respect to which the constraints are enforced, e.g.
+        "layer1" for the last layer of the default model or "param_layer". The
+        other parameters follow the gradient of the constrained loss with the
+        multipliers held fixed, for every method. See
+        src.lagrange.select_parameters(). Defaults to None for all of the
+        parameters
+    :param linear_gram: whether to compute the gram matrices of the
+        "constrained", "batchwise" and "projected" methods directly from the
+        per-sample gradients of the nn.Linear layers of the model. See
+        src.lagrange.PerSampleGradients. Only valid for constraints which
+        declare constraint_fn.uses_input_derivatives = False, since
+        derivatives of the model with respect to its inputs defeat it.
+        Regardless, these methods compute the jacobian of the loss (and of
+        such constraints) from the per-sample gradients whenever the model
+        only consists of nn.Linear layers. Defaults to False
+    :param select_constraints: whether the "batchwise" method only enforces a
+        well-conditioned subset of the constraints of the batch, which are
+        rarely linearly independent. See
+        src.lagrange.compute_exact_multipliers(). Defaults to False
+    :param verify_per_sample: whether to check a few random columns of every
+        jacobian computed from the per-sample gradients against autograd,
+        which catches constraints that wrongly declare
+        uses_input_derivatives = False. See src.lagrange.PerSampleGradients.
+        Defaults to True
     :returns: an ignite.engine.Engine whose output is (xb, yb, out) for every
         iteration
     """
 
+    if derivative_backend is not None:
+        constraint_kwargs = {"derivative_backend": derivative_backend}
+    else:
+        constraint_kwargs = dict()
+
+    constrained_parameters = select_parameters(model, parameter_selector)
+
+    # The constraint reads the derivatives of the output from the context, so
+    # they are propagated alongside the forward pass where possible
+    taylor_mode = (
+        derivative_backend is None
+        and hasattr(model, "forward_with_derivatives")
+        and getattr(constraint_fn, "supports_taylor_mode", False)
+    )
+
+    # Only the jacobian of the loss may use the per-sample gradients if the
+    # constraint differentiates the model with respect to its inputs
+    per_sample_constraints = not getattr(
+        constraint_fn, "uses_input_derivatives", True
+    )
+    if linear_gram:
+        if method not in ["constrained", "batchwise", "projected"]:
+            raise ValueError(
+                f"linear_gram is not supported for method {method}"
+            )
+        # Rejected once here, rather than falling back on every batch
+        if not per_sample_constraints:
+            raise ValueError(
+                "linear_gram requires a constraint which does not use"
+                " derivatives of the model with respect to its inputs. Set"
+                " constraint_fn.uses_input_derivatives = False if it doesn't"
+            )
+        # The gram matrix is computed directly from the recorded layer
+        # activations
+        per_sample_gradients = PerSampleGradients(
+            model, verify=verify_per_sample
+        )
+    elif method in [
+        "constrained",
+        "batchwise",
+        "projected",
+    ] and PerSampleGradients.supports_model(model):
+        # Per-sample gradients w.r.t. the parameters need a single backward
+        # pass per element of a sample, rather than per element of the batch
+        per_sample_gradients = PerSampleGradients(
+            model, verify=verify_per_sample
+        )
+    else:
+        per_sample_gradients = None
+
+    if method in ["constrained", "batchwise", "projected"]:
+        solver_options = {
+            "linear_gram": linear_gram,
+            "per_sample_constraints": per_sample_constraints,
+        }
+        if method == "batchwise":
+            solver_options["select_constraints"] = select_constraints
+    else:
+        solver_options = None
+
+    if method == "projected" and optimizer is not None:
+        projected_optimizer = ProjectedOptimizer(
+            optimizer,
+            per_sample_gradients=per_sample_gradients,
+            parameters=constrained_parameters,
+            per_sample_constraints=per_sample_constraints,
+        )
+    else:
+        projected_optimizer = None
+
     def end_section(engine, section_event, section_start_time):
         """End the section, tabulate the time, fire the event, and resume time"""
         engine.state.times[section_event.value] = (
@@ -117,7 +262,16 @@ def create_engine(
             engine, Sub_Batch_Events.DATA_LOADED, section_start
         )
 
-        engine.state.out = model(*engine.state.xb)
+        # All constraints on this batch share their derivatives
+        context = DerivativeContext()
+        if per_sample_gradients is not None:
+            per_sample_gradients.start()
+        engine.state.out = forward(
+            model, engine.state.xb, context, taylor_mode=taylor_mode
+        )
+        if per_sample_gradients is not None:
+            # Only the primary forward pass is recorded
+            per_sample_gradients.stop()
         section_start = end_section(
             engine, Sub_Batch_Events.FORWARD_PASS_COMPLETED, section_start
         )
@@ -151,8 +305,13 @@ def create_engine(
         )
 
         engine.state.constraints, engine.state.constraints_diagnostics = constraint_fn(
-            engine.state.out, engine.state.xb, model, True
-        )  # last parameter is to return diagnostics
+            engine.state.out,
+            engine.state.xb,
+            model,
+            True,
+            context=context,
+            **constraint_kwargs,
+        )  # fourth parameter is to return diagnostics
 
         section_start = end_section(
             engine, Sub_Batch_Events.CONSTRAINTS_COMPUTED, section_start
@@ -162,9 +321,11 @@ def create_engine(
             constrained_loss, engine.state.multipliers, multiplier_computation_timing = constrain_loss(
                 engine.state.loss,
                 engine.state.constraints,
-                list(model.parameters()),
+                constrained_parameters,
                 return_multipliers=True,
                 return_timing=True,
+                per_sample_gradients=per_sample_gradients,
+                solver_options=solver_options,
                 # defaults are for this method
             )
             engine.state.reduced_constraints = engine.state.constraints.new_zeros(
@@ -176,10 +337,12 @@ def create_engine(
             engine.state.constrained_loss, engine.state.multipliers, multiplier_computation_timing = constrain_loss(
                 engine.state.loss,
                 engine.state.constraints,
-                list(model.parameters()),
+                constrained_parameters,
                 return_multipliers=True,
                 return_timing=True,
                 batchwise=True,
+                per_sample_gradients=per_sample_gradients,
+                solver_options=solver_options,
             )
             engine.state.reduced_constraints = engine.state.constraints.new_zeros(
                 1
@@ -193,7 +356,7 @@ def create_engine(
             engine.state.constrained_loss, engine.state.multipliers, multiplier_computation_timing = constrain_loss(
                 engine.state.loss,
                 engine.state.constraints,
-                list(model.parameters()),
+                constrained_parameters,
                 return_multipliers=True,
                 return_timing=True,
                 reduction=reduction,
@@ -202,6 +365,61 @@ def create_engine(
                 engine.state.constraints
             )
             engine.state.times.update(multiplier_computation_timing)
+        elif method == "warm-started":
+            if not hasattr(engine.state, "multiplier_state"):
+                engine.state.multiplier_state = Warm_Start_State()
+            # Without a reduction, all of the constraints of the batch are
+            # enforced, which are enough for the corrections to pay off
+            engine.state.constrained_loss, engine.state.multipliers, multiplier_computation_timing = constrain_loss(
+                engine.state.loss,
+                engine.state.constraints,
+                constrained_parameters,
+                return_multipliers=True,
+                return_timing=True,
+                batchwise=reduction is None,
+                reduction=reduction,
+                solver="warm-started",
+                solver_options={"state": engine.state.multiplier_state},
+            )
+            if reduction is None:
+                engine.state.reduced_constraints = engine.state.constraints.new_zeros(
+                    1
+                )
+            else:
+                engine.state.reduced_constraints = reduction(
+                    engine.state.constraints
+                )
+            engine.state.times.update(multiplier_computation_timing)
+        elif method == "projected":
+            if projected_optimizer is not None:
+                engine.state.multipliers, multiplier_computation_timing = projected_optimizer.project(
+                    engine.state.loss,
+                    engine.state.constraints,
+                    return_timing=True,
+                )
+            else:
+                __, engine.state.multipliers, multiplier_computation_timing = compute_projected_gradients(
+                    engine.state.loss,
+                    engine.state.constraints,
+                    constrained_parameters,
+                    return_timing=True,
+                    per_sample_gradients=per_sample_gradients,
+                    per_sample_constraints=per_sample_constraints,
+                )
+            # Only for monitoring, since the gradients are already projected
+            with torch.no_grad():
+                engine.state.constrained_loss = torch.mean(
+                    engine.state.loss
+                    + torch.einsum(
+                        "...i,...i->...",
+                        engine.state.constraints,
+                        engine.state.multipliers,
+                    )
+                )
+            engine.state.reduced_constraints = engine.state.constraints.new_zeros(
+                1
+            )
+            engine.state.times.update(multiplier_computation_timing)
         elif method == "soft-constrained":
             engine.state.multipliers = (
                 engine.state.constraints / engine.state.constraints.numel()
@@ -227,7 +445,7 @@ def create_engine(
                     engine.state.loss.size()
                 ).requires_grad_(),
                 engine.state.constraints,
-                list(model.parameters()),
+                constrained_parameters,
                 return_multipliers=True,
                 return_timing=True,
             )
@@ -242,7 +460,7 @@ def create_engine(
                     engine.state.loss.size()
                 ).requires_grad_(),
                 engine.state.constraints,
-                list(model.parameters()),
+                constrained_parameters,
                 return_multipliers=True,
                 return_timing=True,
             )
@@ -267,7 +485,9 @@ def create_engine(
             .detach()
         )
         if optimizer is not None:
-            engine.state.constrained_loss.backward()
+            if projected_optimizer is None:
+                engine.state.constrained_loss.backward()
+            # Otherwise the projected gradients have already been set
             # attach the gradients
             engine.state.model_parameters_grad = torch.cat(
                 [param.grad.view(-1) for param in model.parameters()], dim=-1
@@ -305,4 +525,13 @@ def create_engine(
     if monitor is not None:
         monitor.attach(engine)
 
+    if per_sample_gradients is not None:
+        # The model is only hooked while this engine runs
+        engine.add_event_handler(
+            Events.STARTED, lambda engine: per_sample_gradients.register()
+        )
+        engine.add_event_handler(
+            Events.COMPLETED, lambda engine: per_sample_gradients.remove()
+        )
+
     return engine
@@ -9,7 +9,7 @@ import torch.optim as optim
 
 from .checkpointer import ModelAndMonitorCheckpointer
 from .constraints import helmholtz_equation, pythagorean_equation
-from .dataloader import get_multiwave_dataloaders
+from .dataloader import get_multiwave_dataloaders, constraint_residual_score
 from .event_loop import create_engine, Sub_Batch_Events
 from .model import Dense, ParameterizedDense
 from .monitor import ProofOfConstraintMonitor
@@ -35,6 +35,24 @@ def default_configuration():
     method: method to use for constraining. See the event loop for more details
     constraint: function to use for constraining
     reduction: reduction to use for constraining. See event loop for details
+    trace_estimation: optional dictionary of keyword arguments ("num_probes"
+        and optionally "distribution") for estimating the laplacian of the
+        constraint with random probes. Defaults to None for exact computation
+    evaluation_derivative_backend: optional dictionary selecting how the
+        evaluators compute derivatives of the model for the constraint, e.g.
+        {"backend": "finite-difference", "step": 1e-2, "order": 2}. Defaults to
+        None for the same derivatives as used in training
+    parameter_selector: optional selector of the subset of the model parameters
+        with respect to which the constraints are enforced, e.g. "layer1" for
+        the last layer of the default model or "param_layer". See
+        src.lagrange.select_parameters(). Defaults to None for all of the
+        parameters
+    select_constraints: whether the "batchwise" method only enforces a
+        well-conditioned subset of the constraints of the batch. Defaults to
+        False
+    adaptive_sampling_interval: number of epochs between refinements of the
+        training points when their sampling is "adaptive". See
+        dataloader.SingleWaveDataset.refine(). Defaults to 1
     """
     return {
         "seed": None,
@@ -62,6 +80,11 @@ def default_configuration():
         "method": "constrained",
         "constraint": helmholtz_equation,
         "reduction": None,
+        "trace_estimation": None,
+        "evaluation_derivative_backend": None,
+        "parameter_selector": None,
+        "select_constraints": False,
+        "adaptive_sampling_interval": 1,
     }
 
 
@@ -95,6 +118,12 @@ def get_loss_and_constraint(configuration):
     # We need the entire batch of losses, not it's sum
     loss = nn.MSELoss(reduction="none")
     constraint = configuration["constraint"]
+    if configuration["trace_estimation"] is not None:
+        constraint = functools.partial(
+            constraint, **configuration["trace_estimation"]
+        )
+        # The laplacian of a Taylor-mode forward pass would be exact
+        constraint.supports_taylor_mode = False
     return loss, constraint
 
 
@@ -182,6 +211,8 @@ def run_experiment(
         method=kwargs["method"],
         reduction=kwargs["reduction"],
         device=kwargs["device"],
+        parameter_selector=kwargs["parameter_selector"],
+        select_constraints=kwargs["select_constraints"],
     )
 
     # These are not trainers simply because we don't provide the optimizer
@@ -194,6 +225,9 @@ def run_experiment(
             method=kwargs["method"],
             reduction=kwargs["reduction"],
             device=kwargs["device"],
+            parameter_selector=kwargs["parameter_selector"],
+            select_constraints=kwargs["select_constraints"],
+            derivative_backend=kwargs["evaluation_derivative_backend"],
         )
     else:
         train_evaluator = None
@@ -206,6 +240,9 @@ def run_experiment(
             method=kwargs["method"],
             reduction=kwargs["reduction"],
             device=kwargs["device"],
+            parameter_selector=kwargs["parameter_selector"],
+            select_constraints=kwargs["select_constraints"],
+            derivative_backend=kwargs["evaluation_derivative_backend"],
         )
     else:
         test_evaluator = None
@@ -246,6 +283,17 @@ def run_experiment(
         if should_checkpoint:
             checkpointer(trainer)
 
+    # Move the training points towards high constraint residuals
+    if kwargs["training_parameterizations"]["sampling"] == "adaptive":
+        score = constraint_residual_score(
+            model, constraint, device=kwargs["device"]
+        )
+
+        @trainer.on(Events.EPOCH_COMPLETED)
+        def refine_training_points(trainer):
+            if trainer.state.epoch % kwargs["adaptive_sampling_interval"] == 0:
+                train_dl.dataset.refine(score)
+
     if should_log:
 
         @trainer.on(Events.ITERATION_COMPLETED)
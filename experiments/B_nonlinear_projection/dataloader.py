@@ -7,7 +7,11 @@ import torch
 from torch.utils.data import TensorDataset, DataLoader, Dataset, ConcatDataset
 
 
-__all__ = ["get_singlewave_dataloaders", "get_multiwave_dataloaders"]
+__all__ = [
+    "get_singlewave_dataloaders",
+    "get_multiwave_dataloaders",
+    "constraint_residual_score",
+]
 
 
 def construct_wave_equation(amplitude, frequency, phase):
@@ -25,7 +29,8 @@ class SingleWaveDataset(Dataset):
             if seed is not None:
                 torch.manual_seed(seed)
             xs = 2 * torch.rand((num_points, 1)) - 1
-        elif sampling == "uniform":
+        elif sampling in ["uniform", "adaptive"]:
+            # Adaptive sampling starts from uniform points and refines them
             xs = torch.linspace(-1, 1, num_points).unsqueeze(-1)
         else:
             raise ValueError(f"Sampling method {sampling} not recognized!")
@@ -33,6 +38,10 @@ class SingleWaveDataset(Dataset):
         ys = wave_equation(xs)
         return xs, ys
 
+    @staticmethod
+    def make_candidates(num_candidates):
+        return 2 * torch.rand((num_candidates, 1)) - 1
+
     @staticmethod
     def make_parameter_tensor(amplitude, frequency, phase):
         return torch.tensor([amplitude, frequency, phase])
@@ -45,6 +54,8 @@ class SingleWaveDataset(Dataset):
         num_points,
         sampling="uniform",
         seed=None,
+        num_candidates=None,
+        adaptive_fraction=0.5,
     ):
         """A dataset with a single example of a wave equation
 
@@ -54,10 +65,23 @@ class SingleWaveDataset(Dataset):
         :param sampling: method to use for sampling:
             "uniform" - training points sampled with constant interval in [-1,1]
             "random" - training points sampled randomly in [-1,1]
+            "adaptive" - training points start uniform and are moved towards
+                high constraint residuals by refine()
         :param num_points: number of points per parameterization
         :param seed: optional seed for generating data
+        :param num_candidates: size of the random candidate pool scored by
+            refine(). Defaults to 10 * num_points
+        :param adaptive_fraction: fraction of the points which refine()
+            replaces. Defaults to 0.5
         """
         self.length = num_points
+        self.num_candidates = (
+            10 * num_points if num_candidates is None else num_candidates
+        )
+        self.adaptive_fraction = adaptive_fraction
+        self.wave_equation = construct_wave_equation(
+            amplitude, frequency, phase
+        )
 
         self.parameter_tensor = self.make_parameter_tensor(
             amplitude, frequency, phase
@@ -75,6 +99,28 @@ class SingleWaveDataset(Dataset):
         param = self.parameter_tensor
         return (x, param), y
 
+    def refine(self, score):
+        """Residual-based adaptive refinement. Scores a fresh pool of random
+        candidate points and replaces the lowest-scoring points of the dataset
+        with the highest-scoring candidates, so the number of points stays
+        the same
+
+        :param score: function of a tensor of points of size (n, 1) and the
+            parameter tensor, which returns a tensor of size (n,) of their
+            constraint residuals. See constraint_residual_score()
+        """
+        num_replaced = int(round(self.adaptive_fraction * self.length))
+        num_replaced = min(num_replaced, self.num_candidates)
+        if num_replaced <= 0:
+            return
+        xs = self.xy[0].detach()
+        candidates = self.make_candidates(self.num_candidates)
+        scores = score(torch.cat([xs, candidates]), self.parameter_tensor)
+        kept = torch.topk(scores[: self.length], self.length - num_replaced)[1]
+        added = torch.topk(scores[self.length :], num_replaced)[1]
+        xs = torch.cat([xs[kept], candidates[added]])
+        self.xy = xs, self.wave_equation(xs)
+
 
 class MultiWaveDataset(ConcatDataset):
     def __init__(
@@ -85,6 +131,8 @@ class MultiWaveDataset(ConcatDataset):
         num_points,
         sampling="uniform",
         seed=None,
+        num_candidates=None,
+        adaptive_fraction=0.5,
     ):
         """A dataset with multiple examples of a wave equation
 
@@ -94,8 +142,14 @@ class MultiWaveDataset(ConcatDataset):
         :param sampling: method to use for sampling:
             "uniform" - training points sampled with constant interval in [-1,1]
             "random" - training points sampled randomly in [-1,1]
+            "adaptive" - training points start uniform and are moved towards
+                high constraint residuals by refine()
         :param num_points: number of points per parameterization
         :param seed: optional seed for generating data
+        :param num_candidates: size of the candidate pool per parameterization
+            for adaptive sampling. Defaults to 10 * num_points
+        :param adaptive_fraction: fraction of the points per parameterization
+            which are replaced by each refinement. Defaults to 0.5
         """
         parameterizations = [
             {"amplitude": amplitude, "frequency": frequency, "phase": phase}
@@ -109,11 +163,43 @@ class MultiWaveDataset(ConcatDataset):
                 num_points=num_points,
                 sampling=sampling,
                 seed=seed,
+                num_candidates=num_candidates,
+                adaptive_fraction=adaptive_fraction,
             )
             for parameterization in parameterizations
         ]
         super().__init__(datasets)
 
+    def refine(self, score):
+        """Refines the points of every parameterization. See
+        SingleWaveDataset.refine()"""
+        for dataset in self.datasets:
+            dataset.refine(score)
+
+
+def constraint_residual_score(model, constraint_fn, device="cpu"):
+    """Creates a function which scores points by the magnitude of the
+    constraint residual of the model at them, for adaptive sampling
+
+    :param model: the model being trained
+    :param constraint_fn: the constraint function, with the same signature as
+        in the event loop
+    :param device: device to evaluate the model on
+    :returns: function of points of size (n, 1) and a parameter tensor, which
+        returns the summed absolute residuals of size (n,) on the cpu
+    """
+
+    def score(xs, parameter_tensor):
+        xs = xs.to(device).requires_grad_()
+        params = parameter_tensor.detach().to(device).expand(len(xs), -1)
+        out = model(xs, params)
+        constraints, __ = constraint_fn(out, (xs, params), model, True)
+        return torch.sum(
+            torch.abs(constraints.detach()).view(len(xs), -1), dim=-1
+        ).cpu()
+
+    return score
+
 
 def get_singlewave_dataloaders(
     training_parameterization,
@@ -190,7 +276,13 @@ def get_multiwave_dataloaders(
         sampling: method to use for sampling:
             "uniform" - training points sampled with constant interval in [-1,1]
             "random" - training points sampled randomly in [-1,1]
+            "adaptive" - training points start uniform and are refined towards
+                high constraint residuals with train_dl.dataset.refine()
         num_points: number of points per parameterization
+        num_candidates: optional size of the candidate pool per
+            parameterization for adaptive sampling
+        adaptive_fraction: optional fraction of the points replaced by each
+            adaptive refinement
     :param testing_parameterizations: sames as training_parameterizations, but
         for testing data
     :param seed: optional seed for generating data
@@ -213,6 +305,10 @@ def get_multiwave_dataloaders(
         training_num_points,
         training_sampling,
         seed=seed,
+        num_candidates=training_parameterizations.get("num_candidates"),
+        adaptive_fraction=training_parameterizations.get(
+            "adaptive_fraction", 0.5
+        ),
     )
     testing_amplitudes = testing_parameterizations["amplitudes"]
     testing_frequencies = testing_parameterizations["frequencies"]
@@ -226,6 +322,10 @@ def get_multiwave_dataloaders(
         testing_num_points,
         testing_sampling,
         seed=seed,
+        num_candidates=testing_parameterizations.get("num_candidates"),
+        adaptive_fraction=testing_parameterizations.get(
+            "adaptive_fraction", 0.5
+        ),
     )
     train_dl = DataLoader(train_ds, batch_size, shuffle=True)
     proj_dl = DataLoader(test_ds, proj_batch_size, shuffle=True)
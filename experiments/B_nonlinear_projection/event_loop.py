@@ -13,6 +13,8 @@ try:
 except ImportError:
     from time import time as perf_counter
 
+from src.derivatives import DerivativeContext
+
 __all__ = ["create_engine", "Sub_Batch_Events"]
 
 
@@ -41,6 +43,26 @@ def prepare_batch(batch, device=None, non_blocking=False):
     )
 
 
+def forward(model, xb, context, taylor_mode=False):
+    """Runs the forward pass of the model. In Taylor mode, the jacobian and
+    laplacian of the output with respect to the inputs are propagated
+    alongside it and stored in the context, so that the constraint needn't run
+    the model again
+
+    :param model: the model. Must have forward_with_derivatives() in Taylor
+        mode
+    :param xb: inputs to the model (inputs, parameterization)
+    :param context: src.derivatives.DerivativeContext for this batch
+    :param taylor_mode: whether to use the Taylor-mode forward pass
+    :returns: output of the model
+    """
+    if not taylor_mode:
+        return model(*xb)
+    out, jac, lap = model.forward_with_derivatives(*xb)
+    context.set_derivatives(out, xb[0], jacobian=jac, laplacian=lap)
+    return out
+
+
 def end_section(engine, section_event, section_start_time):
     """End the section, tabulate the time, fire the event, and resume time"""
     engine.state.times[section_event.value] = (
@@ -65,6 +87,7 @@ class TrainingLoop(object):
         error_fn,
         guard=True,
         device="cpu",
+        derivative_backend=None,
     ):
         self.model = model
         self.loss_fn = loss_fn
@@ -76,6 +99,17 @@ class TrainingLoop(object):
         )
         self.guard = guard
         self.device = torch.device(device)
+        if derivative_backend is not None:
+            self.constraint_kwargs = {"derivative_backend": derivative_backend}
+        else:
+            self.constraint_kwargs = dict()
+        # The constraint reads the derivatives of the output from the context,
+        # so they are propagated alongside the forward pass where possible
+        self.taylor_mode = (
+            derivative_backend is None
+            and hasattr(model, "forward_with_derivatives")
+            and getattr(constraint_fn, "supports_taylor_mode", False)
+        )
 
     def __call__(self, engine, batch):
         if not hasattr(engine.state, "times"):
@@ -95,7 +129,11 @@ class TrainingLoop(object):
             engine, Sub_Batch_Events.DATA_LOADED, section_start
         )
 
-        engine.state.out = self.model(*engine.state.xb)
+        # All constraints on this batch share their derivatives
+        context = DerivativeContext()
+        engine.state.out = forward(
+            self.model, engine.state.xb, context, taylor_mode=self.taylor_mode
+        )
         section_start = end_section(
             engine, Sub_Batch_Events.FORWARD_PASS_COMPLETED, section_start
         )
@@ -129,8 +167,13 @@ class TrainingLoop(object):
         )
 
         engine.state.constraints, engine.state.constraints_diagnostics = self.constraint_fn(
-            engine.state.out, engine.state.xb, self.model, True
-        )  # last parameter is to return diagnostics
+            engine.state.out,
+            engine.state.xb,
+            self.model,
+            True,
+            context=context,
+            **self.constraint_kwargs,
+        )  # fourth parameter is to return diagnostics
         engine.state.constraints_error = self.error_fn(engine.state.constraints)
         section_start = end_section(
             engine, Sub_Batch_Events.CONSTRAINTS_COMPUTED, section_start
@@ -199,6 +242,11 @@ class ProjectionLoop(object):
             error_fn if error_fn is not None else self.mean_squared_error
         )
         self.device = torch.device(device)
+        # The constraint reads the derivatives of the output from the context,
+        # so they are propagated alongside the forward pass where possible
+        self.taylor_mode = hasattr(
+            model, "forward_with_derivatives"
+        ) and getattr(constraint_fn, "supports_taylor_mode", False)
 
     def __call__(self, engine, batch):
         # Used to restore model (both are important here)
@@ -229,7 +277,11 @@ class ProjectionLoop(object):
             engine, Sub_Batch_Events.DATA_LOADED, section_start
         )
 
-        engine.state.out = self.model(*engine.state.xb)
+        # All constraints on this batch share their derivatives
+        context = DerivativeContext()
+        engine.state.out = forward(
+            self.model, engine.state.xb, context, taylor_mode=self.taylor_mode
+        )
         section_start = end_section(
             engine, Sub_Batch_Events.FORWARD_PASS_COMPLETED, section_start
         )
@@ -241,8 +293,12 @@ class ProjectionLoop(object):
         )
 
         engine.state.constraints, engine.state.constraints_diagnostics = self.constraint_fn(
-            engine.state.out, engine.state.xb, self.model, True
-        )  # last parameter is to return diagnostics
+            engine.state.out,
+            engine.state.xb,
+            self.model,
+            True,
+            context=context,
+        )  # fourth parameter is to return diagnostics
         engine.state.constraints_error = self.error_fn(engine.state.constraints)
         section_start = end_section(
             engine, Sub_Batch_Events.CONSTRAINTS_COMPUTED, section_start
@@ -284,6 +340,7 @@ def create_engine(
     device="cpu",
     tolerance=1e-5,
     max_iterations=1e4,
+    derivative_backend=None,
 ):
     """Creates an engine with the necessary components. If optimizer is not
     provided, then will run inference
@@ -304,17 +361,27 @@ def create_engine(
     :param error_fn: error function to use for converting the constraint 
         function to an error function for soft constraining. Defaults to MSE
     :param device: "cuda" or "cpu"
+    :param derivative_backend: optional dictionary passed to the constraint
+        function to select how it computes derivatives with respect to the
+        inputs, e.g. {"backend": "finite-difference", "step": 1e-2, "order": 2}.
+        Only used by the training (or evaluation) loop. Defaults to None for
+        the constraint's own choice
     :returns: an ignite.engine.Engine whose output is (xb, yb, out) for every
         iteration
     """
 
     if projection:
-        iteration_fn = ProjectionLoop
+        iteration_fn = ProjectionLoop(
+            model,
+            loss_fn,
+            constraint_fn,
+            optimizer,
+            regularization_weight,
+            error_fn,
+            device,
+        )
     else:
-        iteration_fn = TrainingLoop
-
-    engine = Engine(
-        iteration_fn(
+        iteration_fn = TrainingLoop(
             model,
             loss_fn,
             constraint_fn,
@@ -322,8 +389,10 @@ def create_engine(
             regularization_weight,
             error_fn,
             device,
+            derivative_backend=derivative_backend,
         )
-    )
+
+    engine = Engine(iteration_fn)
     engine.register_events(*Sub_Batch_Events)
 
     if monitor is not None:
@@ -10,7 +10,7 @@ import torch.optim as optim
 
 from .checkpointer import ModelAndMonitorCheckpointer
 from .constraints import helmholtz_equation, pythagorean_equation
-from .dataloader import get_multiwave_dataloaders
+from .dataloader import get_multiwave_dataloaders, constraint_residual_score
 from .event_loop import create_engine, Sub_Batch_Events
 from .model import Dense, ParameterizedDense
 from .monitor import TrainingMonitor, ProjectionMonitor
@@ -45,6 +45,16 @@ def default_configuration():
         error function for soft constraining. Defaults to MSE
     tolerance: desired maximum value of constraint error
     max_iterations: maximum number of iterations in the projection step
+    trace_estimation: optional dictionary of keyword arguments ("num_probes"
+        and optionally "distribution") for estimating the laplacian of the
+        constraint with random probes. Defaults to None for exact computation
+    evaluation_derivative_backend: optional dictionary selecting how the
+        evaluator computes derivatives of the model for the constraint, e.g.
+        {"backend": "finite-difference", "step": 1e-2, "order": 2}. Defaults to
+        None for the same derivatives as used in training
+    adaptive_sampling_interval: number of epochs between refinements of the
+        training points when their sampling is "adaptive". See
+        dataloader.SingleWaveDataset.refine(). Defaults to 1
     """
     return {
         "seed": None,
@@ -76,6 +86,9 @@ def default_configuration():
         "error_fn": None,
         "tolerance": 1e-5,
         "max_iterations": 1e4,
+        "trace_estimation": None,
+        "evaluation_derivative_backend": None,
+        "adaptive_sampling_interval": 1,
     }
 
 
@@ -121,6 +134,12 @@ def get_loss_and_constraint(configuration):
     # We need the entire batch of losses, not it's sum
     loss = nn.MSELoss(reduction="none")
     constraint = configuration["constraint"]
+    if configuration["trace_estimation"] is not None:
+        constraint = functools.partial(
+            constraint, **configuration["trace_estimation"]
+        )
+        # The laplacian of a Taylor-mode forward pass would be exact
+        constraint.supports_taylor_mode = False
     return loss, constraint
 
 
@@ -215,6 +234,7 @@ def run_experiment(
             device=kwargs["device"],
             tolerance=kwargs["tolerance"],
             max_iterations=kwargs["max_iterations"],
+            derivative_backend=kwargs["evaluation_derivative_backend"],
         )
     else:
         evaluator = None
@@ -296,6 +316,17 @@ def run_experiment(
             # Unblock the projector so it can resume later
             projector.should_terminate = False
 
+    # Move the training points towards high constraint residuals
+    if kwargs["training_parameterizations"]["sampling"] == "adaptive":
+        score = constraint_residual_score(
+            model, constraint, device=kwargs["device"]
+        )
+
+        @trainer.on(Events.EPOCH_COMPLETED)
+        def refine_training_points(trainer):
+            if trainer.state.epoch % kwargs["adaptive_sampling_interval"] == 0:
+                train_dl.dataset.refine(score)
+
     if should_log:
 
         @trainer.on(Events.ITERATION_COMPLETED)
@@ -3,6 +3,13 @@
 import torch
 import torch.nn as nn
 
+from src.taylor_mode import (
+    taylor_activation,
+    taylor_input,
+    taylor_linear,
+    taylor_scale,
+)
+
 from src.projection import ProjectableModel
 
 
@@ -13,6 +20,13 @@ class Swish(object):
     def __call__(self, x):
         return x * torch.sigmoid(x)
 
+    def taylor_derivatives(self, x):
+        sigmoid = torch.sigmoid(x)
+        d_sigmoid = sigmoid * (1 - sigmoid)
+        first = sigmoid + x * d_sigmoid
+        second = d_sigmoid * (2 + x * (1 - 2 * sigmoid))
+        return x * sigmoid, first, second
+
     def __str__(self):
         return "Swish()"
 
@@ -60,6 +74,35 @@ class Dense(ProjectableModel):
             xb = self.final_act(xb)
         return xb.view(-1, 1)
 
+    def forward_with_derivatives(self, xb, parameterization):
+        """Computes the output of the model together with its jacobian and
+        laplacian with respect to xb in a single augmented forward pass
+
+        :returns: output of size (batchsize, 1), jacobian of size
+            (batchsize, 1, in_size), laplacian of size (batchsize, 1)
+        """
+        value, jac, lap = taylor_input(xb)
+        # The parameterization is constant with respect to the inputs
+        value = torch.cat((value, parameterization), dim=1)
+        jac = torch.cat(
+            (jac, jac.new_zeros((*parameterization.size(), jac.size()[-1]))),
+            dim=1,
+        )
+        lap = torch.cat((lap, torch.zeros_like(parameterization)), dim=1)
+        for layer in self.layers[:-1]:
+            value, jac, lap = taylor_linear(layer, value, jac, lap)
+            value, jac, lap = taylor_activation(self.act, value, jac, lap)
+        value, jac, lap = taylor_linear(self.layers[-1], value, jac, lap)
+        if self.final_act is not None:
+            value, jac, lap = taylor_activation(
+                self.final_act, value, jac, lap
+            )
+        return (
+            value.view(-1, 1),
+            jac.view(-1, 1, jac.size()[-1]),
+            lap.view(-1, 1),
+        )
+
 
 class ParameterizedDense(ProjectableModel):
     """A model which is a standard dense neural network, but after every layer,
@@ -114,3 +157,30 @@ class ParameterizedDense(ProjectableModel):
         if self.final_act is not None:
             xb = self.final_act(xb)
         return xb.view(-1, 1)
+
+    def forward_with_derivatives(self, xb, parameterization):
+        """Computes the output of the model together with its jacobian and
+        laplacian with respect to xb in a single augmented forward pass
+
+        :returns: output of size (batchsize, 1), jacobian of size
+            (batchsize, 1, in_size), laplacian of size (batchsize, 1)
+        """
+        # The reweightings are constant with respect to the inputs
+        reweightings = self.get_parameterized_reweightings(parameterization)
+        value, jac, lap = taylor_input(xb)
+        for layer, reweighting in zip(self.layers[:-1], reweightings):
+            value, jac, lap = taylor_linear(layer, value, jac, lap)
+            value, jac, lap = taylor_activation(self.act, value, jac, lap)
+            value, jac, lap = taylor_scale(
+                reweighting.view(value.size()), value, jac, lap
+            )
+        value, jac, lap = taylor_linear(self.layers[-1], value, jac, lap)
+        if self.final_act is not None:
+            value, jac, lap = taylor_activation(
+                self.final_act, value, jac, lap
+            )
+        return (
+            value.view(-1, 1),
+            jac.view(-1, 1, jac.size()[-1]),
+            lap.view(-1, 1),
+        )
@@ -1,6 +1,8 @@
 import glob
 import os
 
+from ignite.engine import Events
+import pytest
 import torch
 import torch.nn as nn
 
@@ -8,8 +10,25 @@ from ..A_constrained_training.constraints import (
     helmholtz_equation,
     pythagorean_equation,
 )
-from ..A_constrained_training.main import run_experiment
+from ..A_constrained_training.dataloader import (
+    MultiWaveDataset,
+    get_multiwave_dataloaders,
+)
+from ..A_constrained_training.event_loop import create_engine, forward
+from ..A_constrained_training.main import (
+    default_configuration,
+    get_loss_and_constraint,
+    run_experiment,
+)
+from ..A_constrained_training.model import Dense, ParameterizedDense
 from ..A_constrained_training.reductions import Lp_Reduction
+from src.derivatives import DerivativeContext
+from src.lagrange import (
+    PerSampleGradients,
+    ProjectedOptimizer,
+    constrain_loss,
+    select_parameters,
+)
 
 
 def test_constrained_training():
@@ -88,3 +107,233 @@ def test_constrained_training():
 
     if failure is not None:
         raise failure
+
+
+def test_adaptive_sampling():
+
+    dataset = MultiWaveDataset(
+        [1.0], [1.0, 2.0], [0.0], 20, sampling="adaptive", num_candidates=200
+    )
+
+    # Score points by their closeness to x = 0.5
+    def score(xs, parameter_tensor):
+        return -torch.abs(xs - 0.5).view(-1)
+
+    dataset.refine(score)
+    assert len(dataset) == 40
+    for single in dataset.datasets:
+        xs, ys = single.xy
+        assert xs.size() == (20, 1)
+        # Half of the points were replaced by the closest of the candidates
+        assert torch.sum(torch.abs(xs - 0.5) < 0.1) >= 10
+        assert torch.allclose(ys, single.wave_equation(xs))
+
+    # The refinement also runs as part of training
+    run_experiment(
+        2,
+        evaluate_training=False,
+        evaluate_testing=False,
+        training_parameterizations={
+            "amplitudes": [1.0],
+            "frequencies": [1.0],
+            "phases": [0.0],
+            "num_points": 20,
+            "sampling": "adaptive",
+        },
+    )
+
+
+def test_linear_gram():
+
+    model = Dense(1, 3, 1, sizes=[5])
+    loss = nn.MSELoss(reduction="none")
+
+    # Constraints on derivatives w.r.t. the inputs are rejected up front
+    try:
+        create_engine(
+            model,
+            loss,
+            helmholtz_equation,
+            method="constrained",
+            linear_gram=True,
+        )
+    except ValueError:
+        pass
+    else:
+        assert False, "Should have rejected the constraint"
+
+    def output_constraint(out, xb, model, return_diagnostics, **kwargs):
+        constraints = out - xb[1][:, :1]
+        return (constraints, None) if return_diagnostics else constraints
+
+    output_constraint.uses_input_derivatives = False
+
+    configuration = default_configuration()
+    train_dl, __ = get_multiwave_dataloaders(
+        configuration["training_parameterizations"],
+        configuration["testing_parameterizations"],
+        batch_size=5,
+    )
+    for method in ["constrained", "batchwise", "projected"]:
+        engine = create_engine(
+            model,
+            loss,
+            output_constraint,
+            torch.optim.SGD(model.parameters(), lr=0.01),
+            method=method,
+            linear_gram=True,
+        )
+        engine.run(train_dl, max_epochs=1)
+        # The hooks are removed when the engine is done
+        assert all(len(layer._forward_hooks) == 0 for layer in model.layers)
+
+
+def test_per_sample_loss_jacobian(monkeypatch):
+
+    # Record which jacobians used the per-sample gradients
+    used = list()
+    per_sample_jacobian = PerSampleGradients.jacobian
+
+    def recording_jacobian(self, y, parameters, create_graph=False):
+        jacs = per_sample_jacobian(
+            self, y, parameters, create_graph=create_graph
+        )
+        used.append(jacs is not None)
+        return jacs
+
+    monkeypatch.setattr(PerSampleGradients, "jacobian", recording_jacobian)
+
+    model = Dense(1, 3, 1, sizes=[5])
+    configuration = default_configuration()
+    train_dl, __ = get_multiwave_dataloaders(
+        configuration["training_parameterizations"],
+        configuration["testing_parameterizations"],
+        batch_size=5,
+    )
+    for method in ["constrained", "projected"]:
+        del used[:]
+        engine = create_engine(
+            model,
+            nn.MSELoss(reduction="none"),
+            helmholtz_equation,
+            torch.optim.SGD(model.parameters(), lr=0.01),
+            method=method,
+        )
+        engine.run(train_dl, max_epochs=1)
+        # Only the loss is attempted, since the constraint differentiates the
+        # model w.r.t. its inputs, and it always succeeds
+        assert len(used) == len(train_dl)
+        assert all(used)
+
+
+def test_select_constraints():
+
+    # Off by default, so that "batchwise" results stay comparable
+    assert not default_configuration()["select_constraints"]
+    run_experiment(
+        1,
+        evaluate_training=False,
+        evaluate_testing=False,
+        method="batchwise",
+        select_constraints=True,
+    )
+
+
+def test_parameter_selection():
+
+    model = ParameterizedDense(1, 3, 1, sizes=[5, 5], activation=nn.Tanh())
+
+    # The param_layer is registered last, but is not the last layer
+    assert select_parameters(model, "layer2") == [
+        model.layer2.weight,
+        model.layer2.bias,
+    ]
+    with pytest.raises(ValueError):
+        select_parameters(model, 1)
+
+    # Both methods train the parameters which are not selected with the
+    # gradient of the constrained loss
+    selected = select_parameters(model, ["layer2", "param_layer"])
+    out = model(torch.rand(7, 1), torch.rand(7, 3))
+    loss = torch.sum((out - 1) ** 2, dim=-1)
+    constraints = torch.sin(out)
+    model.zero_grad()
+    torch.mean(constrain_loss(loss, constraints, selected)).backward(
+        retain_graph=True
+    )
+    expected = [param.grad.clone() for param in model.parameters()]
+
+    optimizer = ProjectedOptimizer(
+        torch.optim.SGD(model.parameters(), lr=1e-3), parameters=selected
+    )
+    optimizer.zero_grad()
+    optimizer.project(loss, constraints)
+    for param, exp in zip(model.parameters(), expected):
+        assert torch.allclose(param.grad, exp, atol=1e-5)
+
+
+def test_trace_estimation():
+
+    torch.manual_seed(0)
+    model = Dense(1, 3, 1, sizes=[20, 20], activation=nn.Tanh())
+    xb = (torch.rand(16, 1, requires_grad=True), torch.rand(16, 3))
+
+    # The exact laplacian of a Taylor-mode forward pass
+    context = DerivativeContext()
+    out = forward(model, xb, context, taylor_mode=True)
+    __, (exact, __, __) = helmholtz_equation(
+        out, xb, model, True, context=context
+    )
+
+    # Gaussian probes don't estimate the laplacian of a single input exactly
+    configuration = default_configuration()
+    configuration["trace_estimation"] = {
+        "num_probes": 1,
+        "distribution": "gaussian",
+    }
+    __, constraint = get_loss_and_constraint(configuration)
+    assert not constraint.supports_taylor_mode
+    out = model(*xb)
+    __, (estimate, __, __) = constraint(out, xb, model, True)
+    assert estimate.size() == exact.size()
+    assert not torch.allclose(estimate, exact)
+
+    # Neither does the engine compute the exact laplacian in Taylor mode
+    engine = create_engine(model, nn.MSELoss(reduction="none"), constraint)
+    batch = (xb, torch.zeros(16, 1))
+    engine.run([batch], max_epochs=1)
+    estimate, __, __ = engine.state.constraints_diagnostics
+    assert not torch.allclose(estimate, exact)
+
+
+def test_warm_started_engine():
+
+    torch.manual_seed(0)
+    model = Dense(1, 3, 1, sizes=[20], activation=nn.Tanh())
+    configuration = default_configuration()
+    train_dl, __ = get_multiwave_dataloaders(
+        configuration["training_parameterizations"],
+        configuration["testing_parameterizations"],
+        batch_size=16,
+    )
+    batch = next(iter(train_dl))
+
+    # Without a reduction, all 16 constraints of the batch are enforced
+    engine = create_engine(
+        model,
+        nn.MSELoss(reduction="none"),
+        helmholtz_equation,
+        torch.optim.SGD(model.parameters(), lr=1e-6),
+        method="warm-started",
+    )
+    refreshed = list()
+
+    @engine.on(Events.ITERATION_COMPLETED)
+    def record_refresh(engine):
+        refreshed.append(engine.state.times["multipliers: refreshed"])
+
+    engine.run([batch] * 5, max_epochs=1)
+    assert engine.state.multipliers.numel() == 16
+    # The first step is exact, but later small steps reuse the multipliers
+    assert refreshed[0]
+    assert not all(refreshed)
@@ -1,18 +1,44 @@
 """Tools for differentiably computing derivatives"""
 
+import inspect
 import torch
 from torch import autograd
 
 
 __all__ = [
+    "DerivativeContext",
+    "jvp",
     "jacobian",
     "jacobian_and_hessian",
     "trace",
     "divergence",
+    "estimate_divergence",
     "jacobian_and_laplacian",
+    "jacobian_and_estimated_laplacian",
+    "finite_difference_jacobian_and_laplacian",
 ]
 
 
+# Newer versions of PyTorch can compute several vector-Jacobian products in a
+# single (vmapped) backward pass. Older versions have to loop over the rows
+_SUPPORTS_BATCHED_GRADS = (
+    "is_grads_batched" in inspect.signature(autograd.grad).parameters
+)
+
+
+# Central difference stencils as (offsets, first derivative weights, second
+# derivative weights, second derivative weight of the center point)
+_FINITE_DIFFERENCE_STENCILS = {
+    2: ([-1, 1], [-1 / 2, 1 / 2], [1, 1], -2),
+    4: (
+        [-2, -1, 1, 2],
+        [1 / 12, -8 / 12, 8 / 12, -1 / 12],
+        [-1 / 12, 16 / 12, 16 / 12, -1 / 12],
+        -30 / 12,
+    ),
+}
+
+
 def _get_size(tensor):
     """Returns the size of a tensor, but treats a scalar as a 1-element vector"""
     if tensor.dim() == 0:
@@ -109,7 +135,436 @@ def _batched_jacobian(y, xs, create_graph, allow_unused):
     return jacs
 
 
-def jacobian(y, xs, batched=False, create_graph=False, allow_unused=False):
+def _vectorized_rows(y, xs, batched, create_graph, allow_unused, rows):
+    """Computes some rows of the jacobian of outputs with respect to inputs
+    using a single batched vector-jacobian product
+
+    :param y: tensor for the output of some function
+    :param xs: a list of tensors for the inputs of some function
+    :param batched: whether the first dimension of y and xs is actually a
+        batch dimension (i.e. the function was applied to an entire batch)
+    :param create_graph: set True for the resulting jacobian to be differentible
+    :param allow_unused: set False to assert all inputs affected the outputs
+    :param rows: range of the (per-sample) flattened elements of y to
+        differentiate
+    :returns: a list of tensors of size (len(rows), *xs[i].size()), where the
+        size of xs[i] includes the batch dimension if batched
+    :throws: RuntimeError if the batched backward pass is not supported for
+        some operation in the graph of y
+    """
+    rows = list(rows)
+    if batched:
+        batchsize = _get_size(y)[0]
+        num_rows = _get_size(y)[1:].numel()
+        # Each row queries a single output element for every batch element
+        query_vectors = (
+            torch.eye(num_rows, dtype=y.dtype, device=y.device)[rows]
+            .unsqueeze(1)
+            .expand(len(rows), batchsize, num_rows)
+            .reshape(len(rows), *y.size())
+        )
+    else:
+        num_rows = _get_size(y).numel()
+        query_vectors = torch.eye(num_rows, dtype=y.dtype, device=y.device)[
+            rows
+        ].view(len(rows), *y.size())
+
+    grads = autograd.grad(
+        y,
+        xs,
+        grad_outputs=query_vectors,
+        retain_graph=True,
+        create_graph=create_graph,
+        allow_unused=allow_unused,
+        is_grads_batched=True,
+    )
+    return [
+        # this element doesn't depend on the xs, so leave gradient 0
+        y.new_zeros((len(rows), *_get_size(x))) if grad is None else grad
+        for x, grad in zip(xs, grads)
+    ]
+
+
+def _looped_rows(y, xs, batched, create_graph, allow_unused, rows):
+    """Computes some rows of the jacobian of outputs with respect to inputs
+    with one vector-jacobian product per row. See _vectorized_rows()"""
+    rows = list(rows)
+    if batched:
+        flat_y = y.reshape(_get_size(y)[0], -1)
+        query_vector = y.new_ones(_get_size(y)[0])
+    else:
+        flat_y = y.view(-1)
+        query_vector = None
+
+    cols = [list() for x in xs]
+    for i in rows:
+        cols_i = autograd.grad(
+            flat_y[:, i] if batched else flat_y[i],
+            xs,
+            grad_outputs=query_vector,
+            retain_graph=True,
+            create_graph=create_graph,
+            allow_unused=allow_unused,
+        )
+        for j, col_i in enumerate(cols_i):
+            if col_i is None:
+                # this element doesn't depend on the xs, so leave gradient 0
+                col_i = y.new_zeros(_get_size(xs[j]))
+            cols[j].append(col_i)
+    return [torch.stack(col, dim=0) for col in cols]
+
+
+def _rows_to_jacobian(y, x, rows, batched, create_graph):
+    """Reshapes all rows of the jacobian of y with respect to x (as returned by
+    _vectorized_rows or _looped_rows) into the jacobian"""
+    if batched:
+        # (outsize, batchsize, insize) -> (batchsize, outsize, insize)
+        jac = rows.transpose(0, 1).reshape(
+            _get_size(y)[0], *_get_size(y)[1:], *_get_size(x)[1:]
+        )
+    else:
+        jac = rows.reshape(*_get_size(y), *_get_size(x))
+    if create_graph and not jac.requires_grad:
+        jac.requires_grad_()
+    return jac
+
+
+def _vectorized_jacobian(y, xs, batched, create_graph, allow_unused):
+    """Computes the jacobian of outputs with respect to inputs using a single
+    batched vector-jacobian product for all rows
+
+    :param y: tensor for the output of some function
+    :param xs: a list of tensors for the inputs of some function
+    :param batched: whether the first dimension of y and xs is actually a
+        batch dimension (i.e. the function was applied to an entire batch)
+    :param create_graph: set True for the resulting jacobian to be differentible
+    :param allow_unused: set False to assert all inputs affected the outputs
+    :returns: a list of tensors of the same sizes as those returned by
+        _jacobian or _batched_jacobian, depending on batched
+    :throws: RuntimeError if the batched backward pass is not supported for
+        some operation in the graph of y
+    """
+    num_rows = (_get_size(y)[1:] if batched else _get_size(y)).numel()
+    rows = _vectorized_rows(
+        y,
+        xs,
+        batched=batched,
+        create_graph=create_graph,
+        allow_unused=allow_unused,
+        rows=range(num_rows),
+    )
+    return [
+        _rows_to_jacobian(y, x, row, batched, create_graph)
+        for x, row in zip(xs, rows)
+    ]
+
+
+def _chunked_jacobian(
+    y, xs, batched, create_graph, allow_unused, vectorize, chunk_size
+):
+    """Computes the jacobian of outputs with respect to inputs chunk_size rows
+    at a time, so that the intermediate buffers of only one chunk are alive at
+    any point. Note that if create_graph is set, then the graphs of all rows
+    are necessarily kept alive for the resulting jacobian
+
+    :param y: tensor for the output of some function
+    :param xs: a list of tensors for the inputs of some function
+    :param batched: whether the first dimension of y and xs is actually a
+        batch dimension (i.e. the function was applied to an entire batch)
+    :param create_graph: set True for the resulting jacobian to be differentible
+    :param allow_unused: set False to assert all inputs affected the outputs
+    :param vectorize: whether to attempt to compute each chunk in a single
+        batched backward pass
+    :param chunk_size: number of (per-sample) rows to compute at a time
+    :returns: a list of jacobians, one for each of xs
+    """
+    num_rows = (_get_size(y)[1:] if batched else _get_size(y)).numel()
+    chunks = [list() for x in xs]
+    for start in range(0, num_rows, chunk_size):
+        rows = range(start, min(start + chunk_size, num_rows))
+        chunk = None
+        if vectorize and _SUPPORTS_BATCHED_GRADS:
+            try:
+                chunk = _vectorized_rows(
+                    y, xs, batched, create_graph, allow_unused, rows
+                )
+            except RuntimeError:
+                # Some operation doesn't support batched gradients
+                vectorize = False
+        if chunk is None:
+            chunk = _looped_rows(
+                y, xs, batched, create_graph, allow_unused, rows
+            )
+        for j, rows_j in enumerate(chunk):
+            chunks[j].append(rows_j)
+        del chunk
+
+    return [
+        _rows_to_jacobian(y, x, torch.cat(chunk, dim=0), batched, create_graph)
+        for x, chunk in zip(xs, chunks)
+    ]
+
+
+def _memory_chunk_size(y, xs, max_memory):
+    """Estimates the number of rows of the jacobian of y with respect to xs
+    which can be computed at a time within max_memory bytes. Each row needs
+    roughly one query vector and one gradient for every input"""
+    bytes_per_row = y.element_size() * (
+        _get_size(y).numel() + sum(_get_size(x).numel() for x in xs)
+    )
+    return max(1, int(max_memory // bytes_per_row))
+
+
+def _reverse_jacobian(
+    y, xs, batched, create_graph, allow_unused, vectorize, chunk_size=None
+):
+    """Computes the jacobian of outputs with respect to inputs in reverse mode,
+    preferring a single vectorized backward pass if possible
+
+    :param y: tensor for the output of some function
+    :param xs: a list of tensors for the inputs of some function
+    :param batched: whether the first dimension of y and xs is actually a
+        batch dimension (i.e. the function was applied to an entire batch)
+    :param create_graph: set True for the resulting jacobian to be differentible
+    :param allow_unused: set False to assert all inputs affected the outputs
+    :param vectorize: whether to attempt the vectorized computation. Falls back
+        to looping over the rows of the jacobian if not supported
+    :param chunk_size: optional number of rows to compute at a time
+    :returns: a list of jacobians, one for each of xs
+    """
+    num_rows = (_get_size(y)[1:] if batched else _get_size(y)).numel()
+    if chunk_size is not None and chunk_size < num_rows:
+        return _chunked_jacobian(
+            y,
+            xs,
+            batched=batched,
+            create_graph=create_graph,
+            allow_unused=allow_unused,
+            vectorize=vectorize,
+            chunk_size=chunk_size,
+        )
+    if vectorize and _SUPPORTS_BATCHED_GRADS:
+        try:
+            return _vectorized_jacobian(
+                y,
+                xs,
+                batched=batched,
+                create_graph=create_graph,
+                allow_unused=allow_unused,
+            )
+        except RuntimeError:
+            # Some operation doesn't support batched gradients. Genuine errors
+            # will be raised again by the fallback
+            pass
+    if batched:
+        return _batched_jacobian(
+            y, xs, create_graph=create_graph, allow_unused=allow_unused
+        )
+    else:
+        return _jacobian(
+            y, xs, create_graph=create_graph, allow_unused=allow_unused
+        )
+
+
+def _forward_jacobian(
+    y, xs, batched, create_graph, allow_unused, vectorize, chunk_size=None
+):
+    """Computes the jacobian of outputs with respect to inputs in forward mode,
+    i.e. one jacobian-vector product per element of the inputs
+
+    Since the graph of y has already been built, the jacobian-vector products
+    are computed with the "double-backward" trick: the vector-jacobian product
+    J^T v is linear in a dummy vector v, so the jacobian of J^T v with respect
+    to v is J itself
+
+    :param y: tensor for the output of some function
+    :param xs: a list of tensors for the inputs of some function
+    :param batched: whether the first dimension of y and xs is actually a
+        batch dimension (i.e. the function was applied to an entire batch)
+    :param create_graph: set True for the resulting jacobian to be differentible
+    :param allow_unused: set False to assert all inputs affected the outputs
+    :param vectorize: whether to attempt to compute all jacobian-vector
+        products in a single pass
+    :param chunk_size: optional number of jacobian-vector products to compute
+        at a time
+    :returns: a list of jacobians, one for each of xs
+    """
+    dummy = torch.zeros_like(y, requires_grad=True)
+    vjps = autograd.grad(
+        y,
+        xs,
+        grad_outputs=dummy,
+        create_graph=True,
+        allow_unused=allow_unused,
+    )
+
+    if batched:
+        batchsize = _get_size(y)[0]
+        outsize = _get_size(y)[1:]
+    else:
+        outsize = _get_size(y)
+
+    jacs = list()
+    for x, vjp in zip(xs, vjps):
+        insize = _get_size(x)[1:] if batched else _get_size(x)
+        if vjp is None:
+            # this element doesn't depend on the xs, so leave gradient 0
+            if batched:
+                jac = y.new_zeros((batchsize, *outsize, *insize))
+            else:
+                jac = y.new_zeros((*outsize, *insize))
+        else:
+            # Each row of this jacobian is a jacobian-vector product
+            transposed_jac = _reverse_jacobian(
+                vjp,
+                [dummy],
+                batched=batched,
+                create_graph=create_graph,
+                allow_unused=True,
+                vectorize=vectorize,
+                chunk_size=chunk_size,
+            )[0]
+            if batched:
+                jac = (
+                    transposed_jac.reshape(
+                        batchsize, insize.numel(), outsize.numel()
+                    )
+                    .transpose(1, 2)
+                    .reshape(batchsize, *outsize, *insize)
+                )
+            else:
+                jac = (
+                    transposed_jac.reshape(insize.numel(), outsize.numel())
+                    .t()
+                    .reshape(*outsize, *insize)
+                )
+        if create_graph and not jac.requires_grad:
+            jac.requires_grad_()
+        jacs.append(jac)
+
+    return jacs
+
+
+def _select_mode(y, xs, batched):
+    """Chooses between forward and reverse mode for the jacobian. Reverse mode
+    requires one pass per (per-sample) output element and forward mode one pass
+    per (per-sample) input element. Since our forward-mode passes go backwards
+    twice, we only prefer them when there are more than twice as many outputs
+    as inputs
+
+    :param y: tensor for the output of some function
+    :param xs: a list of tensors for the inputs of some function
+    :param batched: whether the first dimension of y and xs is actually a
+        batch dimension (i.e. the function was applied to an entire batch)
+    :returns: "forward" or "reverse"
+    """
+    if batched:
+        out_size = _get_size(y)[1:].numel()
+        in_size = sum(_get_size(x)[1:].numel() for x in xs)
+    else:
+        out_size = _get_size(y).numel()
+        in_size = sum(_get_size(x).numel() for x in xs)
+    if 2 * in_size < out_size:
+        return "forward"
+    else:
+        return "reverse"
+
+
+def jvp(y, xs, vs, create_graph=False, allow_unused=False):
+    """Computes the jacobian-vector product of y with respect to xs in the
+    direction vs (i.e. a directional derivative) without computing the jacobian
+
+    :param y: output of some tensor function
+    :param xs: either a single tensor input to some tensor function or a list
+        of tensor inputs to a function
+    :param vs: tangent vector(s) of the same shape(s) as xs
+    :param create_graph: whether the result should be differentiable
+    :param allow_unused: whether terms in xs are allowed to not contribute to
+        any of y
+    :returns: a tensor of the same size as y containing sum_i J(y, xs[i]) vs[i]
+    """
+    if not (isinstance(xs, list) or isinstance(xs, tuple)):
+        xs = [xs]
+        vs = [vs]
+    dummy = torch.zeros_like(y, requires_grad=True)
+    vjps = autograd.grad(
+        y,
+        xs,
+        grad_outputs=dummy,
+        create_graph=True,
+        allow_unused=allow_unused,
+    )
+    used = [(vjp, v) for vjp, v in zip(vjps, vs) if vjp is not None]
+    if len(used) == 0:
+        return y.new_zeros(y.size())
+    product = autograd.grad(
+        [vjp for vjp, _ in used],
+        dummy,
+        grad_outputs=[v for _, v in used],
+        retain_graph=True,
+        create_graph=create_graph,
+        allow_unused=True,
+    )[0]
+    if product is None:
+        # y is constant with respect to the xs
+        return y.new_zeros(y.size())
+    return product
+
+
+def _compute_jacobian(
+    y,
+    xs,
+    batched,
+    create_graph,
+    allow_unused,
+    vectorize,
+    mode,
+    chunk_size=None,
+    max_memory=None,
+):
+    """Computes the jacobian of y with respect to xs. See jacobian() for the
+    description of the arguments. This exists separately so that functions
+    with a "jacobian" argument can still compute jacobians"""
+    is_list = isinstance(xs, list) or isinstance(xs, tuple)
+    xs_list = xs if is_list else [xs]
+
+    if max_memory is not None:
+        memory_chunk_size = _memory_chunk_size(y, xs_list, max_memory)
+        if chunk_size is None or memory_chunk_size < chunk_size:
+            chunk_size = memory_chunk_size
+
+    if mode == "auto":
+        mode = _select_mode(y, xs_list, batched)
+    if mode == "reverse":
+        jacobian_fn = _reverse_jacobian
+    elif mode == "forward":
+        jacobian_fn = _forward_jacobian
+    else:
+        raise ValueError(f"Jacobian mode {mode} not recognized!")
+
+    jacs = jacobian_fn(
+        y,
+        xs_list,
+        batched=batched,
+        create_graph=create_graph,
+        allow_unused=allow_unused,
+        vectorize=vectorize,
+        chunk_size=chunk_size,
+    )
+    return jacs if is_list else jacs[0]
+
+
+def jacobian(
+    y,
+    xs,
+    batched=False,
+    create_graph=False,
+    allow_unused=False,
+    vectorize=True,
+    mode="reverse",
+    chunk_size=None,
+    max_memory=None,
+):
     """Computes the jacobian of y with respect to in
 
     :param y: output of some tensor function
@@ -120,33 +575,40 @@ def jacobian(y, xs, batched=False, create_graph=False, allow_unused=False):
     :param create_graph: whether the resulting hessian should be differentiable
     :param allow_unused: whether terms in xs are allowed to not contribute to
         any of y
+    :param vectorize: whether to compute all rows of the jacobian with a single
+        batched backward pass. This falls back to computing the rows one at a
+        time if the installed version of PyTorch (or some operation in the
+        graph of y) does not support it. Defaults to True
+    :param mode: method for computing the jacobian. Should be one of
+        "reverse" - one vector-jacobian product per element of y
+        "forward" - one jacobian-vector product per element of xs
+        "auto" - choose between the two based on the sizes of y and xs
+        Defaults to "reverse"
+    :param chunk_size: optional number of (per-sample) rows of the jacobian to
+        compute at a time. Only the intermediate buffers of one chunk are alive
+        at any point, which bounds the peak memory of large jacobians
+    :param max_memory: optional approximate budget in bytes for the
+        intermediate buffers of each chunk, from which the chunk size is
+        estimated. The smaller of the two chunk sizes is used if both are given
     :returns: jacobian(s) of the same shape as xs. Each jacobian will have 
         size (*y.size(), *xs[i].size()) or 
         (batchsize, *y.size()[1:], *xs[i].size()[1:])
     """
-    if isinstance(xs, list) or isinstance(xs, tuple):
-        if batched:
-            return _batched_jacobian(
-                y, xs, create_graph=create_graph, allow_unused=allow_unused
-            )
-        else:
-            return _jacobian(
-                y, xs, create_graph=create_graph, allow_unused=allow_unused
-            )
-    else:
-        xs_list = [xs]
-        if batched:
-            return _batched_jacobian(
-                y, xs_list, create_graph=create_graph, allow_unused=allow_unused
-            )[0]
-        else:
-            return _jacobian(
-                y, xs_list, create_graph=create_graph, allow_unused=allow_unused
-            )[0]
+    return _compute_jacobian(
+        y,
+        xs,
+        batched=batched,
+        create_graph=create_graph,
+        allow_unused=allow_unused,
+        vectorize=vectorize,
+        mode=mode,
+        chunk_size=chunk_size,
+        max_memory=max_memory,
+    )
 
 
 def jacobian_and_hessian(
-    y, xs, batched=False, create_graph=False, allow_unused=False
+    y, xs, batched=False, create_graph=False, allow_unused=False, mode="reverse"
 ):
     """Computes the jacobian and the hessian of y with respect to xs
 
@@ -158,10 +620,16 @@ def jacobian_and_hessian(
     :param create_graph: whether the resulting hessian should be differentiable
     :param allow_unused: whether terms in xs are allowed to not contribute to
         any of y
+    :param mode: method for computing the jacobians. See jacobian()
     :returns jacobian, hessian, which are lists if xs is a list
     """
     jac = jacobian(
-        y, xs, batched=batched, create_graph=True, allow_unused=allow_unused
+        y,
+        xs,
+        batched=batched,
+        create_graph=True,
+        allow_unused=allow_unused,
+        mode=mode,
     )
     if isinstance(jac, list):
         hes = [
@@ -171,6 +639,7 @@ def jacobian_and_hessian(
                 batched=batched,
                 create_graph=create_graph,
                 allow_unused=allow_unused,
+                mode=mode,
             )
             for jac_i in jac
         ]
@@ -181,6 +650,7 @@ def jacobian_and_hessian(
             batched=batched,
             create_graph=create_graph,
             allow_unused=allow_unused,
+            mode=mode,
         )
     return jac, hes
 
@@ -199,7 +669,13 @@ def trace(tensor):
 
 
 def divergence(
-    y, xs, jacobian=None, batched=False, create_graph=False, allow_unused=False
+    y,
+    xs,
+    jacobian=None,
+    batched=False,
+    create_graph=False,
+    allow_unused=False,
+    mode="reverse",
 ):
     """Computes the divergence of y with respect to xs. If jacobian is 
     provided, then will be more efficient
@@ -211,38 +687,535 @@ def divergence(
         batch dimension (i.e. the function was applied to an entire batch)
     :param allow_unused: whether terms in xs are allowed to not contribute to
         any of y
+    :param mode: method for computing the jacobian. See jacobian()
     :returns: divergence tensor. Size (1,) or (out.size()[0], 1)
     """
     if jacobian is None:
-        jacobian = jacobian(
+        jacobian = _compute_jacobian(
             y,
             xs,
             batched=batched,
             create_graph=create_graph,
             allow_unused=allow_unused,
+            vectorize=True,
+            mode=mode,
         )
     return trace(jacobian)
 
 
+def _sample_probes(x, num_probes, distribution):
+    """Samples random probe vectors with zero mean and identity covariance
+
+    :param x: tensor whose size, dtype, and device the probes should match
+    :param num_probes: number of probe vectors
+    :param distribution: either "rademacher" or "gaussian"
+    :returns: a tensor of size (num_probes, *x.size())
+    """
+    size = (num_probes, *x.size())
+    if distribution == "rademacher":
+        return (
+            2 * torch.randint(0, 2, size, dtype=x.dtype, device=x.device) - 1
+        )
+    elif distribution == "gaussian":
+        return torch.randn(size, dtype=x.dtype, device=x.device)
+    else:
+        raise ValueError(f"Probe distribution {distribution} not recognized!")
+
+
+def estimate_divergence(
+    y,
+    xs,
+    num_probes=1,
+    distribution="rademacher",
+    batched=False,
+    create_graph=False,
+    allow_unused=False,
+):
+    """Computes an unbiased estimate of the divergence of y with respect to xs
+    using Hutchinson's trace estimator: tr(J) = E[z^T J z]. Each probe requires
+    a single vector-jacobian product, regardless of the size of xs
+
+    :param y: output of some tensor function. Must have the same size as xs
+    :param xs: input to some tensor function
+    :param num_probes: number of random probes to average over
+    :param distribution: distribution of the probes, "rademacher" (lower
+        variance) or "gaussian". Defaults to "rademacher"
+    :param batched: whether the first dimension of y and xs is actually a
+        batch dimension (i.e. the function was applied to an entire batch)
+    :param create_graph: whether the resulting estimate should be
+        differentiable
+    :param allow_unused: whether terms in xs are allowed to not contribute to
+        any of y
+    :returns: divergence tensor. Size (1,) or (out.size()[0], 1)
+    """
+    probes = _sample_probes(xs, num_probes, distribution)
+    estimate = 0
+    for probe in probes:
+        vjp = autograd.grad(
+            y,
+            xs,
+            grad_outputs=probe.view(y.size()),
+            retain_graph=True,
+            create_graph=create_graph,
+            allow_unused=allow_unused,
+        )[0]
+        if vjp is None:
+            # y doesn't depend on xs, so the divergence is zero
+            vjp = probe.new_zeros(probe.size())
+        if batched:
+            estimate = estimate + torch.sum(
+                (vjp * probe).view(probe.size()[0], -1), dim=-1
+            )
+        else:
+            estimate = estimate + torch.sum(vjp * probe)
+    return estimate / num_probes
+
+
+def _laplacian_from_jacobian(jac, x, batched, create_graph):
+    """Computes the laplacian from a differentiable jacobian by computing only
+    the diagonal of the hessian. Each second derivative d^2(y_o)/dx_i^2 is a
+    single backward pass of jac[o, i], seeded by e_i, of which only the i-th
+    entry is kept. This needs as many backward passes as the full hessian, but
+    never stores more than one gradient of x at a time
+
+    :param jac: jacobian of some output with respect to x. Must have been
+        computed with create_graph=True
+    :param x: input to some tensor function
+    :param batched: whether the first dimension of jac and x is actually a
+        batch dimension (i.e. the function was applied to an entire batch)
+    :param create_graph: whether the resulting laplacian should be
+        differentiable
+    :returns: laplacian of size jac.size()[:-x.dim()] (or
+        jac.size()[:-x.dim() + 1] if batched)
+    """
+    if batched:
+        batchsize = _get_size(x)[0]
+        insize = _get_size(x)[1:]
+        flat_jac = jac.reshape(batchsize, -1, insize.numel())
+    else:
+        insize = _get_size(x)
+        flat_jac = jac.reshape(-1, insize.numel())
+    # size of the output (including the batch dimension)
+    outsize = _get_size(jac)[: len(_get_size(jac)) - len(insize)]
+    num_inputs = insize.numel()
+    num_outputs = flat_jac.size()[-2]
+
+    if not flat_jac.requires_grad:
+        # the jacobian is constant, so the laplacian is zero
+        return jac.new_zeros(outsize)
+
+    laps = list()
+    for o in range(num_outputs):
+        lap = None
+        for i in range(num_inputs):
+            # Summing along the batch is safe, since the samples are
+            # independent
+            grad = autograd.grad(
+                torch.sum(flat_jac[..., o, i]),
+                x,
+                retain_graph=True,
+                create_graph=create_graph,
+                allow_unused=True,
+            )[0]
+            if grad is None:
+                continue
+            if batched:
+                second_derivative = grad.reshape(batchsize, num_inputs)[:, i]
+            else:
+                second_derivative = grad.reshape(num_inputs)[i]
+            lap = second_derivative if lap is None else lap + second_derivative
+        if lap is None:
+            lap = flat_jac.new_zeros(flat_jac.size()[:-2])
+        laps.append(lap)
+    return torch.stack(laps, dim=-1).reshape(outsize)
+
+
 def jacobian_and_laplacian(
-    y, xs, batched=False, create_graph=False, allow_unused=False
+    y,
+    xs,
+    batched=False,
+    create_graph=False,
+    allow_unused=False,
+    mode="reverse",
+    method="diagonal",
 ):
-    """This currently computes the laplacian by using the entire hessian. There
-    may be a more efficient way to do this
+    """Computes the jacobian and the laplacian of y with respect to xs
 
     :param y: output of some tensor function
     :param xs: input to some tensor function
     :param batched: whether the first dimension of y and xs is actually a
         batch dimension (i.e. the function was applied to an entire batch)
     :param create_graph: whether the resulting hessian should be differentiable
+    :param mode: method for computing the jacobians. See jacobian()
+    :param method: method for computing the laplacian. Should be one of
+        "diagonal" - compute only the diagonal of the hessian, keeping a
+            single entry of each backward pass
+        "hessian" - compute the entire hessian and take its trace
+        Defaults to "diagonal"
     :returns jacobian, laplacian
     """
-    jac, hes = jacobian_and_hessian(
+    if method == "hessian":
+        jac, hes = jacobian_and_hessian(
+            y,
+            xs,
+            batched=batched,
+            create_graph=create_graph,
+            allow_unused=allow_unused,
+            mode=mode,
+        )
+        lap = trace(hes)
+    elif method == "diagonal":
+        jac = jacobian(
+            y,
+            xs,
+            batched=batched,
+            create_graph=True,
+            allow_unused=allow_unused,
+            mode=mode,
+        )
+        if isinstance(jac, list):
+            lap = [
+                _laplacian_from_jacobian(
+                    jac_i, x, batched=batched, create_graph=create_graph
+                )
+                for jac_i, x in zip(jac, xs)
+            ]
+        else:
+            lap = _laplacian_from_jacobian(
+                jac, xs, batched=batched, create_graph=create_graph
+            )
+    else:
+        raise ValueError(f"Laplacian method {method} not recognized!")
+    return jac, lap
+
+
+def _estimated_laplacian_from_jacobian(
+    jac, x, num_probes, distribution, batched, create_graph
+):
+    """Estimates the laplacian from a differentiable jacobian with Hutchinson's
+    estimator. See jacobian_and_estimated_laplacian()
+
+    :param jac: jacobian of some output with respect to x. Must have been
+        computed with create_graph=True
+    :param x: input to some tensor function
+    :param num_probes: number of random probes to average over
+    :param distribution: distribution of the probes
+    :param batched: whether the first dimension of jac and x is actually a
+        batch dimension (i.e. the function was applied to an entire batch)
+    :param create_graph: whether the resulting laplacian should be
+        differentiable
+    :returns: laplacian estimate
+    """
+    probes = _sample_probes(x, num_probes, distribution)
+    # number of dimensions of the jacobian belonging to the inputs
+    in_dims = len(_get_size(x)) - 1 if batched else len(_get_size(x))
+    flat_jac = jac.reshape(*jac.size()[: jac.dim() - in_dims], -1)
+    estimate = 0
+    for probe in probes:
+        if batched:
+            # broadcast the probe over the outputs
+            flat_probe = probe.view(
+                probe.size()[0], *[1] * (flat_jac.dim() - 2), -1
+            )
+        else:
+            flat_probe = probe.view(-1)
+        # directional derivative z^T grad(u) ...
+        directional = torch.sum(flat_jac * flat_probe, dim=-1)
+        # ... differentiated again in the same direction
+        estimate = estimate + jvp(
+            directional, x, probe, create_graph=create_graph, allow_unused=True
+        )
+    return estimate / num_probes
+
+
+def jacobian_and_estimated_laplacian(
+    y,
+    xs,
+    num_probes=1,
+    distribution="rademacher",
+    batched=False,
+    create_graph=False,
+    allow_unused=False,
+    mode="reverse",
+):
+    """Computes the jacobian and an unbiased estimate of the laplacian of y with
+    respect to xs using Hutchinson's trace estimator on the hessian:
+    tr(H) = E[z^T H z]. Each probe requires a single jacobian-vector product
+    of the jacobian, regardless of the size of xs
+
+    :param y: output of some tensor function
+    :param xs: input to some tensor function
+    :param num_probes: number of random probes to average over
+    :param distribution: distribution of the probes, "rademacher" (lower
+        variance) or "gaussian". Defaults to "rademacher"
+    :param batched: whether the first dimension of y and xs is actually a
+        batch dimension (i.e. the function was applied to an entire batch)
+    :param create_graph: whether the resulting laplacian should be
+        differentiable
+    :param allow_unused: whether terms in xs are allowed to not contribute to
+        any of y
+    :param mode: method for computing the jacobian. See jacobian()
+    :returns jacobian, laplacian estimate
+    """
+    jac = jacobian(
         y,
         xs,
         batched=batched,
-        create_graph=create_graph,
+        create_graph=True,
         allow_unused=allow_unused,
+        mode=mode,
+    )
+    lap = _estimated_laplacian_from_jacobian(
+        jac,
+        xs,
+        num_probes=num_probes,
+        distribution=distribution,
+        batched=batched,
+        create_graph=create_graph,
     )
-    lap = trace(hes)
     return jac, lap
+
+
+def finite_difference_jacobian_and_laplacian(
+    fn, x, args=(), step=1e-2, order=2
+):
+    """Computes the value, jacobian, and laplacian of a batched function with
+    respect to its (batched) input with central finite differences. All
+    perturbed inputs are evaluated in a single call to fn, so this requires no
+    derivative graphs with respect to x at all. The results remain
+    differentiable with respect to anything else fn depends on (e.g. the
+    parameters of a model)
+
+    :param fn: function which maps a batch of inputs (and the args) to a batch
+        of outputs. Each batch element must be computed independently
+    :param x: batched input to the function. Size (batchsize, *insize)
+    :param args: optional list of additional batched inputs to fn, which are
+        not differentiated
+    :param step: step size of the finite differences. Since the laplacian is
+        divided by step^2, this should not be too small for single precision.
+        Defaults to 1e-2
+    :param order: order of accuracy of the central difference stencil. Should
+        be 2 or 4. Defaults to 2
+    :returns value, jacobian, laplacian of sizes (batchsize, *outsize),
+        (batchsize, *outsize, *insize), (batchsize, *outsize)
+    """
+    if order not in _FINITE_DIFFERENCE_STENCILS:
+        raise ValueError(f"Finite difference order {order} not supported!")
+    stencil = _FINITE_DIFFERENCE_STENCILS[order]
+    offsets, first_weights, second_weights, center_weight = stencil
+    offsets = x.new_tensor(offsets)
+    first_weights = x.new_tensor(first_weights)
+    second_weights = x.new_tensor(second_weights)
+
+    batchsize = x.size()[0]
+    insize = x.size()[1:]
+    num_inputs = insize.numel()
+    flat_x = x.detach().reshape(batchsize, num_inputs)
+
+    # perturbed inputs are indexed by (offset, input direction, batch element)
+    directions = torch.eye(num_inputs, dtype=x.dtype, device=x.device)
+    perturbed_x = flat_x.view(1, 1, batchsize, num_inputs) + step * (
+        offsets.view(-1, 1, 1, 1) * directions.view(1, num_inputs, 1, -1)
+    )
+    all_x = torch.cat([flat_x, perturbed_x.reshape(-1, num_inputs)], dim=0)
+    num_evaluations = 1 + len(offsets) * num_inputs
+    all_args = [
+        arg.repeat(num_evaluations, *[1] * (arg.dim() - 1)) for arg in args
+    ]
+    all_outputs = fn(all_x.view(-1, *insize), *all_args)
+
+    outsize = all_outputs.size()[1:]
+    value = all_outputs[:batchsize]
+    perturbed_outputs = all_outputs[batchsize:].reshape(
+        len(offsets), num_inputs, batchsize, -1
+    )
+    jac = torch.einsum("k,kibo->boi", first_weights, perturbed_outputs) / step
+    lap = (
+        torch.einsum("k,kibo->bo", second_weights, perturbed_outputs)
+        + center_weight * num_inputs * value.reshape(batchsize, -1)
+    ) / (step * step)
+    return (
+        value,
+        jac.reshape(batchsize, *outsize, *insize),
+        lap.reshape(batchsize, *outsize),
+    )
+
+
+class DerivativeContext(object):
+    """Caches the derivatives of outputs with respect to inputs so that any
+    number of functions (e.g. several PDE residuals) evaluated on the same batch
+    share a single derivative computation. A new context should be created for
+    every batch. All derivatives are differentiable (create_graph=True)
+
+    Derivatives are keyed on the identities of the output and input tensors.
+    The context holds references to these tensors, so the keys remain valid for
+    the lifetime of the context
+    """
+
+    def __init__(self, mode="reverse", method="diagonal"):
+        """
+        :param mode: method for computing the jacobians. See jacobian()
+        :param method: method for computing exact laplacians. See
+            jacobian_and_laplacian()
+        """
+        self.mode = mode
+        self.method = method
+        self._cache = dict()
+
+    def _lookup(self, kind, outputs, inputs):
+        entry = self._cache.get((kind, id(outputs), id(inputs)))
+        return None if entry is None else entry[-1]
+
+    def _store(self, kind, outputs, inputs, value):
+        self._cache[(kind, id(outputs), id(inputs))] = (outputs, inputs, value)
+        return value
+
+    def set_derivatives(self, outputs, inputs, jacobian=None, laplacian=None):
+        """Stores externally computed derivatives (e.g. from a Taylor-mode or
+        finite-difference pass of the model) of outputs with respect to inputs
+
+        :param outputs: output of some tensor function
+        :param inputs: input to some tensor function
+        :param jacobian: optional jacobian of outputs with respect to inputs
+        :param laplacian: optional laplacian of outputs with respect to inputs
+        """
+        if jacobian is not None:
+            self._store("jacobian", outputs, inputs, jacobian)
+        if laplacian is not None:
+            self._store("laplacian", outputs, inputs, laplacian)
+
+    def has_laplacian(self, outputs, inputs):
+        """Whether the exact laplacian of outputs w.r.t. inputs is available"""
+        return self._lookup("laplacian", outputs, inputs) is not None
+
+    def jacobian(self, outputs, inputs, batched=True):
+        """Retrieves or computes the jacobian of outputs w.r.t. inputs
+
+        :param outputs: output of some tensor function
+        :param inputs: input to some tensor function
+        :param batched: whether the first dimension of outputs and inputs is
+            actually a batch dimension
+        :returns: jacobian. See jacobian()
+        """
+        jac = self._lookup("jacobian", outputs, inputs)
+        if jac is None:
+            jac = self._store(
+                "jacobian",
+                outputs,
+                inputs,
+                _compute_jacobian(
+                    outputs,
+                    inputs,
+                    batched=batched,
+                    create_graph=True,
+                    allow_unused=False,
+                    vectorize=True,
+                    mode=self.mode,
+                ),
+            )
+        return jac
+
+    def laplacian(
+        self,
+        outputs,
+        inputs,
+        batched=True,
+        num_probes=None,
+        distribution="rademacher",
+    ):
+        """Retrieves or computes the laplacian of outputs w.r.t. inputs. An
+        exact laplacian is always returned if one is available, even if an
+        estimate was requested
+
+        :param outputs: output of some tensor function
+        :param inputs: input to some tensor function
+        :param batched: whether the first dimension of outputs and inputs is
+            actually a batch dimension
+        :param num_probes: if provided, the laplacian is estimated with this
+            many random probes (Hutchinson's estimator) instead
+        :param distribution: distribution of the random probes. See
+            jacobian_and_estimated_laplacian()
+        :returns: laplacian. See jacobian_and_laplacian()
+        """
+        lap = self._lookup("laplacian", outputs, inputs)
+        if lap is not None:
+            return lap
+
+        if num_probes is not None:
+            kind = f"laplacian estimate ({num_probes}, {distribution})"
+            lap = self._lookup(kind, outputs, inputs)
+            if lap is None:
+                lap = self._store(
+                    kind,
+                    outputs,
+                    inputs,
+                    _estimated_laplacian_from_jacobian(
+                        self.jacobian(outputs, inputs, batched=batched),
+                        inputs,
+                        num_probes=num_probes,
+                        distribution=distribution,
+                        batched=batched,
+                        create_graph=True,
+                    ),
+                )
+        elif self.method == "diagonal":
+            lap = self._store(
+                "laplacian",
+                outputs,
+                inputs,
+                _laplacian_from_jacobian(
+                    self.jacobian(outputs, inputs, batched=batched),
+                    inputs,
+                    batched=batched,
+                    create_graph=True,
+                ),
+            )
+        else:
+            jac, lap = jacobian_and_laplacian(
+                outputs,
+                inputs,
+                batched=batched,
+                create_graph=True,
+                mode=self.mode,
+                method=self.method,
+            )
+            self.set_derivatives(outputs, inputs, jacobian=jac, laplacian=lap)
+        return lap
+
+    def jvp(self, outputs, inputs, tangent, batched=True):
+        """Computes the jacobian-vector product of outputs w.r.t. inputs in the
+        direction of tangent. This contracts the jacobian if it is already
+        available and otherwise uses a single forward-mode pass, without
+        materializing the jacobian. See jvp()
+
+        :param outputs: output of some tensor function
+        :param inputs: input to some tensor function
+        :param tangent: tensor of the same size as inputs
+        :param batched: whether the first dimension of outputs and inputs is
+            actually a batch dimension
+        :returns: tensor of the same size as outputs
+        """
+        jac = self._lookup("jacobian", outputs, inputs)
+        if jac is None:
+            return jvp(outputs, inputs, tangent, create_graph=True)
+        if batched:
+            return torch.einsum(
+                "bjk,bk->bj",
+                jac.reshape(outputs.size()[0], outputs[0].numel(), -1),
+                tangent.reshape(tangent.size()[0], -1),
+            ).view(outputs.size())
+        return (
+            jac.reshape(outputs.numel(), -1) @ tangent.reshape(-1)
+        ).view(outputs.size())
+
+    def divergence(self, outputs, inputs, batched=True):
+        """Computes the divergence of outputs w.r.t. inputs from the (possibly
+        cached) jacobian
+
+        :param outputs: output of some tensor function
+        :param inputs: input to some tensor function
+        :param batched: whether the first dimension of outputs and inputs is
+            actually a batch dimension
+        :returns: divergence. See divergence()
+        """
+        return trace(self.jacobian(outputs, inputs, batched=batched))
@@ -1,2 +1,7 @@
 from .loss_constraining import *
 
+from .parameter_selection import *
+
+from .per_sample import *
+
+from .projected_optimizer import *
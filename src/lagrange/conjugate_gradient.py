@@ -0,0 +1,222 @@
+"""Functions for computing the optimal Lagrange multipliers with a matrix-free
+conjugate gradient solve, which never stores the constraint jacobian"""
+
+from enum import Enum
+import torch
+from torch import autograd
+
+try:
+    from time import perf_counter
+except ImportError:
+    from time import time as perf_counter
+
+
+class Timing_Events(Enum):
+    """A set of Sub-Batch events"""
+
+    COMPUTE_PRE_MULTIPLIERS = "multipliers: compute pre-multipliers"
+    CONJUGATE_GRADIENT = "multipliers: conjugate gradient"
+    ITERATIONS = "multipliers: conjugate gradient iterations"
+    RESIDUAL = "multipliers: conjugate gradient relative residual"
+    ERRORED = "multipliers: errored"
+
+
+def _zeros_if_none(grads, like):
+    return [
+        torch.zeros_like(ref) if grad is None else grad
+        for grad, ref in zip(grads, like)
+    ]
+
+
+def _constraint_products(flat_constraints, parameters, allow_unused):
+    """Builds functions which compute jacobian-vector and vector-jacobian
+    products of the constraints with respect to the parameters without ever
+    computing the jacobian
+
+    :param flat_constraints: a vector of constraints
+    :param parameters: a list of the parameters
+    :param allow_unused: whether some parameter may not affect the constraints
+    :returns: jvp, vjp, where jvp maps a list of tensors of the sizes of the
+        parameters to a tensor of the size of the constraints, and vjp maps
+        the other way around
+    """
+    # The vector-jacobian product J(g)^T w is linear in the dummy w, so
+    # differentiating it with respect to w in the direction u gives J(g) u
+    dummy = torch.zeros_like(flat_constraints, requires_grad=True)
+    dummy_vjps = autograd.grad(
+        flat_constraints,
+        parameters,
+        grad_outputs=dummy,
+        retain_graph=True,
+        create_graph=True,
+        allow_unused=allow_unused,
+    )
+    used = [i for i, vjp in enumerate(dummy_vjps) if vjp is not None]
+
+    def constraint_jvp(vectors):
+        if len(used) == 0:
+            return torch.zeros_like(dummy)
+        product = autograd.grad(
+            [dummy_vjps[i] for i in used],
+            dummy,
+            grad_outputs=[vectors[i] for i in used],
+            retain_graph=True,
+            allow_unused=True,
+        )[0]
+        return torch.zeros_like(dummy) if product is None else product
+
+    def constraint_vjp(vector):
+        return _zeros_if_none(
+            autograd.grad(
+                flat_constraints,
+                parameters,
+                grad_outputs=vector,
+                retain_graph=True,
+                allow_unused=allow_unused,
+            ),
+            parameters,
+        )
+
+    return constraint_jvp, constraint_vjp
+
+
+def _loss_gradient(loss, parameters, allow_unused):
+    """Computes the gradient of a scalar loss with respect to the parameters"""
+    return _zeros_if_none(
+        autograd.grad(
+            loss.view(-1)[0],
+            parameters,
+            retain_graph=True,
+            allow_unused=allow_unused,
+        ),
+        parameters,
+    )
+
+
+def compute_cg_multipliers(
+    loss,
+    constraints,
+    parameters,
+    return_timing=False,
+    allow_unused=False,
+    warn=True,
+    tolerance=1e-5,
+    max_iterations=None,
+    initial_multipliers=None,
+):
+    """Computes the optimal Lagrange multipliers by solving
+    J(g) J(g)^T multipliers = g - J(g) J(f)^T with conjugate gradient. Each
+    iteration applies J(g) J(g)^T with one vector-jacobian product and one
+    jacobian-vector product, so neither the jacobian nor the gram matrix is
+    ever stored
+
+    Since the vector-jacobian products sum over any batch, the loss must be a
+    single scalar (e.g. the "batchwise" or "reduction" methods of
+    constrain_loss). The multipliers are not differentiable
+
+    :param loss: tensor corresponding to the evaluated loss. Must have exactly
+        one element
+    :param constraints: a single tensor corresponding to the evaluated
+        constraints (you may need to torch.stack() first)
+    :param parameters: an iterable of the parameters to optimize
+    :param return_timing: whether to also return the timing data
+    :param allow_unused: whether to allow some parameter to not be an input of
+        the loss or constraints function. Defaults to False
+    :param warn: whether to warn if conjugate gradient does not converge. If
+        set to "error", then will throw a RuntimeError if this occurs
+    :param tolerance: relative residual at which to stop iterating
+    :param max_iterations: maximum number of iterations. Defaults to twice the
+        number of constraints (in exact arithmetic, conjugate gradient
+        converges within the number of constraints)
+    :param initial_multipliers: optional initial guess, e.g. the multipliers of
+        the previous step. Must have the same size as the constraints
+    :returns: multipliers (, timing), if the timing is also requested.
+        Multipliers will have the same shape as the constraints
+    :throws: ValueError if the loss has more than one element
+    """
+    if loss.numel() != 1:
+        raise ValueError(
+            "Conjugate gradient multipliers require a scalar loss. Try the"
+            " batchwise or reduction methods"
+        )
+
+    timing = dict()
+
+    def record_timing(start_time, event):
+        end_time = perf_counter()
+        timing[event.value] = end_time - start_time
+        return end_time
+
+    start_time = perf_counter()
+
+    parameters = list(parameters)
+    flat_constraints = constraints.view(-1)
+    if max_iterations is None:
+        max_iterations = 2 * flat_constraints.numel()
+
+    constraint_jvp, constraint_vjp = _constraint_products(
+        flat_constraints, parameters, allow_unused
+    )
+
+    def operator(vector):
+        return constraint_jvp(constraint_vjp(vector))
+
+    loss_grads = _loss_gradient(loss, parameters, allow_unused)
+    rhs = flat_constraints.detach() - constraint_jvp(loss_grads)
+    start_time = record_timing(
+        start_time, Timing_Events.COMPUTE_PRE_MULTIPLIERS
+    )
+
+    if initial_multipliers is None:
+        multipliers = torch.zeros_like(rhs)
+        residual = rhs
+    else:
+        multipliers = initial_multipliers.detach().view(-1).clone()
+        residual = rhs - operator(multipliers)
+    direction = residual
+    residual_norm_sq = torch.dot(residual, residual)
+    rhs_norm = torch.norm(rhs)
+
+    iterations = 0
+    while (
+        iterations < max_iterations
+        and torch.sqrt(residual_norm_sq) > tolerance * rhs_norm
+    ):
+        operator_direction = operator(direction)
+        curvature = torch.dot(direction, operator_direction)
+        if curvature <= 0:
+            # The gram matrix is singular along this direction
+            break
+        step = residual_norm_sq / curvature
+        multipliers = multipliers + step * direction
+        residual = residual - step * operator_direction
+        new_residual_norm_sq = torch.dot(residual, residual)
+        direction = residual + (new_residual_norm_sq / residual_norm_sq) * (
+            direction
+        )
+        residual_norm_sq = new_residual_norm_sq
+        iterations += 1
+
+    start_time = record_timing(start_time, Timing_Events.CONJUGATE_GRADIENT)
+    relative_residual = float(
+        torch.sqrt(residual_norm_sq) / torch.clamp(rhs_norm, min=1e-30)
+    )
+    timing[Timing_Events.ITERATIONS.value] = iterations
+    timing[Timing_Events.RESIDUAL.value] = relative_residual
+    timing[Timing_Events.ERRORED.value] = relative_residual > tolerance
+
+    if relative_residual > tolerance and warn:
+        message = (
+            f"Conjugate gradient did not converge after {iterations}"
+            f" iterations (relative residual {relative_residual}). Constraints"
+            " are likely ill-conditioned!"
+        )
+        if warn == "error":
+            raise RuntimeError(message)
+        print(message)
+
+    multipliers = multipliers.detach().view(constraints.size())
+    if return_timing:
+        return multipliers, timing
+    else:
+        return multipliers
@@ -1,6 +1,7 @@
 """Functions for exactly computing the optimal Lagrange multipliers"""
 
 from enum import Enum
+import sys
 import torch
 
 try:
@@ -8,12 +9,28 @@ try:
 except ImportError:
     from time import time as perf_counter
 
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
 from src.derivatives import jacobian
+from src.lagrange.linalg import (
+    _closed_form_solve,
+    _condition_numbers,
+    _pseudoinverse_solve,
+    _pseudoinverse_tolerance,
+    _selected_solve,
+    _symmetric_eig,
+)
+from src.lagrange.structured import solve_structured_gram
 
 
 class Timing_Events(Enum):
     """A set of Sub-Batch events"""
 
+    COMPUTE_JACOBIANS = "multipliers: compute jacobians"
     COMPUTE_JF = "multipliers: compute loss jacobian"
     COMPUTE_JG = "multipliers: compute constraint jacobian"
     COMPUTE_GRAM = "multipliers: compute gram matrix"
@@ -22,6 +39,131 @@ class Timing_Events(Enum):
     CHOLESKY_SOLVE = "multipliers: choleksy solve"
     ERRORED = "multipliers: errored"
     LEAST_SQUARES = "multipliers: least squares"
+    PEAK_MEMORY = "multipliers: peak memory (bytes)"
+    STRUCTURED_SOLVE = "multipliers: structured solve"
+    BLOCK_RESIDUAL = "multipliers: relative block-diagonal residual"
+    LOW_RANK = "multipliers: low-rank structure"
+    BLOCK_DIAGONAL = "multipliers: block-diagonal structure"
+    BLOCK_PRECONDITIONED = "multipliers: block-preconditioned structure"
+    STRUCTURED_ITERATIONS = "multipliers: structured solve iterations"
+    KEPT_CONSTRAINTS = "multipliers: mean kept constraints per sample"
+    CLOSED_FORM_SOLVE = "multipliers: closed-form solve"
+
+
+def _reset_peak_memory(device):
+    """Resets the peak memory statistics of the device, if possible"""
+    if device.type == "cuda":
+        if hasattr(torch.cuda, "reset_peak_memory_stats"):
+            torch.cuda.reset_peak_memory_stats(device)
+        else:
+            torch.cuda.reset_max_memory_allocated(device)
+
+
+def _peak_memory(device):
+    """Returns the peak memory in bytes allocated on the device since the last
+    _reset_peak_memory(). For the CPU, this is the peak resident memory of the
+    whole process, which cannot be reset. Returns -999.0 if unavailable"""
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device)
+    elif resource is not None:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS, but in kilobytes on Linux
+        return max_rss if sys.platform == "darwin" else max_rss * 1024
+    else:
+        return -999.0
+
+
+def _parameter_jacobian(
+    y,
+    parameters,
+    allow_unused,
+    per_sample_gradients,
+    chunk_size=None,
+    max_memory=None,
+    create_graph=True,
+):
+    """Computes the (by default differentiable) jacobian of y with respect to
+    the flattened and concatenated parameters. Has size
+    (*y.size(), num_parameters)"""
+    jacs = None
+    if per_sample_gradients is not None:
+        jacs = per_sample_gradients.jacobian(
+            y, parameters, create_graph=create_graph
+        )
+    if jacs is None:
+        # Even though y is batched, the parameters are not, so we compute the
+        # jacobian in an unbatched way and reassemble
+        jacs = jacobian(
+            y,
+            parameters,
+            batched=False,
+            create_graph=create_graph,
+            allow_unused=allow_unused,
+            chunk_size=chunk_size,
+            max_memory=max_memory,
+        )
+    return torch.cat([jac.view(*y.size(), -1) for jac in jacs], dim=-1)
+
+
+def _loss_and_constraint_jacobians(
+    loss,
+    constraints,
+    parameters,
+    allow_unused,
+    per_sample_gradients,
+    per_sample_constraints=True,
+    chunk_size=None,
+    max_memory=None,
+    create_graph=True,
+):
+    """Computes the jacobians of the loss of size (batchsize,) and of the
+    constraints of size (batchsize, num_constraints). Without
+    per_sample_gradients, the loss and constraints share their graph, so they
+    are differentiated together in a single pass. Otherwise, the loss can
+    often use the per-sample gradients even if the constraints (e.g. through
+    input derivatives) can't, so they are kept separate
+
+    :returns: J(f)^T of size (batchsize, num_parameters), J(g) of size
+        (batchsize, num_constraints, num_parameters), and a dictionary with
+        the time spent on each of them, which is empty if they were computed
+        together
+    """
+    timing = dict()
+    if per_sample_gradients is None:
+        jacs = _parameter_jacobian(
+            torch.cat([loss.unsqueeze(-1), constraints], dim=-1),
+            parameters,
+            allow_unused,
+            None,
+            chunk_size=chunk_size,
+            max_memory=max_memory,
+            create_graph=create_graph,
+        )
+        return jacs[:, 0], jacs[:, 1:], timing
+
+    start_time = perf_counter()
+    jac_fT = _parameter_jacobian(
+        loss,
+        parameters,
+        allow_unused,
+        per_sample_gradients,
+        chunk_size=chunk_size,
+        max_memory=max_memory,
+        create_graph=create_graph,
+    )
+    end_time = perf_counter()
+    timing[Timing_Events.COMPUTE_JF.value] = end_time - start_time
+    jac_g = _parameter_jacobian(
+        constraints,
+        parameters,
+        allow_unused,
+        per_sample_gradients if per_sample_constraints else None,
+        chunk_size=chunk_size,
+        max_memory=max_memory,
+        create_graph=create_graph,
+    )
+    timing[Timing_Events.COMPUTE_JG.value] = perf_counter() - end_time
+    return jac_fT, jac_g, timing
 
 
 def compute_exact_multipliers(
@@ -31,6 +173,19 @@ def compute_exact_multipliers(
     return_timing=False,
     allow_unused=False,
     warn=True,
+    per_sample_gradients=None,
+    chunk_size=None,
+    max_memory=None,
+    linear_gram=False,
+    create_graph=True,
+    gram_solver="dense",
+    block_size=None,
+    dense_threshold=1000,
+    select_constraints=False,
+    selection_tolerance=1e-6,
+    closed_form=True,
+    per_sample_constraints=True,
+    reset_peak_memory=False,
 ):
     """Assumes that the constraints are well-conditioned and computes the
     optimal Lagrange multipliers
@@ -44,6 +199,61 @@ def compute_exact_multipliers(
         to "error", then will throw a RuntimeError if this occurs
     :param allow_used: whether to allow some parameter to not be an input of
         the loss or constraints function. Defaults to False
+    :param per_sample_gradients: an optional src.lagrange.PerSampleGradients
+        which recorded the forward pass of the model. If provided, the
+        jacobians are computed with it whenever the loss or constraints are
+        compatible, instead of with one backward pass per element
+    :param chunk_size: optional number of rows of the jacobians to compute at
+        a time. See src.derivatives.jacobian()
+    :param max_memory: optional approximate memory budget in bytes for each
+        chunk of the jacobians. See src.derivatives.jacobian()
+    :param linear_gram: whether to compute the gram matrix and J(g) J(f)^T
+        from the layer inputs and output gradients recorded by
+        per_sample_gradients, without materializing the jacobians. The cost
+        then scales with the square of the batch size rather than with the
+        number of parameters. Falls back to the jacobians if the loss or
+        constraints are not compatible. See PerSampleGradients.gram_matrix()
+    :param create_graph: whether the multipliers should be differentiable. If
+        False, the jacobians are computed without recording the graph of their
+        own derivatives, which saves considerable memory and time when the
+        multipliers are detached anyway (as in constrain_loss). Defaults to
+        True
+    :param gram_solver: how to solve the linear system of the gram matrix.
+        Should be one of
+        "dense" - Cholesky factorization of the full gram matrix
+        "structured" - exploit its block and low-rank structure, working
+            from J(g) without forming the gram matrix. See
+            src.lagrange.structured.solve_structured_gram()
+        "auto" - "structured" if the gram matrix has more than dense_threshold
+            rows, otherwise "dense"
+        Defaults to "dense"
+    :param block_size: number of consecutive constraints forming a diagonal
+        block of the gram matrix for the structured solver, e.g. the number of
+        constraints per sample for batchwise constraining
+    :param dense_threshold: largest gram matrix solved densely if
+        gram_solver="auto"
+    :param select_constraints: whether to only enforce a maximal
+        well-conditioned subset of the constraints, chosen by a pivoted
+        Cholesky factorization of the gram matrix (equivalently, pivoted QR of
+        J(g)^T). The multipliers of the other constraints are zero. Useful for
+        batchwise constraining, whose constraints are usually not linearly
+        independent. Takes precedence over gram_solver
+    :param selection_tolerance: relative size (compared to the largest
+        diagonal of the gram matrix) of the smallest accepted pivot
+    :param closed_form: whether to solve gram matrices of at most 3
+        constraints with their explicit inverses instead of Cholesky, which
+        avoids its overhead (e.g. for a single reduced constraint or a few
+        constraints per sample). Defaults to True
+    :param per_sample_constraints: whether the jacobian of the constraints may
+        also be computed with per_sample_gradients. Set False for constraints
+        which use derivatives of the model with respect to its inputs, so that
+        only the loss is attempted. Defaults to True
+    :param reset_peak_memory: whether to reset the peak memory statistics of
+        a CUDA device first, so that the reported peak memory is that of this
+        call above what was allocated when it started. This discards the peak
+        seen by any outer profiler. Otherwise, the reported peak memory is the
+        amount by which the call raised the previous peak of the device (or,
+        on the CPU, of the process). Defaults to False
     :returns: multipliers (, timing), if the timing is also requested. 
         Multipliers will have the same shape as the constraints
     :throws: RuntimeError if the jacobian of the constraints are not full rank
@@ -66,61 +276,156 @@ def compute_exact_multipliers(
     # Restructure the loss into the shape (batchsize, )
     loss = loss.view(batchsize)
 
+    if reset_peak_memory:
+        _reset_peak_memory(loss.device)
+    initial_peak_memory = _peak_memory(loss.device)
     start_time = perf_counter()
 
-    # Even though the loss is batched, the parameters are not, so we compute
-    # the jacobian in an unbatched way and reassemble
-    jac_fT = torch.cat(
-        [
-            jac.view(*loss.size(), -1)
-            for jac in jacobian(
-                loss,
-                parameters,
-                batched=False,
-                create_graph=True,
-                allow_unused=allow_unused,
-            )
-        ],
-        dim=-1,
-    )
-    start_time = record_timing(start_time, Timing_Events.COMPUTE_JF)
-    jac_g = torch.cat(
-        [
-            jac.view(*constraints.size(), -1)
-            for jac in jacobian(
-                constraints,
-                parameters,
-                batched=False,
-                create_graph=True,
-                allow_unused=allow_unused,
-            )
-        ],
-        dim=-1,
+    parameters = list(parameters)
+    structured = not select_constraints and (
+        gram_solver == "structured"
+        or (gram_solver == "auto" and constraints.size()[-1] > dense_threshold)
     )
-    start_time = record_timing(start_time, Timing_Events.COMPUTE_JG)
+    linear_gram_result = None
+    if (
+        linear_gram
+        and per_sample_gradients is not None
+        and per_sample_constraints
+    ):
+        linear_gram_result = per_sample_gradients.gram_matrix(
+            loss, constraints, parameters, create_graph=create_graph
+        )
+
+    if linear_gram_result is not None:
+        # The jacobians are never materialized
+        jac_g = None
+        gram_matrix, jac_g_jac_fT = linear_gram_result
+        timing[Timing_Events.COMPUTE_JACOBIANS.value] = -999.0
+        timing[Timing_Events.COMPUTE_JF.value] = -999.0
+        timing[Timing_Events.COMPUTE_JG.value] = -999.0
+        start_time = record_timing(start_time, Timing_Events.COMPUTE_GRAM)
+    else:
+        # Only the jacobians computed separately have their own timing
+        jac_fT, jac_g, jacobians_timing = _loss_and_constraint_jacobians(
+            loss,
+            constraints,
+            parameters,
+            allow_unused,
+            per_sample_gradients,
+            per_sample_constraints=per_sample_constraints,
+            chunk_size=chunk_size,
+            max_memory=max_memory,
+            create_graph=create_graph,
+        )
+        start_time = record_timing(
+            start_time, Timing_Events.COMPUTE_JACOBIANS
+        )
+        timing.update(jacobians_timing)
 
-    # Possibly batched version of J(g) * J(g)^T
-    gram_matrix = torch.einsum("...ij,...kj->...ik", jac_g, jac_g)
-    start_time = record_timing(start_time, Timing_Events.COMPUTE_GRAM)
+        if structured:
+            # The structured solver works from J(g) directly
+            gram_matrix = None
+            timing[Timing_Events.COMPUTE_GRAM.value] = -999.0
+        else:
+            # Possibly batched version of J(g) * J(g)^T
+            gram_matrix = torch.einsum("...ij,...kj->...ik", jac_g, jac_g)
+            start_time = record_timing(start_time, Timing_Events.COMPUTE_GRAM)
+        jac_g_jac_fT = torch.einsum("...ij,...j->...i", jac_g, jac_fT)
 
-    untransformed_multipliers = (
-        constraints - torch.einsum("...ij,...j->...i", jac_g, jac_fT)
-    ).unsqueeze(-1)
+    if not create_graph:
+        constraints = constraints.detach()
+    untransformed_multipliers = (constraints - jac_g_jac_fT).unsqueeze(-1)
     start_time = record_timing(
         start_time, Timing_Events.COMPUTE_PRE_MULTIPLIERS
     )
 
+    timing[Timing_Events.STRUCTURED_SOLVE.value] = -999.0
+    timing[Timing_Events.BLOCK_RESIDUAL.value] = -999.0
+    timing[Timing_Events.LOW_RANK.value] = -999.0
+    timing[Timing_Events.BLOCK_DIAGONAL.value] = -999.0
+    timing[Timing_Events.BLOCK_PRECONDITIONED.value] = -999.0
+    timing[Timing_Events.STRUCTURED_ITERATIONS.value] = -999.0
+    timing[Timing_Events.KEPT_CONSTRAINTS.value] = -999.0
+    timing[Timing_Events.CLOSED_FORM_SOLVE.value] = -999.0
+
     try:
-        # We do this this way because there is some chance we can provide this externally later
-        cholesky_L = torch.cholesky(gram_matrix)
-        start_time = record_timing(start_time, Timing_Events.CHOLESKY)
-        multipliers = torch.cholesky_solve(
-            untransformed_multipliers, cholesky_L
-        )
-        start_time = record_timing(start_time, Timing_Events.CHOLESKY_SOLVE)
-        timing[Timing_Events.ERRORED.value] = False
-        timing[Timing_Events.LEAST_SQUARES.value] = -999.0
+        if select_constraints:
+            # The pivoted factorization of the kept constraints replaces the
+            # Cholesky factorization
+            multipliers, kept = _selected_solve(
+                gram_matrix, untransformed_multipliers, selection_tolerance
+            )
+            start_time = record_timing(start_time, Timing_Events.CHOLESKY)
+            timing[Timing_Events.KEPT_CONSTRAINTS.value] = float(
+                torch.mean(kept.float())
+            )
+            timing[Timing_Events.CHOLESKY_SOLVE.value] = -999.0
+            timing[Timing_Events.ERRORED.value] = False
+            timing[Timing_Events.LEAST_SQUARES.value] = -999.0
+        elif structured:
+            multipliers, info = solve_structured_gram(
+                untransformed_multipliers,
+                jac_g=jac_g,
+                gram_matrix=gram_matrix,
+                block_size=block_size,
+            )
+            start_time = record_timing(
+                start_time, Timing_Events.STRUCTURED_SOLVE
+            )
+            # Averaged over the batches, these are the fraction of batches
+            # solved with each structure
+            timing[Timing_Events.LOW_RANK.value] = (
+                info["structure"] == "low-rank"
+            )
+            timing[Timing_Events.BLOCK_DIAGONAL.value] = (
+                info["structure"] == "block-diagonal"
+            )
+            timing[Timing_Events.BLOCK_PRECONDITIONED.value] = (
+                info["structure"] == "block-preconditioned"
+            )
+            timing[Timing_Events.BLOCK_RESIDUAL.value] = info["block_residual"]
+            timing[Timing_Events.STRUCTURED_ITERATIONS.value] = info[
+                "iterations"
+            ]
+            # The structured solve replaces the Cholesky factorization
+            timing[Timing_Events.CHOLESKY.value] = -999.0
+            timing[Timing_Events.CHOLESKY_SOLVE.value] = -999.0
+            timing[Timing_Events.ERRORED.value] = False
+            timing[Timing_Events.LEAST_SQUARES.value] = -999.0
+        elif closed_form and gram_matrix.size()[-1] <= 3:
+            multipliers = _closed_form_solve(
+                gram_matrix, untransformed_multipliers
+            )
+            start_time = record_timing(
+                start_time, Timing_Events.CLOSED_FORM_SOLVE
+            )
+            timing[Timing_Events.CHOLESKY.value] = -999.0
+            timing[Timing_Events.CHOLESKY_SOLVE.value] = -999.0
+            timing[Timing_Events.ERRORED.value] = False
+            timing[Timing_Events.LEAST_SQUARES.value] = -999.0
+        else:
+            # We do this this way because there is some chance we can provide this externally later
+            cholesky_L = torch.cholesky(gram_matrix)
+            start_time = record_timing(start_time, Timing_Events.CHOLESKY)
+            multipliers = torch.cholesky_solve(
+                untransformed_multipliers, cholesky_L
+            )
+            start_time = record_timing(
+                start_time, Timing_Events.CHOLESKY_SOLVE
+            )
+            timing[Timing_Events.ERRORED.value] = False
+            timing[Timing_Events.LEAST_SQUARES.value] = -999.0
     except RuntimeError as rte:
+        if warn == "error":
+            # Raised before any of the diagnostics are computed
+            print("Error occurred while computing constrained loss:")
+            print(rte)
+            raise rte
+        if gram_matrix is None:
+            gram_matrix = torch.einsum("...ij,...kj->...ik", jac_g, jac_g)
+        # A single batched eigendecomposition of the (small) gram matrices
+        # provides both the diagnostics and the pseudoinverse
+        eigenvalues, eigenvectors = _symmetric_eig(gram_matrix)
         if warn:
             print("Error occurred while computing constrained loss:")
             print(rte)
@@ -128,48 +433,39 @@ def compute_exact_multipliers(
                 "Constraints are likely ill-conditioned (i.e. jacobian is"
                 " not full rank at this point)! Investingating..."
             )
-            det_idx = torch.argmin(
-                torch.stack(
-                    [
-                        torch.abs(torch.det(gram_matrix[i]))
-                        for i in range(len(gram_matrix))
-                    ]
-                )
-            )
-            det = torch.det(gram_matrix[det_idx])
-            print(f"Minimum abs(det(gram_matrix)): {det}")
-            if torch.allclose(det, det.new_zeros(det.size())):
+            condition = _condition_numbers(eigenvalues)
+            cond_idx = torch.argmax(condition)
+            print(f"Maximum cond(gram_matrix): {condition[cond_idx]}")
+            tolerance = _pseudoinverse_tolerance(eigenvalues)[cond_idx]
+            if torch.any(torch.abs(eigenvalues[cond_idx]) <= tolerance):
                 print(
                     "Jacobian is indeed not full rank... Falling back to computing pseudoinverse"
                 )
             else:
                 print("Unknown reason for error. Printing complete diagnostics")
-                print(f"jac_g.size(): {jac_g.size()}")
-                print(
-                    f"Jacobian of smallest abs(det(gram_matrix)): {jac_g[det_idx]}"
-                )
+                if jac_g is not None:
+                    print(f"jac_g.size(): {jac_g.size()}")
+                    print(
+                        f"Jacobian of largest cond(gram_matrix): {jac_g[cond_idx]}"
+                    )
                 print(
-                    f"gram_matrix of smallest abs(det(gram_matrix)): {gram_matrix[det_idx]}"
+                    f"gram_matrix of largest cond(gram_matrix): {gram_matrix[cond_idx]}"
                 )
                 print("Falling back to computing pseudoinverse")
-
-            if warn == "error":
-                raise rte
-        multipliers = untransformed_multipliers.new_zeros(
-            untransformed_multipliers.size()
+        multipliers = _pseudoinverse_solve(
+            eigenvalues, eigenvectors, untransformed_multipliers
         )
-        # torch.lstsq is NOT yet batch-enabled. As such, we do the batching manually
-        for b in range(len(multipliers)):
-            # discard the QR decomposition
-            multipliers[b], __ = torch.lstsq(
-                untransformed_multipliers[b], gram_matrix[b]
-            )
         start_time = record_timing(start_time, Timing_Events.LEAST_SQUARES)
         timing[Timing_Events.ERRORED.value] = True
         timing[Timing_Events.CHOLESKY_SOLVE.value] = -999.0
         if Timing_Events.CHOLESKY.value not in timing:
             timing[Timing_Events.CHOLESKY.value] = -999.0
 
+    peak_memory = _peak_memory(loss.device)
+    timing[Timing_Events.PEAK_MEMORY.value] = (
+        -999.0 if peak_memory == -999.0 else peak_memory - initial_peak_memory
+    )
+
     if return_timing:
         return multipliers.view(original_constraints_size), timing
     else:
@@ -0,0 +1,218 @@
+"""Batched linear algebra helpers for solving the (possibly singular) gram
+matrices of the constraints"""
+
+import torch
+
+
+def _symmetric_eig(matrix):
+    """Batched eigendecomposition of symmetric matrices
+
+    :param matrix: tensor of size (batchsize, n, n)
+    :returns: eigenvalues (batchsize, n), eigenvectors (batchsize, n, n)
+    """
+    if hasattr(torch, "linalg") and hasattr(torch.linalg, "eigh"):
+        return torch.linalg.eigh(matrix)
+    elif matrix.dim() == 2:
+        return torch.symeig(matrix, eigenvectors=True)
+    else:
+        # Older versions of torch.symeig don't support batches
+        n = matrix.size()[-1]
+        decompositions = [
+            torch.symeig(single, eigenvectors=True)
+            for single in matrix.reshape(-1, n, n)
+        ]
+        eigenvalues = torch.stack([values for values, __ in decompositions])
+        eigenvectors = torch.stack([vectors for __, vectors in decompositions])
+        return (
+            eigenvalues.view(*matrix.size()[:-1]),
+            eigenvectors.view(matrix.size()),
+        )
+
+
+def _pseudoinverse_tolerance(eigenvalues):
+    """Eigenvalues at most this size are treated as zero. Has size
+    (batchsize, 1)"""
+    largest = torch.max(torch.abs(eigenvalues), dim=-1, keepdim=True)[0]
+    return largest * torch.finfo(eigenvalues.dtype).eps * eigenvalues.size()[-1]
+
+
+def _condition_numbers(eigenvalues):
+    """Condition numbers of the symmetric matrices with the given eigenvalues.
+    Has size (batchsize,) and is infinite for singular matrices"""
+    magnitudes = torch.abs(eigenvalues)
+    return torch.max(magnitudes, dim=-1)[0] / torch.min(magnitudes, dim=-1)[0]
+
+
+def _pseudoinverse_solve(eigenvalues, eigenvectors, rhs):
+    """Batched minimum-norm least squares solution of A x = rhs for symmetric
+    A = V diag(eigenvalues) V^T
+
+    :param eigenvalues: tensor of size (batchsize, n)
+    :param eigenvectors: tensor of size (batchsize, n, n)
+    :param rhs: tensor of size (batchsize, n, 1)
+    :returns: tensor of size (batchsize, n, 1)
+    """
+    nonzero = torch.abs(eigenvalues) > _pseudoinverse_tolerance(eigenvalues)
+    inverse_eigenvalues = torch.where(
+        nonzero, 1 / eigenvalues, torch.zeros_like(eigenvalues)
+    )
+    projected = torch.einsum("...ji,...jk->...ik", eigenvectors, rhs)
+    return torch.einsum(
+        "...ij,...j,...jk->...ik", eigenvectors, inverse_eigenvalues, projected
+    )
+
+
+def _pivoted_cholesky(matrix, tolerance):
+    """Greedy pivoted Cholesky factorization of a batch of symmetric positive
+    semi-definite matrices, which is equivalent to the pivoted QR
+    factorization of their square roots. At every step, the row with the
+    largest remaining diagonal is selected, until this falls below tolerance
+    times the largest diagonal. The selected rows are then a maximal
+    well-conditioned subset. The whole batch is pivoted at once without
+    waiting on the device, so the number of steps is always n
+
+    :param matrix: tensor of size (batchsize, n, n)
+    :param tolerance: relative size of the smallest accepted pivot
+    :returns: the row selected at every step of size (batchsize, n), 1 for
+        the accepted steps and 0 otherwise of size (batchsize, n) (the
+        accepted steps come first), and the Cholesky factor of size
+        (batchsize, n, n) whose columns are those of the steps. The rows of
+        the selected pivots form the lower-triangular Cholesky factor of
+        matrix[pivots][:, pivots]
+    """
+    batchsize, n, __ = matrix.size()
+    batch_index = torch.arange(batchsize, device=matrix.device)
+    rows = torch.arange(n, device=matrix.device)
+    remaining = torch.diagonal(matrix, dim1=-2, dim2=-1)
+    threshold = tolerance * torch.max(remaining.detach(), dim=-1)[0]
+    # 1 for rows which have not been selected yet, so that none is selected
+    # twice
+    available = torch.ones_like(remaining.detach())
+    # 1 while the sample accepts pivots. Once it stops, it never resumes
+    accepting = torch.ones_like(threshold)
+    columns = list()
+    pivots = list()
+    accepted = list()
+    for __ in range(n):
+        candidates = remaining.detach() * available - (1 - available)
+        pivot_value, pivot = torch.max(candidates, dim=-1)
+        accepting = (
+            accepting
+            * (pivot_value > threshold).to(accepting.dtype)
+            * (pivot_value > 0).to(accepting.dtype)
+        )
+        column = matrix[batch_index, :, pivot]
+        if len(columns) > 0:
+            factor = torch.stack(columns, dim=-1)
+            column = column - torch.einsum(
+                "...ij,...j->...i", factor, factor[batch_index, pivot]
+            )
+        # The columns of the rejected steps are zero, and never divide by a
+        # small pivot
+        denominator = accepting * remaining[batch_index, pivot] + (
+            1 - accepting
+        )
+        column = column * (accepting / torch.sqrt(denominator))[:, None]
+        remaining = remaining - column ** 2
+        available = available * (
+            1
+            - accepting[:, None]
+            * (rows == pivot[:, None]).to(available.dtype)
+        )
+        columns.append(column)
+        pivots.append(pivot)
+        accepted.append(accepting)
+    return (
+        torch.stack(pivots, dim=-1),
+        torch.stack(accepted, dim=-1),
+        torch.stack(columns, dim=-1),
+    )
+
+
+def _selected_solve(matrix, rhs, tolerance):
+    """Solves matrix x = rhs on a maximal well-conditioned subset of the rows
+    chosen by _pivoted_cholesky(). The other entries of x are zero
+
+    :param matrix: tensor of size (batchsize, n, n)
+    :param rhs: tensor of size (batchsize, n, 1)
+    :param tolerance: relative size of the smallest accepted pivot
+    :returns: tensor of size (batchsize, n, 1) and the number of rows kept of
+        every sample of size (batchsize,)
+    """
+    n = matrix.size()[-1]
+    pivots, accepted, factor = _pivoted_cholesky(matrix, tolerance)
+    # The rows of the pivots of the Cholesky factor, padded with the identity
+    # for the rejected steps, whose entries of the solution are then zero
+    selected_factor = torch.gather(
+        factor, 1, pivots[:, :, None].expand(-1, -1, n)
+    )
+    both_accepted = accepted[:, :, None] * accepted[:, None, :]
+    identity = torch.eye(n, dtype=matrix.dtype, device=matrix.device)
+    selected_factor = selected_factor * both_accepted + identity * (
+        1 - both_accepted
+    )
+    selected_rhs = torch.gather(rhs, 1, pivots[:, :, None]) * accepted[
+        :, :, None
+    ].to(rhs.dtype)
+    selected_solution = torch.cholesky_solve(selected_rhs, selected_factor)
+    # The rejected steps may repeat a pivot, but only add zeros
+    solution = torch.zeros_like(rhs).scatter_add(
+        1, pivots[:, :, None], selected_solution * accepted[:, :, None]
+    )
+    return solution, torch.sum(accepted, dim=-1).long()
+
+
+def _closed_form_solve(matrix, rhs):
+    """Batched solution of matrix x = rhs for symmetric positive definite
+    matrices of size at most 3, using the explicit inverse (the adjugate
+    divided by the determinant) rather than a Cholesky factorization
+
+    :param matrix: tensor of size (batchsize, n, n) with n <= 3
+    :param rhs: tensor of size (batchsize, n, 1)
+    :returns: tensor of size (batchsize, n, 1)
+    :throws: RuntimeError if any matrix is numerically singular, like
+        torch.cholesky
+    """
+    n = matrix.size()[-1]
+    m = matrix
+    if n == 1:
+        determinant = m[:, 0, 0]
+        adjugate = torch.ones_like(m)
+    elif n == 2:
+        determinant = m[:, 0, 0] * m[:, 1, 1] - m[:, 0, 1] * m[:, 1, 0]
+        adjugate = torch.stack(
+            [
+                torch.stack([m[:, 1, 1], -m[:, 0, 1]], dim=-1),
+                torch.stack([-m[:, 1, 0], m[:, 0, 0]], dim=-1),
+            ],
+            dim=-2,
+        )
+    elif n == 3:
+
+        def cofactor(i, j):
+            rows = [r for r in range(3) if r != i]
+            cols = [c for c in range(3) if c != j]
+            minor = (
+                m[:, rows[0], cols[0]] * m[:, rows[1], cols[1]]
+                - m[:, rows[0], cols[1]] * m[:, rows[1], cols[0]]
+            )
+            return minor if (i + j) % 2 == 0 else -minor
+
+        # The adjugate is the transpose of the matrix of cofactors
+        adjugate = torch.stack(
+            [
+                torch.stack([cofactor(j, i) for j in range(3)], dim=-1)
+                for i in range(3)
+            ],
+            dim=-2,
+        )
+        determinant = torch.sum(m[:, 0, :] * adjugate[:, :, 0], dim=-1)
+    else:
+        raise ValueError(f"Closed-form solve of size {n} not supported!")
+
+    # The determinant of a symmetric positive semi-definite matrix is at most
+    # the product of its diagonals, so smaller values are rounding errors
+    scale = torch.prod(torch.diagonal(m, dim1=-2, dim2=-1), dim=-1)
+    if torch.any(determinant <= torch.finfo(m.dtype).eps * n * scale):
+        raise RuntimeError("Matrix is singular to working precision")
+    return (adjugate @ rhs) / determinant.view(-1, 1, 1)
@@ -3,7 +3,11 @@
 import torch
 
 from src.lagrange.exact import compute_exact_multipliers
+from src.lagrange.parameter_selection import select_parameters
 from src.lagrange.approximate import compute_approximate_multipliers
+from src.lagrange.conjugate_gradient import compute_cg_multipliers
+from src.lagrange.sketching import compute_sketched_multipliers
+from src.lagrange.warm_start import compute_warm_started_multipliers
 
 __all__ = ["constrain_loss"]
 
@@ -17,6 +21,12 @@ def constrain_loss(
     return_multipliers=False,
     return_timing=False,
     warn=True,
+    per_sample_gradients=None,
+    chunk_size=None,
+    max_memory=None,
+    solver="exact",
+    solver_options=None,
+    parameter_selector=None,
 ):
     """Computes the lagrange multipliers according to some particular batching
     method with a possible reduction
@@ -28,7 +38,9 @@ def constrain_loss(
     :param batchwise: whether to treat all instances of the constraints across
         the batch as separate constraints. If set to True, will ignore the 
         "reduction" argument. WARNING: batchwise constraining is unstable 
-        because the constraints are usually not linearly independent!
+        because the constraints are usually not linearly independent! Pass
+        solver_options={"select_constraints": True} to only enforce a
+        well-conditioned subset of them
     :param reduction: a function which takes the constraints tensor of shape 
         (batch_size, num_constraints) and returns a reduced tensor of shape
         (num_constraints). Typically this is a constraint-wise "error" function.
@@ -37,12 +49,49 @@ def constrain_loss(
     :param return_timing: whether to also return the timing data
     :param warn: whether to warn if the constraints are ill-conditioned. If set
         to "error", then will throw a RuntimeError if this occurs
+    :param per_sample_gradients: an optional src.lagrange.PerSampleGradients
+        which recorded the forward pass of the model, used to compute the
+        jacobians of compatible losses and constraints in fewer backward passes
+    :param chunk_size: optional number of rows of the jacobians to compute at
+        a time to bound the peak memory. See src.derivatives.jacobian()
+    :param max_memory: optional approximate memory budget in bytes for each
+        chunk of the jacobians. See src.derivatives.jacobian()
+    :param solver: method for computing the multipliers. Should be one of
+        "exact" - materialize the jacobians and solve with Cholesky. The
+            jacobians are not differentiable unless solver_options contains
+            {"create_graph": True}. Large gram matrices (e.g. of batchwise
+            constraining) are solved by exploiting their structure. See
+            compute_exact_multipliers()
+        "conjugate-gradient" - matrix-free conjugate gradient solve. Requires
+            batchwise=True or a reduction. Ignores per_sample_gradients,
+            chunk_size and max_memory
+        "sketched" - approximate solve in a random sketch of the parameter
+            space. Ignores per_sample_gradients, chunk_size and max_memory
+        "warm-started" - correct the multipliers of the previous step, with
+            periodic exact recomputations. Requires batchwise=True or a
+            reduction and a Warm_Start_State as solver_options["state"].
+            Ignores per_sample_gradients, chunk_size and max_memory
+        Defaults to "exact"
+    :param solver_options: optional dictionary of additional arguments for the
+        solver, e.g. {"tolerance": 1e-6, "max_iterations": 100,
+        "initial_multipliers": previous_multipliers} for "conjugate-gradient"
+        or {"sketch_size": 100, "sketch": "gaussian"} for "sketched"
+        or {"state": Warm_Start_State()} for "warm-started"
+    :param parameter_selector: optional selector of the subset of the
+        parameters with respect to which the multipliers are computed. The
+        constrained loss still depends on all of the parameters, so the others
+        follow its gradient with the multipliers held fixed. Requires
+        parameters to be an nn.Module or an iterable of (name, parameter)
+        pairs. See select_parameters()
     :returns: constrained_loss (, multipliers) (, timing) depending on
         whether the multipliers and/or timing are also 
         requested. constrained_loss will be a tensor of shape (batch_size,) only
         if reduction=None and batchwise=False. Otherwise, it will have shape 
         (1,) 
     """
+    if parameter_selector is not None:
+        parameters = select_parameters(parameters, parameter_selector)
+
     if batchwise:
         reduced_loss = torch.mean(loss)
         reduced_constraints = constraints.view(1, -1)
@@ -53,14 +102,60 @@ def constrain_loss(
         reduced_loss = loss
         reduced_constraints = constraints
 
-    multipliers, timing = compute_exact_multipliers(
-        reduced_loss,
-        reduced_constraints,
-        parameters,
-        warn=warn,
-        allow_unused=True,
-        return_timing=True,
-    )
+    if solver_options is None:
+        solver_options = dict()
+    if solver == "exact":
+        # The multipliers are detached below, so their jacobians need not be
+        # differentiable unless explicitly requested
+        exact_options = {"create_graph": False, "gram_solver": "auto"}
+        if batchwise:
+            # Constraints of the same sample form the diagonal blocks
+            exact_options["block_size"] = constraints[0].numel()
+        exact_options.update(solver_options)
+        multipliers, timing = compute_exact_multipliers(
+            reduced_loss,
+            reduced_constraints,
+            parameters,
+            warn=warn,
+            allow_unused=True,
+            return_timing=True,
+            per_sample_gradients=per_sample_gradients,
+            chunk_size=chunk_size,
+            max_memory=max_memory,
+            **exact_options,
+        )
+    elif solver == "conjugate-gradient":
+        multipliers, timing = compute_cg_multipliers(
+            reduced_loss,
+            reduced_constraints,
+            parameters,
+            warn=warn,
+            allow_unused=True,
+            return_timing=True,
+            **solver_options,
+        )
+    elif solver == "sketched":
+        multipliers, timing = compute_sketched_multipliers(
+            reduced_loss,
+            reduced_constraints,
+            parameters,
+            warn=warn,
+            allow_unused=True,
+            return_timing=True,
+            **solver_options,
+        )
+    elif solver == "warm-started":
+        multipliers, timing = compute_warm_started_multipliers(
+            reduced_loss,
+            reduced_constraints,
+            parameters,
+            warn=warn,
+            allow_unused=True,
+            return_timing=True,
+            **solver_options,
+        )
+    else:
+        raise ValueError(f"Multiplier solver {solver} not recognized!")
 
     # We don't want to back-prop through the multipliers themselves
     multipliers = multipliers.detach()
@@ -0,0 +1,72 @@
+"""Selection of the subset of the parameters of a model with respect to which
+the constraints are enforced"""
+
+import torch.nn as nn
+
+__all__ = ["select_parameters"]
+
+
+def _matches(name, prefix):
+    return name == prefix or name.startswith(prefix + ".")
+
+
+def select_parameters(named_parameters, selector=None):
+    """Selects a subset of the parameters of a model. Enforcing the constraints
+    with respect to fewer parameters makes the jacobians cheaper, while the
+    loss may still train all of the parameters
+
+    :param named_parameters: an nn.Module or an iterable of (name, parameter)
+        pairs, e.g. model.named_parameters()
+    :param selector: which parameters to select. Should be one of
+        None - all of the parameters
+        a string or list of strings - the parameters whose names (or the names
+            of whose modules) match, e.g. "param_layer" or ["layer4", "layer5"]
+        a function of (name, parameter) which returns whether to select it
+        Defaults to None. Layers are selected by name rather than by position,
+        since the order in which the modules were registered need not be the
+        order in which they are called (e.g. the param_layer of
+        ParameterizedDense is registered after its last layer)
+    :returns: a list of the selected parameters
+    :throws: TypeError if named_parameters are not (name, parameter) pairs,
+        e.g. model.parameters(). ValueError if no parameter is selected
+    """
+    if isinstance(named_parameters, nn.Module):
+        named_parameters = named_parameters.named_parameters()
+    named_parameters = list(named_parameters)
+    for item in named_parameters:
+        # Unpacking a parameter would silently iterate over its first
+        # dimension instead
+        if not (
+            isinstance(item, tuple)
+            and len(item) == 2
+            and isinstance(item[0], str)
+        ):
+            raise TypeError(
+                f"Parameters must be selected from (name, parameter) pairs,"
+                f" e.g. model.named_parameters(), not {type(item).__name__}"
+            )
+    named_parameters = [
+        (name, param) for name, param in named_parameters if param.requires_grad
+    ]
+
+    if selector is None:
+        selected = named_parameters
+    elif isinstance(selector, (str, list, tuple)):
+        prefixes = [selector] if isinstance(selector, str) else selector
+        selected = [
+            (name, param)
+            for name, param in named_parameters
+            if any(_matches(name, prefix) for prefix in prefixes)
+        ]
+    elif callable(selector):
+        selected = [
+            (name, param)
+            for name, param in named_parameters
+            if selector(name, param)
+        ]
+    else:
+        raise ValueError(f"Parameter selector {selector} not recognized!")
+
+    if len(selected) == 0:
+        raise ValueError(f"Parameter selector {selector} selected nothing!")
+    return [param for __, param in selected]
@@ -0,0 +1,383 @@
+"""Per-sample parameter gradients of batched tensors for models built from
+nn.Linear layers"""
+
+import torch
+from torch import autograd
+import torch.nn as nn
+
+__all__ = ["PerSampleGradients"]
+
+
+class PerSampleGradients(object):
+    """Computes the jacobian of a batched tensor with respect to the parameters
+    of the nn.Linear layers of a model, assuming that every batch element of
+    the tensor only depends on the corresponding sample of the batch
+
+    Forward hooks record the inputs and outputs of the layers while recording.
+    The per-sample gradient of a weight is the outer product of the gradient of
+    the layer output with the layer input, so one backward pass per non-batch
+    element of the tensor suffices, rather than one per element
+
+    Only the primary forward pass should be recorded. If the hooked layers are
+    called again before the next start() (e.g. by the Taylor-mode or
+    finite-difference forwards of a constraint), tensors may depend on the
+    parameters through those calls and are rejected without any backward
+    passes
+
+    Usage:
+        per_sample_gradients = PerSampleGradients(model)
+        per_sample_gradients.start()
+        out = model(xb)
+        per_sample_gradients.stop()
+        jacs = per_sample_gradients.jacobian(loss_fn(out, yb), parameters)
+    """
+
+    def __init__(self, model, verify=True, num_verified=2):
+        """
+        :param model: an nn.Module whose nn.Linear layers should be hooked
+        :param verify: whether to check that the per-sample gradients account
+            for the whole gradient. This detects tensors which depend on
+            derivatives of the model with respect to its inputs computed by
+            autograd, or on the parameters through unhooked operations. Set
+            False only if the caller guarantees that no such tensors are
+            differentiated
+        :param num_verified: number of randomly chosen columns of every
+            differentiated tensor which are verified, each of which also
+            computes the gradients of the parameters in its backward pass.
+            Every column is eventually checked over repeated calls. Defaults
+            to 2
+        """
+        self.layers = [
+            module for module in model.modules() if isinstance(module, nn.Linear)
+        ]
+        self.verify = verify
+        self.num_verified = num_verified
+        self.recording = False
+        self.unrecorded_calls = 0
+        self._records = list()
+        self._handles = list()
+        self.register()
+
+    @staticmethod
+    def supports_model(model):
+        """Whether every parameter of the model belongs to an nn.Linear layer,
+        so that the per-sample gradients can cover all of them
+
+        :param model: an nn.Module
+        """
+        return all(
+            isinstance(module, nn.Linear)
+            for module in model.modules()
+            if len(list(module.parameters(recurse=False))) > 0
+        )
+
+    def register(self):
+        """Hooks the layers of the model, unless they are already hooked"""
+        if len(self._handles) == 0:
+            self._handles = [
+                layer.register_forward_hook(self._record)
+                for layer in self.layers
+            ]
+
+    def _record(self, layer, inputs, output):
+        if self.recording:
+            self._records.append((layer, inputs[0], output))
+        else:
+            self.unrecorded_calls += 1
+
+    def start(self):
+        """Discards any previous records and begins recording forward passes"""
+        self._records = list()
+        self.unrecorded_calls = 0
+        self.recording = True
+
+    def stop(self):
+        """Stops recording forward passes. Records are kept until start()"""
+        self.recording = False
+
+    def remove(self):
+        """Removes the hooks from the model. See register()"""
+        for handle in self._handles:
+            handle.remove()
+        self._handles = list()
+        self._records = list()
+        self.recording = False
+
+    def supports(self, y, parameters):
+        """Whether the per-sample jacobian of y with respect to the parameters
+        can be attempted. This is never the case if the hooked layers were
+        called since recording stopped. Note that jacobian() may still reject y
+
+        :param y: tensor of size (batchsize, ...)
+        :param parameters: an iterable of the parameters
+        """
+        owned = set(
+            id(param)
+            for layer in self.layers
+            for param in (layer.weight, layer.bias)
+            if param is not None
+        )
+        return (
+            self.unrecorded_calls == 0
+            and len(y.size()) > 0
+            and all(id(param) in owned for param in parameters)
+            and len(self._matching_records(y.size()[0])) > 0
+        )
+
+    def _matching_records(self, batchsize):
+        return [
+            record
+            for record in self._records
+            if len(record[1].size()) == 2 and record[1].size()[0] == batchsize
+        ]
+
+    def _output_gradients(self, y, parameters, create_graph, batchsize=None):
+        """Computes the gradients of the sum over the batch of every column of y
+        with respect to the recorded layer outputs. Since every batch element
+        of y only depends on the corresponding sample, these are the per-sample
+        gradients
+
+        :param y: tensor of size (batchsize, num_columns)
+        :param parameters: a list of the weights and biases of hooked layers
+        :param create_graph: set True for the gradients to be differentible
+        :param batchsize: batch size of the layer calls to differentiate with
+            respect to. Defaults to the size of the first dimension of y
+        :returns: records, gradients, where records are the (layer, input,
+            output) of each recorded call and gradients are tensors of size
+            (num_columns, batchsize, out_features) for each record, or None if
+            y depends on the parameters other than through the recorded layer
+            outputs (e.g. through derivatives of the model with respect to its
+            inputs). This is only verified for num_verified random columns,
+            and only if verify was set
+        """
+        if batchsize is None:
+            batchsize = y.size()[0]
+        records = self._matching_records(batchsize)
+        outputs = [output for __, __, output in records]
+        index = {id(param): i for i, param in enumerate(parameters)}
+
+        if self.verify:
+            verified = set(
+                torch.randperm(y.size()[-1])[: self.num_verified].tolist()
+            )
+        else:
+            verified = set()
+
+        columns = [list() for __ in records]
+        for k in range(y.size()[-1]):
+            verify = k in verified
+            grads = autograd.grad(
+                y[:, k].sum(),
+                outputs + parameters if verify else outputs,
+                retain_graph=True,
+                create_graph=create_graph,
+                allow_unused=True,
+            )
+            output_grads = grads[: len(outputs)]
+            for r, ((__, __, output), grad) in enumerate(
+                zip(records, output_grads)
+            ):
+                columns[r].append(
+                    torch.zeros_like(output) if grad is None else grad
+                )
+            if not verify:
+                continue
+
+            totals = [torch.zeros_like(param) for param in parameters]
+            for r, (layer, x, __) in enumerate(records):
+                grad = columns[r][-1]
+                if id(layer.weight) in index:
+                    i = index[id(layer.weight)]
+                    totals[i] = totals[i] + grad.t() @ x
+                if layer.bias is not None and id(layer.bias) in index:
+                    i = index[id(layer.bias)]
+                    totals[i] = totals[i] + torch.sum(grad, dim=0)
+
+            # The per-sample gradients must account for the whole gradient,
+            # otherwise the parameters are used outside of the recorded layers
+            param_grads = grads[len(outputs) :]
+            for total, param_grad in zip(totals, param_grads):
+                if param_grad is None:
+                    param_grad = torch.zeros_like(total)
+                if not torch.allclose(
+                    total, param_grad, rtol=1e-4, atol=1e-6
+                ):
+                    return None
+
+        return records, [torch.stack(column, dim=0) for column in columns]
+
+    def jacobian(self, y, parameters, create_graph=False):
+        """Computes the jacobian of y with respect to the parameters, treating
+        the first dimension of y as the batch dimension
+
+        :param y: tensor of size (batchsize, ...)
+        :param parameters: an iterable of the weights and biases of the hooked
+            layers
+        :param create_graph: set True for the resulting jacobian to be
+            differentible
+        :returns: a list of tensors of size (y.size() + parameters[i].size()),
+            or None if y is not supported or depends on the parameters other
+            than through the recorded layer outputs (e.g. through derivatives of
+            the model with respect to its inputs)
+        """
+        parameters = list(parameters)
+        if not self.supports(y, parameters):
+            return None
+
+        batchsize = y.size()[0]
+        flat_y = y.reshape(batchsize, -1)
+        result = self._output_gradients(flat_y, parameters, create_graph)
+        if result is None:
+            return None
+        records, gradients = result
+
+        index = {id(param): i for i, param in enumerate(parameters)}
+        jacs = [
+            y.new_zeros((flat_y.size()[-1], batchsize, *param.size()))
+            for param in parameters
+        ]
+        for (layer, x, __), grad in zip(records, gradients):
+            if id(layer.weight) in index:
+                i = index[id(layer.weight)]
+                jacs[i] = jacs[i] + torch.einsum("kbo,bi->kboi", grad, x)
+            if layer.bias is not None and id(layer.bias) in index:
+                i = index[id(layer.bias)]
+                jacs[i] = jacs[i] + grad
+
+        return [
+            jac.transpose(0, 1).reshape(*y.size(), *param.size())
+            for jac, param in zip(jacs, parameters)
+        ]
+
+    def _kernels(self, records, parameters, diagonal):
+        """Computes the inner products of the layer inputs of every pair of
+        recorded calls of each layer, (A A^T). The bias contributes an inner
+        product of 1
+
+        :param records: the recorded (layer, input, output) of each call
+        :param parameters: a list of the weights and biases of hooked layers
+        :param diagonal: whether to only compute the inner products between
+            inputs of the same batch element
+        :returns: a list of (record indices, kernel) for each layer, where the
+            kernel has size (calls, calls, batchsize) if diagonal and otherwise
+            (calls, batchsize, calls, batchsize)
+        """
+        owned = set(id(param) for param in parameters)
+        layers = list()
+        for r, (layer, __, __) in enumerate(records):
+            for layer_records in layers:
+                if records[layer_records[0]][0] is layer:
+                    layer_records.append(r)
+                    break
+            else:
+                layers.append([r])
+
+        kernels = list()
+        for layer_records in layers:
+            layer = records[layer_records[0]][0]
+            # (calls, batchsize, in_features)
+            inputs = torch.stack([records[r][1] for r in layer_records])
+            if diagonal:
+                kernel = inputs.new_zeros(
+                    (inputs.size()[0], inputs.size()[0], inputs.size()[1])
+                )
+                if id(layer.weight) in owned:
+                    kernel = kernel + torch.einsum(
+                        "cbi,dbi->cdb", inputs, inputs
+                    )
+            else:
+                kernel = inputs.new_zeros(
+                    (*inputs.size()[:2], *inputs.size()[:2])
+                )
+                if id(layer.weight) in owned:
+                    kernel = kernel + torch.einsum(
+                        "cbi,dei->cbde", inputs, inputs
+                    )
+            if layer.bias is not None and id(layer.bias) in owned:
+                kernel = kernel + 1
+            kernels.append((layer_records, kernel))
+        return kernels
+
+    def gram_matrix(self, loss, constraints, parameters, create_graph=False):
+        """Computes the gram matrix J(g) J(g)^T and J(g) J(f)^T for the
+        constraints g and loss f directly from the recorded layer inputs A and
+        output gradients G. The jacobian row of every nn.Linear layer is an
+        outer product of the two, so its contribution to J J^T is
+        (A A^T) * (G G^T), whose size only depends on the batch size
+
+        Supports either a batched loss of size (batchsize,) with constraints of
+        size (batchsize, num_constraints), in which case the gram matrices are
+        computed separately for every batch element, or a scalar loss with
+        constraints of size (1, batchsize * num_constraints) as in batchwise
+        constraining. In the latter case, the batch size is that of the first
+        recorded forward pass
+
+        :param loss: tensor of size (batchsize,) or (1,)
+        :param constraints: tensor of size (batchsize, num_constraints) or
+            (1, batchsize * num_constraints)
+        :param parameters: an iterable of the weights and biases of the hooked
+            layers
+        :param create_graph: set True for the results to be differentible
+        :returns: gram matrix of size (batchsize, num_constraints,
+            num_constraints) or (1, batchsize * num_constraints, batchsize *
+            num_constraints) and J(g) J(f)^T of size (batchsize,
+            num_constraints) or (1, batchsize * num_constraints), or None if
+            the loss or constraints are not supported
+        """
+        parameters = list(parameters)
+        if len(self._records) == 0:
+            return None
+        batched = loss.numel() != 1
+        if batched:
+            batchsize = loss.size()[0]
+            if constraints.size()[0] != batchsize:
+                return None
+        else:
+            batchsize = self._records[0][1].size()[0]
+            if constraints.numel() % batchsize != 0:
+                return None
+            # Recover the per-sample constraints of batchwise constraining
+            constraints = constraints.reshape(batchsize, -1)
+        if not self.supports(constraints, parameters):
+            return None
+
+        loss_result = self._output_gradients(
+            loss.reshape(-1, 1), parameters, create_graph, batchsize=batchsize
+        )
+        constraint_result = self._output_gradients(
+            constraints, parameters, create_graph
+        )
+        if loss_result is None or constraint_result is None:
+            return None
+        records, loss_grads = loss_result
+        __, constraint_grads = constraint_result
+
+        gram = None
+        cross = None
+        for layer_records, kernel in self._kernels(
+            records, parameters, diagonal=batched
+        ):
+            # (num_constraints, calls, batchsize, out_features)
+            g_grads = torch.stack(
+                [constraint_grads[r] for r in layer_records], dim=1
+            )
+            # (calls, batchsize, out_features)
+            f_grads = torch.stack([loss_grads[r][0] for r in layer_records])
+            if batched:
+                layer_gram = torch.einsum(
+                    "cdb,icbo,jdbo->bij", kernel, g_grads, g_grads
+                )
+                layer_cross = torch.einsum(
+                    "cdb,icbo,dbo->bi", kernel, g_grads, f_grads
+                )
+            else:
+                # Rows are ordered as in constraints.view(1, -1)
+                layer_gram = torch.einsum(
+                    "cbde,icbo,jdeo->biej", kernel, g_grads, g_grads
+                ).reshape(1, constraints.numel(), constraints.numel())
+                layer_cross = torch.einsum(
+                    "cbde,icbo,deo->bi", kernel, g_grads, f_grads
+                ).reshape(1, constraints.numel())
+            gram = layer_gram if gram is None else gram + layer_gram
+            cross = layer_cross if cross is None else cross + layer_cross
+        return gram, cross
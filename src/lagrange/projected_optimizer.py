@@ -0,0 +1,316 @@
+"""An optimizer wrapper which projects the gradient of the loss onto the
+constraint manifold at step time, rather than reweighting the loss"""
+
+from enum import Enum
+import torch
+from torch import autograd
+
+try:
+    from time import perf_counter
+except ImportError:
+    from time import time as perf_counter
+
+from src.lagrange.exact import _loss_and_constraint_jacobians
+from src.lagrange.linalg import _pseudoinverse_solve, _symmetric_eig
+
+__all__ = ["ProjectedOptimizer", "compute_projected_gradients"]
+
+
+class Timing_Events(Enum):
+    """A set of Sub-Batch events"""
+
+    COMPUTE_JACOBIANS = "multipliers: compute jacobians"
+    COMPUTE_GRAM = "multipliers: compute gram matrix"
+    COMPUTE_PRE_MULTIPLIERS = "multipliers: compute pre-multipliers"
+    CHOLESKY = "multipliers: cholesky"
+    CHOLESKY_SOLVE = "multipliers: choleksy solve"
+    ERRORED = "multipliers: errored"
+    LEAST_SQUARES = "multipliers: least squares"
+    PROJECT = "multipliers: project gradients"
+
+
+def compute_projected_gradients(
+    loss,
+    constraints,
+    parameters,
+    batchwise=False,
+    reduction=None,
+    return_timing=False,
+    warn=True,
+    per_sample_gradients=None,
+    per_sample_constraints=True,
+):
+    """Computes the gradients of the constrained loss of constrain_loss()
+    directly from the first-order jacobians of the loss and constraints. With
+    multipliers = (J(g) J(g)^T)^{-1} (g - J(g) J(f)^T), the gradient
+    J(f)^T + J(g)^T multipliers is the gradient of the loss projected onto the
+    null space of J(g), plus the Gauss-Newton step J(g)^+ g towards the
+    constraint manifold. Since the multipliers are never differentiated, no
+    jacobian is computed with create_graph=True and no backward pass through
+    the constrained loss is necessary
+
+    :param loss: tensor corresponding to the evalutated loss
+    :param constraints: a single tensor corresponding to the evaluated
+        constraints (you may need to torch.stack() first)
+    :param parameters: an iterable of the parameters to optimize
+    :param batchwise: whether to treat all instances of the constraints across
+        the batch as separate constraints. See constrain_loss()
+    :param reduction: optional reduction of the constraints. See
+        constrain_loss()
+    :param return_timing: whether to also return the timing data
+    :param warn: whether to warn if the constraints are ill-conditioned. If set
+        to "error", then will throw a RuntimeError if this occurs
+    :param per_sample_gradients: an optional src.lagrange.PerSampleGradients
+        which recorded the forward pass of the model
+    :param per_sample_constraints: whether the jacobian of the constraints may
+        also be computed with per_sample_gradients. See
+        compute_exact_multipliers()
+    :returns: gradients, multipliers (, timing), where gradients is a list of
+        tensors of the same sizes as the parameters holding the gradient of the
+        mean (along batch) constrained loss, and multipliers have the same
+        shape as the (reduced) constraints
+    """
+    timing = dict()
+
+    def record_timing(start_time, event):
+        end_time = perf_counter()
+        timing[event.value] = end_time - start_time
+        return end_time
+
+    if batchwise:
+        loss = torch.mean(loss)
+        constraints = constraints.view(1, -1)
+    elif reduction is not None:
+        loss = torch.mean(loss)
+        constraints = reduction(constraints)
+    original_constraints_size = constraints.size()
+    batchsize = 1 if len(loss.size()) == 0 else loss.size()[0]
+    constraints = constraints.view(batchsize, -1)
+    loss = loss.view(batchsize)
+
+    start_time = perf_counter()
+
+    parameters = list(parameters)
+    jac_fT, jac_g, jacobians_timing = _loss_and_constraint_jacobians(
+        loss,
+        constraints,
+        parameters,
+        True,
+        per_sample_gradients,
+        per_sample_constraints=per_sample_constraints,
+        create_graph=False,
+    )
+    start_time = record_timing(start_time, Timing_Events.COMPUTE_JACOBIANS)
+    timing.update(jacobians_timing)
+
+    gram_matrix = torch.einsum("...ij,...kj->...ik", jac_g, jac_g)
+    start_time = record_timing(start_time, Timing_Events.COMPUTE_GRAM)
+    untransformed_multipliers = (
+        constraints.detach() - torch.einsum("...ij,...j->...i", jac_g, jac_fT)
+    ).unsqueeze(-1)
+    start_time = record_timing(
+        start_time, Timing_Events.COMPUTE_PRE_MULTIPLIERS
+    )
+
+    try:
+        cholesky_L = torch.cholesky(gram_matrix)
+        start_time = record_timing(start_time, Timing_Events.CHOLESKY)
+        multipliers = torch.cholesky_solve(
+            untransformed_multipliers, cholesky_L
+        )
+        start_time = record_timing(start_time, Timing_Events.CHOLESKY_SOLVE)
+        timing[Timing_Events.ERRORED.value] = False
+        timing[Timing_Events.LEAST_SQUARES.value] = -999.0
+    except RuntimeError as rte:
+        if warn:
+            print("Error occurred while computing projected gradients:")
+            print(rte)
+            print(
+                "Constraints are likely ill-conditioned (i.e. jacobian is"
+                " not full rank at this point)! Falling back to computing"
+                " pseudoinverse"
+            )
+            if warn == "error":
+                raise rte
+        eigenvalues, eigenvectors = _symmetric_eig(gram_matrix)
+        multipliers = _pseudoinverse_solve(
+            eigenvalues, eigenvectors, untransformed_multipliers
+        )
+        start_time = record_timing(start_time, Timing_Events.LEAST_SQUARES)
+        timing[Timing_Events.ERRORED.value] = True
+        timing[Timing_Events.CHOLESKY_SOLVE.value] = -999.0
+        if Timing_Events.CHOLESKY.value not in timing:
+            timing[Timing_Events.CHOLESKY.value] = -999.0
+    multipliers = multipliers.squeeze(-1)
+
+    # Mean (along batch) of J(f)^T + J(g)^T multipliers
+    flat_gradient = torch.mean(
+        jac_fT + torch.einsum("...ij,...i->...j", jac_g, multipliers), dim=0
+    )
+    gradients = list()
+    offset = 0
+    for param in parameters:
+        gradients.append(
+            flat_gradient[offset : offset + param.numel()].view(param.size())
+        )
+        offset += param.numel()
+    start_time = record_timing(start_time, Timing_Events.PROJECT)
+
+    multipliers = multipliers.view(original_constraints_size)
+    if return_timing:
+        return gradients, multipliers, timing
+    else:
+        return gradients, multipliers
+
+
+class ProjectedOptimizer(object):
+    """Wraps a torch.optim optimizer so that each step follows the gradient of
+    the loss projected onto the constraint manifold. This is equivalent to
+    stepping with the gradient of the constrained loss of constrain_loss(),
+    but only needs the first-order jacobians of the loss and constraints. See
+    compute_projected_gradients()
+
+    Usage:
+        optimizer = ProjectedOptimizer(torch.optim.Adam(model.parameters()))
+        optimizer.zero_grad()
+        loss, constraints = ...
+        optimizer.step(loss, constraints)
+    """
+
+    def __init__(
+        self,
+        optimizer,
+        batchwise=False,
+        reduction=None,
+        warn=True,
+        per_sample_gradients=None,
+        parameters=None,
+        per_sample_constraints=True,
+    ):
+        """
+        :param optimizer: the torch.optim optimizer to wrap
+        :param batchwise: whether to treat all instances of the constraints
+            across the batch as separate constraints. See constrain_loss()
+        :param reduction: optional reduction of the constraints. See
+            constrain_loss()
+        :param warn: whether to warn if the constraints are ill-conditioned. If
+            set to "error", then will throw a RuntimeError if this occurs
+        :param per_sample_gradients: an optional
+            src.lagrange.PerSampleGradients which records the forward passes
+            of the model
+        :param parameters: optional subset of the parameters of the optimizer
+            whose gradients are projected (see select_parameters()). The
+            other parameters follow the gradient of the mean constrained loss
+            with the multipliers held fixed, exactly as they would with
+            constrain_loss(). Defaults to all of the parameters
+        :param per_sample_constraints: whether the jacobian of the constraints
+            may also be computed with per_sample_gradients. See
+            compute_exact_multipliers()
+        """
+        self.optimizer = optimizer
+        self.batchwise = batchwise
+        self.reduction = reduction
+        self.warn = warn
+        self.per_sample_gradients = per_sample_gradients
+        self.per_sample_constraints = per_sample_constraints
+        self.projected_parameters = (
+            None if parameters is None else list(parameters)
+        )
+
+    @property
+    def param_groups(self):
+        return self.optimizer.param_groups
+
+    @property
+    def state(self):
+        return self.optimizer.state
+
+    def parameters(self):
+        """The parameters of the wrapped optimizer which require gradients"""
+        return [
+            param
+            for group in self.optimizer.param_groups
+            for param in group["params"]
+            if param.requires_grad
+        ]
+
+    def zero_grad(self):
+        self.optimizer.zero_grad()
+
+    def state_dict(self):
+        return self.optimizer.state_dict()
+
+    def load_state_dict(self, state_dict):
+        self.optimizer.load_state_dict(state_dict)
+
+    def project(self, loss, constraints, return_timing=False):
+        """Sets the gradients of the parameters to the projected gradients.
+        Any existing gradients are overwritten
+
+        :param loss: tensor corresponding to the evalutated loss
+        :param constraints: a single tensor corresponding to the evaluated
+            constraints
+        :param return_timing: whether to also return the timing data
+        :returns: multipliers (, timing)
+        """
+        parameters = self.parameters()
+        others = list()
+        if self.projected_parameters is not None:
+            projected = set(id(param) for param in self.projected_parameters)
+            others = [
+                param for param in parameters if id(param) not in projected
+            ]
+            parameters = self.projected_parameters
+        gradients, multipliers, timing = compute_projected_gradients(
+            loss,
+            constraints,
+            parameters,
+            batchwise=self.batchwise,
+            reduction=self.reduction,
+            return_timing=True,
+            warn=self.warn,
+            per_sample_gradients=self.per_sample_gradients,
+            per_sample_constraints=self.per_sample_constraints,
+        )
+        for param, gradient in zip(parameters, gradients):
+            param.grad = gradient.detach().clone()
+        if len(others) > 0:
+            # As for constrain_loss(), the other parameters follow the
+            # gradient of the constrained loss with the multipliers held fixed
+            if self.batchwise:
+                loss = torch.mean(loss)
+                constraints = constraints.view(1, -1)
+            elif self.reduction is not None:
+                loss = torch.mean(loss)
+                constraints = self.reduction(constraints)
+            constrained_loss = loss + torch.einsum(
+                "...i,...i->...", constraints, multipliers.detach()
+            )
+            other_gradients = autograd.grad(
+                torch.mean(constrained_loss),
+                others,
+                retain_graph=True,
+                allow_unused=True,
+            )
+            for param, gradient in zip(others, other_gradients):
+                param.grad = (
+                    torch.zeros_like(param)
+                    if gradient is None
+                    else gradient.detach()
+                )
+        if return_timing:
+            return multipliers, timing
+        else:
+            return multipliers
+
+    def step(self, loss=None, constraints=None):
+        """Performs a single optimization step. If the loss and constraints are
+        given, first projects their gradients (see project()). Otherwise, the
+        gradients set by the last call to project() are used
+
+        :param loss: optional tensor corresponding to the evalutated loss
+        :param constraints: optional tensor of the evaluated constraints
+        """
+        if loss is not None:
+            self.project(loss, constraints)
+        self.optimizer.step()
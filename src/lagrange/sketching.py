@@ -0,0 +1,204 @@
+"""Functions for approximating the optimal Lagrange multipliers by sketching
+the parameter space with a few random directions"""
+
+from enum import Enum
+import math
+import torch
+from torch import autograd
+
+try:
+    from time import perf_counter
+except ImportError:
+    from time import time as perf_counter
+
+from src.lagrange.linalg import _pseudoinverse_solve, _symmetric_eig
+
+
+class Timing_Events(Enum):
+    """A set of Sub-Batch events"""
+
+    COMPUTE_SKETCH = "multipliers: compute sketched jacobians"
+    COMPUTE_GRAM = "multipliers: compute gram matrix"
+    COMPUTE_PRE_MULTIPLIERS = "multipliers: compute pre-multipliers"
+    CHOLESKY = "multipliers: cholesky"
+    CHOLESKY_SOLVE = "multipliers: choleksy solve"
+    ERRORED = "multipliers: errored"
+    LEAST_SQUARES = "multipliers: least squares"
+
+
+def _sketch_directions(parameters, sketch_size, sketch):
+    """Yields sketch_size random directions in the parameter space, scaled so
+    that the expected sum of their outer products is the identity
+
+    :param parameters: a list of the parameters
+    :param sketch_size: number of directions
+    :param sketch: "gaussian" or "subsample"
+    :yields: lists of tensors of the same sizes as the parameters
+    """
+    if sketch == "gaussian":
+        scale = 1 / math.sqrt(sketch_size)
+        for __ in range(sketch_size):
+            yield [torch.randn_like(param) * scale for param in parameters]
+    elif sketch == "subsample":
+        sizes = [param.numel() for param in parameters]
+        num_parameters = sum(sizes)
+        sketch_size = min(sketch_size, num_parameters)
+        scale = math.sqrt(num_parameters / sketch_size)
+        for index in torch.randperm(num_parameters)[:sketch_size].tolist():
+            direction = [torch.zeros_like(param) for param in parameters]
+            for param_direction, size in zip(direction, sizes):
+                if index < size:
+                    param_direction.view(-1)[index] = scale
+                    break
+                index -= size
+            yield direction
+    else:
+        raise ValueError(f"Sketch {sketch} not recognized!")
+
+
+def _sketched_jacobian(y, parameters, sketch_size, sketch, allow_unused):
+    """Computes the product of the jacobian of y with respect to the parameters
+    with a random sketching matrix, using one jacobian-vector product per
+    column of the sketch
+
+    :param y: tensor of size (batchsize, outsize)
+    :param parameters: a list of the parameters
+    :param sketch_size: number of columns of the sketch
+    :param sketch: "gaussian" or "subsample". See _sketch_directions()
+    :param allow_unused: whether some parameter may not affect y
+    :returns: tensor of size (batchsize, outsize, sketch_size)
+    """
+    # The vector-jacobian product J^T w is linear in the dummy w, so
+    # differentiating it with respect to w in the direction u gives J u
+    dummy = torch.zeros_like(y, requires_grad=True)
+    vjps = autograd.grad(
+        y,
+        parameters,
+        grad_outputs=dummy,
+        retain_graph=True,
+        create_graph=True,
+        allow_unused=allow_unused,
+    )
+    used = [i for i, vjp in enumerate(vjps) if vjp is not None]
+
+    columns = list()
+    for direction in _sketch_directions(parameters, sketch_size, sketch):
+        column = None
+        if len(used) > 0:
+            column = autograd.grad(
+                [vjps[i] for i in used],
+                dummy,
+                grad_outputs=[direction[i] for i in used],
+                retain_graph=True,
+                allow_unused=True,
+            )[0]
+        columns.append(torch.zeros_like(y) if column is None else column)
+    return torch.stack(columns, dim=-1)
+
+
+def compute_sketched_multipliers(
+    loss,
+    constraints,
+    parameters,
+    sketch_size=100,
+    sketch="gaussian",
+    return_timing=False,
+    allow_unused=False,
+    warn=True,
+):
+    """Approximates the optimal Lagrange multipliers by replacing the parameter
+    space with sketch_size random directions S, i.e. by solving
+    J(g) S S^T J(g)^T multipliers = g - J(g) S S^T J(f)^T. Only the sketched
+    jacobians J(g) S and J(f) S are computed, with one jacobian-vector product
+    per direction. The approximation improves as sketch_size grows and should
+    be much larger than the number of constraints
+
+    :param loss: tensor corresponding to the evalutated loss
+    :param constraints: a single tensor corresponding to the evaluated
+        constraints (you may need to torch.stack() first)
+    :param parameters: an iterable of the parameters to optimize
+    :param sketch_size: number of random directions
+    :param sketch: distribution of the random directions. Should be one of
+        "gaussian" - independent Gaussian directions
+        "subsample" - a random subset of the parameters
+        Defaults to "gaussian"
+    :param return_timing: whether to also return the timing data
+    :param allow_unused: whether to allow some parameter to not be an input of
+        the loss or constraints function. Defaults to False
+    :param warn: whether to warn if the sketched constraints are
+        ill-conditioned. If set to "error", then will throw a RuntimeError if
+        this occurs
+    :returns: multipliers (, timing), if the timing is also requested.
+        Multipliers will have the same shape as the constraints
+    """
+    timing = dict()
+
+    def record_timing(start_time, event):
+        end_time = perf_counter()
+        timing[event.value] = end_time - start_time
+        return end_time
+
+    # Restructure the constraints into the shapes (batchsize, -1)
+    batchsize = 1 if len(loss.size()) == 0 else loss.size()[0]
+    original_constraints_size = constraints.size()
+    constraints = constraints.view(batchsize, -1)
+    # Restructure the loss into the shape (batchsize, )
+    loss = loss.view(batchsize)
+
+    start_time = perf_counter()
+
+    # The loss and constraints share a single sketch
+    sketched = _sketched_jacobian(
+        torch.cat([loss.unsqueeze(-1), constraints], dim=-1),
+        list(parameters),
+        sketch_size,
+        sketch,
+        allow_unused,
+    )
+    jac_fT = sketched[:, 0]
+    jac_g = sketched[:, 1:]
+    start_time = record_timing(start_time, Timing_Events.COMPUTE_SKETCH)
+
+    gram_matrix = torch.einsum("...ij,...kj->...ik", jac_g, jac_g)
+    start_time = record_timing(start_time, Timing_Events.COMPUTE_GRAM)
+
+    untransformed_multipliers = (
+        constraints - torch.einsum("...ij,...j->...i", jac_g, jac_fT)
+    ).unsqueeze(-1)
+    start_time = record_timing(
+        start_time, Timing_Events.COMPUTE_PRE_MULTIPLIERS
+    )
+
+    try:
+        cholesky_L = torch.cholesky(gram_matrix)
+        start_time = record_timing(start_time, Timing_Events.CHOLESKY)
+        multipliers = torch.cholesky_solve(
+            untransformed_multipliers, cholesky_L
+        )
+        start_time = record_timing(start_time, Timing_Events.CHOLESKY_SOLVE)
+        timing[Timing_Events.ERRORED.value] = False
+        timing[Timing_Events.LEAST_SQUARES.value] = -999.0
+    except RuntimeError as rte:
+        if warn:
+            print("Error occurred while computing sketched multipliers:")
+            print(rte)
+            print(
+                "Sketched constraints are ill-conditioned! Try increasing the"
+                " sketch size. Falling back to computing pseudoinverse"
+            )
+            if warn == "error":
+                raise rte
+        eigenvalues, eigenvectors = _symmetric_eig(gram_matrix)
+        multipliers = _pseudoinverse_solve(
+            eigenvalues, eigenvectors, untransformed_multipliers
+        )
+        start_time = record_timing(start_time, Timing_Events.LEAST_SQUARES)
+        timing[Timing_Events.ERRORED.value] = True
+        timing[Timing_Events.CHOLESKY_SOLVE.value] = -999.0
+        if Timing_Events.CHOLESKY.value not in timing:
+            timing[Timing_Events.CHOLESKY.value] = -999.0
+
+    if return_timing:
+        return multipliers.view(original_constraints_size), timing
+    else:
+        return multipliers.view(original_constraints_size)
@@ -0,0 +1,249 @@
+"""Solvers for large gram matrices which exploit their block and low-rank
+structure, e.g. those of batchwise constraining or of multi-output constraints
+"""
+
+import torch
+
+from src.lagrange.linalg import _pseudoinverse_tolerance, _symmetric_eig
+
+
+def _diagonal_blocks(gram_matrix, block_size):
+    """Extracts the diagonal blocks of a batch of matrices
+
+    :param gram_matrix: tensor of size (batchsize, n, n)
+    :param block_size: size of the blocks. Must divide n
+    :returns: tensor of size (batchsize, n / block_size, block_size,
+        block_size)
+    """
+    batchsize, n, __ = gram_matrix.size()
+    num_blocks = n // block_size
+    blocks = gram_matrix.view(
+        batchsize, num_blocks, block_size, num_blocks, block_size
+    )
+    index = torch.arange(num_blocks, device=gram_matrix.device)
+    return blocks[:, index, :, index, :].transpose(0, 1)
+
+
+def _jacobian_diagonal_blocks(jac_g, block_size):
+    """Computes the diagonal blocks of J J^T from J without forming J J^T
+
+    :param jac_g: tensor of size (batchsize, n, num_parameters)
+    :param block_size: size of the blocks. Must divide n
+    :returns: tensor of size (batchsize, n / block_size, block_size,
+        block_size)
+    """
+    batchsize, n, num_parameters = jac_g.size()
+    rows = jac_g.reshape(
+        batchsize, n // block_size, block_size, num_parameters
+    )
+    return torch.einsum("...ik,...jk->...ij", rows, rows)
+
+
+def _gram_operator(jac_g, gram_matrix):
+    """Returns the function which multiplies a batch of vectors by the gram
+    matrix, i.e. J (J^T x) if only the jacobian J is available
+    """
+    if gram_matrix is not None:
+        return lambda vector: gram_matrix @ vector
+    jac_gT = jac_g.transpose(-1, -2)
+    return lambda vector: jac_g @ (jac_gT @ vector)
+
+
+def _block_solve(cholesky_blocks, rhs):
+    """Solves the block-diagonal system with the given Cholesky factors
+
+    :param cholesky_blocks: tensor of size (batchsize, num_blocks, block_size,
+        block_size)
+    :param rhs: tensor of size (batchsize, n, 1)
+    :returns: tensor of size (batchsize, n, 1)
+    """
+    batchsize, num_blocks, block_size, __ = cholesky_blocks.size()
+    num_systems = batchsize * num_blocks
+    solution = torch.cholesky_solve(
+        rhs.reshape(num_systems, block_size, 1),
+        cholesky_blocks.reshape(num_systems, block_size, block_size),
+    )
+    return solution.view(rhs.size())
+
+
+def _low_rank_solve(jac_g, rhs):
+    """Minimum-norm solution of J J^T x = rhs when J has fewer columns than
+    rows. Then x = J (J^T J)^+ (J^T J)^+ J^T rhs only needs the
+    eigendecomposition of the smaller J^T J
+
+    :param jac_g: tensor of size (batchsize, n, num_parameters)
+    :param rhs: tensor of size (batchsize, n, 1)
+    :returns: tensor of size (batchsize, n, 1)
+    """
+    eigenvalues, eigenvectors = _symmetric_eig(
+        torch.einsum("...ji,...jk->...ik", jac_g, jac_g)
+    )
+    nonzero = torch.abs(eigenvalues) > _pseudoinverse_tolerance(eigenvalues)
+    inverse_eigenvalues = torch.where(
+        nonzero, 1 / eigenvalues ** 2, torch.zeros_like(eigenvalues)
+    )
+    projected = torch.einsum(
+        "...ji,...jk,...kl->...il", eigenvectors, jac_g.transpose(-1, -2), rhs
+    )
+    return torch.einsum(
+        "...ij,...jk,...k,...kl->...il",
+        jac_g,
+        eigenvectors,
+        inverse_eigenvalues,
+        projected,
+    )
+
+
+def _batch_norm(tensor):
+    return torch.sqrt(torch.sum(tensor ** 2, dim=(1, 2)))
+
+
+def _preconditioned_cg(
+    gram_operator,
+    rhs,
+    cholesky_blocks,
+    tolerance,
+    max_iterations,
+    initial_solution=None,
+):
+    """Conjugate gradient on a batch of gram matrices, preconditioned with
+    their block diagonals
+
+    :param gram_operator: function which multiplies a tensor of size
+        (batchsize, n, 1) by the gram matrices
+    :param initial_solution: optional initial guess of size (batchsize, n, 1).
+        Defaults to zero
+    :returns: solution of size (batchsize, n, 1), number of iterations,
+        whether every system converged
+    """
+    if initial_solution is None:
+        solution = torch.zeros_like(rhs)
+        residual = rhs
+    else:
+        solution = initial_solution
+        residual = rhs - gram_operator(initial_solution)
+    preconditioned = _block_solve(cholesky_blocks, residual)
+    direction = preconditioned
+    residual_dot = torch.sum(residual * preconditioned, dim=(1, 2))
+    rhs_norm = torch.clamp(_batch_norm(rhs), min=1e-30)
+
+    iterations = 0
+    converged = False
+    while iterations < max_iterations:
+        if torch.all(_batch_norm(residual) <= tolerance * rhs_norm):
+            converged = True
+            break
+        operator_direction = gram_operator(direction)
+        curvature = torch.sum(direction * operator_direction, dim=(1, 2))
+        step = torch.where(
+            curvature > 0, residual_dot / curvature, torch.zeros_like(curvature)
+        ).view(-1, 1, 1)
+        solution = solution + step * direction
+        residual = residual - step * operator_direction
+        preconditioned = _block_solve(cholesky_blocks, residual)
+        new_residual_dot = torch.sum(residual * preconditioned, dim=(1, 2))
+        direction = preconditioned + (
+            new_residual_dot / torch.clamp(residual_dot, min=1e-30)
+        ).view(-1, 1, 1) * direction
+        residual_dot = new_residual_dot
+        iterations += 1
+    return solution, iterations, converged
+
+
+def solve_structured_gram(
+    rhs,
+    jac_g=None,
+    gram_matrix=None,
+    block_size=1,
+    block_tolerance=1e-3,
+    tolerance=1e-6,
+    max_iterations=None,
+):
+    """Solves J(g) J(g)^T x = rhs by exploiting the structure of the gram
+    matrix J(g) J(g)^T, choosing between
+        "low-rank" - if J(g) has fewer columns than rows, the much smaller
+            J(g)^T J(g) is decomposed instead
+        "block-diagonal" - if the solution of the diagonal blocks (factorized
+            independently) nearly solves the whole system, it is refined to
+            the tolerance with block-preconditioned conjugate gradient, which
+            then needs very few iterations
+        "block-preconditioned" - otherwise, conjugate gradient preconditioned
+            with the Cholesky factors of the diagonal blocks
+    Given J(g), the gram matrix is never formed: the diagonal blocks are
+    computed from its rows, and conjugate gradient multiplies by J(g) and
+    J(g)^T in turn
+
+    :param rhs: tensor of size (batchsize, n, 1)
+    :param jac_g: jacobian of size (batchsize, n, num_parameters)
+    :param gram_matrix: tensor of size (batchsize, n, n), used instead if the
+        jacobian is not available (e.g. see PerSampleGradients.gram_matrix())
+    :param block_size: number of consecutive rows which form a diagonal block,
+        e.g. the number of constraints per sample for batchwise constraining.
+        If it does not divide n, the diagonal is used instead
+    :param block_tolerance: relative residual of the solution of the diagonal
+        blocks below which it is used as the initial guess
+    :param tolerance: relative residual at which conjugate gradient stops
+    :param max_iterations: maximum number of conjugate gradient iterations.
+        Defaults to n
+    :returns: solution of size (batchsize, n, 1) and a dictionary with the
+        "structure" used, the largest relative "block_residual" of the
+        solution of the diagonal blocks, and the number of conjugate gradient
+        "iterations" (both -999 if not used)
+    :throws: ValueError if neither jac_g nor gram_matrix are given.
+        RuntimeError if conjugate gradient does not converge or any diagonal
+        block is not positive definite
+    """
+    if jac_g is None and gram_matrix is None:
+        raise ValueError("Either jac_g or gram_matrix must be given")
+    n = rhs.size()[-2]
+    if block_size is None or n % block_size != 0:
+        block_size = 1
+    if max_iterations is None:
+        max_iterations = n
+    info = {"block_residual": -999, "iterations": -999}
+
+    if jac_g is not None and jac_g.size()[-1] < n:
+        info["structure"] = "low-rank"
+        return _low_rank_solve(jac_g, rhs), info
+
+    if jac_g is not None:
+        blocks = _jacobian_diagonal_blocks(jac_g, block_size)
+        gram_matrix = None
+    else:
+        blocks = _diagonal_blocks(gram_matrix, block_size)
+    gram_operator = _gram_operator(jac_g, gram_matrix)
+    cholesky_blocks = torch.cholesky(blocks)
+
+    # The coupling through the blocks off the diagonal is measured by how far
+    # the solution of the diagonal blocks is from solving the whole system
+    block_solution = _block_solve(cholesky_blocks, rhs)
+    block_residual = float(
+        torch.max(
+            _batch_norm(rhs - gram_operator(block_solution))
+            / torch.clamp(_batch_norm(rhs), min=1e-30)
+        )
+    )
+    info["block_residual"] = block_residual
+    if block_residual <= block_tolerance:
+        info["structure"] = "block-diagonal"
+        initial_solution = block_solution
+    else:
+        info["structure"] = "block-preconditioned"
+        initial_solution = None
+    # The blocks off the diagonal are never simply dropped, so the solution
+    # is exact up to the tolerance
+    solution, iterations, converged = _preconditioned_cg(
+        gram_operator,
+        rhs,
+        cholesky_blocks,
+        tolerance,
+        max_iterations,
+        initial_solution=initial_solution,
+    )
+    info["iterations"] = iterations
+    if not converged:
+        raise RuntimeError(
+            f"Block-preconditioned conjugate gradient did not converge after"
+            f" {iterations} iterations"
+        )
+    return solution, info
@@ -0,0 +1,311 @@
+"""Functions for computing the optimal Lagrange multipliers statefully, reusing
+the multipliers and gram matrix factorization of previous steps between exact
+recomputations"""
+
+from enum import Enum
+import torch
+
+try:
+    from time import perf_counter
+except ImportError:
+    from time import time as perf_counter
+
+from src.derivatives import jacobian
+from src.lagrange.conjugate_gradient import (
+    _constraint_products,
+    _loss_gradient,
+)
+
+
+class Timing_Events(Enum):
+    """A set of Sub-Batch events"""
+
+    COMPUTE_PRE_MULTIPLIERS = "multipliers: compute pre-multipliers"
+    CORRECTIONS = "multipliers: corrective iterations"
+    NUM_CORRECTIONS = "multipliers: number of corrective iterations"
+    COMPUTE_JF = "multipliers: compute loss jacobian"
+    COMPUTE_JG = "multipliers: compute constraint jacobian"
+    COMPUTE_GRAM = "multipliers: compute gram matrix"
+    CHOLESKY = "multipliers: cholesky"
+    CHOLESKY_SOLVE = "multipliers: choleksy solve"
+    REFRESHED = "multipliers: refreshed"
+    ERRORED = "multipliers: errored"
+
+
+class Warm_Start_State(object):
+    """Stores the multipliers and the factorization of the gram matrix of the
+    last exact computation, together with the settings which decide when to
+    recompute them exactly. compute_warm_started_multipliers() updates this
+    in place, so a single state should be kept for an entire training run
+
+    A corrected step costs at least 5 autograd passes (the helper graph of the
+    jacobian-vector products, the loss gradient, one jacobian-vector product
+    for the right hand side and a vector-jacobian and jacobian-vector product
+    per residual check), whereas an exact recomputation costs one pass per
+    constraint plus one for the loss. Warm starting therefore only pays off
+    for many constraints, and fewer than min_constraints are always
+    recomputed exactly"""
+
+    def __init__(
+        self,
+        refresh_interval=20,
+        max_corrections=2,
+        tolerance=1e-3,
+        residual_growth=2.0,
+        step_growth=2.0,
+        min_constraints=8,
+    ):
+        """
+        :param refresh_interval: maximum number of steps between exact
+            recomputations
+        :param max_corrections: maximum number of corrective iterations per
+            step. If these do not reach the tolerance, the multipliers are
+            recomputed exactly
+        :param tolerance: relative residual of the linear system for the
+            multipliers at which the corrective iterations stop
+        :param residual_growth: recompute exactly if the norm of the
+            constraints grows by this factor since the last recomputation
+        :param step_growth: recompute exactly if the size of the parameter
+            step grows by this factor since the first step after the last
+            recomputation
+        :param min_constraints: always recompute exactly if there are fewer
+            constraints than this, since correcting is then more expensive
+        """
+        self.refresh_interval = refresh_interval
+        self.max_corrections = max_corrections
+        self.tolerance = tolerance
+        self.residual_growth = residual_growth
+        self.step_growth = step_growth
+        self.min_constraints = min_constraints
+        self.reset()
+
+    def reset(self):
+        """Forces an exact recomputation at the next step"""
+        self.multipliers = None
+        self.cholesky_L = None
+        self.last_parameters = None
+        self.reference_residual = None
+        self.reference_step = None
+        self.steps_since_refresh = 0
+
+    def needs_refresh(self, flat_constraints, parameters):
+        """Whether the multipliers should be recomputed exactly
+
+        :param flat_constraints: a vector of the current constraints
+        :param parameters: a list of the current parameters
+        """
+        if (
+            flat_constraints.numel() < self.min_constraints
+            or self.multipliers is None
+            or self.multipliers.size() != flat_constraints.size()
+            or self.steps_since_refresh >= self.refresh_interval
+        ):
+            return True
+        residual = float(torch.norm(flat_constraints.detach()))
+        threshold = self.residual_growth * max(self.reference_residual, 1e-8)
+        if residual > threshold:
+            return True
+        step = float(
+            torch.sqrt(
+                sum(
+                    torch.sum((param.detach() - last) ** 2)
+                    for param, last in zip(parameters, self.last_parameters)
+                )
+            )
+        )
+        if self.reference_step is None:
+            self.reference_step = step
+        elif step > self.step_growth * max(self.reference_step, 1e-12):
+            return True
+        return False
+
+
+def _jittered_cholesky(gram_matrix, warn):
+    """Computes the Cholesky factor of the gram matrix, adding increasing
+    multiples of the mean diagonal to the diagonal until it succeeds
+
+    :returns: cholesky factor, whether any jitter was necessary
+    """
+    try:
+        return torch.cholesky(gram_matrix), False
+    except RuntimeError as rte:
+        if warn:
+            print("Error occurred while computing constrained loss:")
+            print(rte)
+            print(
+                "Constraints are likely ill-conditioned (i.e. jacobian is"
+                " not full rank at this point)! Regularizing gram matrix"
+            )
+            if warn == "error":
+                raise rte
+    size = gram_matrix.size()[-1]
+    scale = torch.mean(
+        torch.diagonal(gram_matrix, dim1=-2, dim2=-1), dim=-1
+    ).view(-1, 1, 1)
+    identity = torch.eye(
+        size, dtype=gram_matrix.dtype, device=gram_matrix.device
+    )
+    jitter = 1e-8
+    while True:
+        try:
+            return (
+                torch.cholesky(gram_matrix + jitter * scale * identity),
+                True,
+            )
+        except RuntimeError:
+            if jitter >= 1.0:
+                raise
+            jitter *= 10
+
+
+def compute_warm_started_multipliers(
+    loss,
+    constraints,
+    parameters,
+    state,
+    return_timing=False,
+    allow_unused=False,
+    warn=True,
+):
+    """Computes the optimal Lagrange multipliers by correcting those of the
+    previous step. Each corrective iteration computes the residual of
+    J(g) J(g)^T multipliers = g - J(g) J(f)^T with one vector-jacobian product
+    and one jacobian-vector product and solves for the correction with the
+    Cholesky factor of the last exact gram matrix. The multipliers are
+    recomputed exactly (and the factorization updated) periodically, whenever
+    the constraints or the parameter steps grow too much, and whenever the
+    corrections fail to converge. Few constraints are always recomputed
+    exactly, since that is cheaper. See Warm_Start_State
+
+    Since the vector-jacobian products sum over any batch, the loss must be a
+    single scalar (e.g. the "batchwise" or "reduction" methods of
+    constrain_loss). The multipliers are not differentiable
+
+    :param loss: tensor corresponding to the evaluated loss. Must have exactly
+        one element
+    :param constraints: a single tensor corresponding to the evaluated
+        constraints (you may need to torch.stack() first)
+    :param parameters: an iterable of the parameters to optimize
+    :param state: a Warm_Start_State, which is updated in place
+    :param return_timing: whether to also return the timing data
+    :param allow_unused: whether to allow some parameter to not be an input of
+        the loss or constraints function. Defaults to False
+    :param warn: whether to warn if the constraints are ill-conditioned. If set
+        to "error", then will throw a RuntimeError if this occurs
+    :returns: multipliers (, timing), if the timing is also requested.
+        Multipliers will have the same shape as the constraints
+    :throws: ValueError if the loss has more than one element
+    """
+    if loss.numel() != 1:
+        raise ValueError(
+            "Warm-started multipliers require a scalar loss. Try the batchwise"
+            " or reduction methods"
+        )
+
+    timing = dict()
+
+    def record_timing(start_time, event):
+        end_time = perf_counter()
+        timing[event.value] = end_time - start_time
+        return end_time
+
+    parameters = list(parameters)
+    flat_constraints = constraints.view(-1)
+    refresh = state.needs_refresh(flat_constraints, parameters)
+
+    start_time = perf_counter()
+    if not refresh:
+        constraint_jvp, constraint_vjp = _constraint_products(
+            flat_constraints, parameters, allow_unused
+        )
+        rhs = flat_constraints.detach() - constraint_jvp(
+            _loss_gradient(loss, parameters, allow_unused)
+        )
+        rhs_norm = torch.norm(rhs)
+        start_time = record_timing(
+            start_time, Timing_Events.COMPUTE_PRE_MULTIPLIERS
+        )
+
+        multipliers = state.multipliers
+        iterations = 0
+        while True:
+            residual = rhs - constraint_jvp(constraint_vjp(multipliers))
+            if torch.norm(residual) <= state.tolerance * rhs_norm:
+                break
+            if iterations >= state.max_corrections:
+                # The old factorization is no longer good enough
+                refresh = True
+                break
+            multipliers = multipliers + torch.cholesky_solve(
+                residual.view(1, -1, 1), state.cholesky_L
+            ).view(-1)
+            iterations += 1
+        start_time = record_timing(start_time, Timing_Events.CORRECTIONS)
+        timing[Timing_Events.NUM_CORRECTIONS.value] = iterations
+    else:
+        timing[Timing_Events.COMPUTE_PRE_MULTIPLIERS.value] = -999.0
+        timing[Timing_Events.CORRECTIONS.value] = -999.0
+        timing[Timing_Events.NUM_CORRECTIONS.value] = -999.0
+
+    if refresh:
+        # The multipliers are not differentiable, so neither are the jacobians
+        jac_fT = torch.cat(
+            [
+                jac.view(1, -1)
+                for jac in jacobian(
+                    loss.view(1), parameters, allow_unused=allow_unused
+                )
+            ],
+            dim=-1,
+        )
+        start_time = record_timing(start_time, Timing_Events.COMPUTE_JF)
+        jac_g = torch.cat(
+            [
+                jac.view(1, flat_constraints.numel(), -1)
+                for jac in jacobian(
+                    flat_constraints.view(1, -1),
+                    parameters,
+                    allow_unused=allow_unused,
+                )
+            ],
+            dim=-1,
+        )
+        start_time = record_timing(start_time, Timing_Events.COMPUTE_JG)
+        gram_matrix = torch.einsum("...ij,...kj->...ik", jac_g, jac_g)
+        start_time = record_timing(start_time, Timing_Events.COMPUTE_GRAM)
+        cholesky_L, errored = _jittered_cholesky(gram_matrix, warn)
+        start_time = record_timing(start_time, Timing_Events.CHOLESKY)
+        untransformed_multipliers = (
+            flat_constraints.view(1, -1)
+            - torch.einsum("...ij,...j->...i", jac_g, jac_fT)
+        ).detach()
+        multipliers = torch.cholesky_solve(
+            untransformed_multipliers.unsqueeze(-1), cholesky_L
+        ).view(-1)
+        start_time = record_timing(start_time, Timing_Events.CHOLESKY_SOLVE)
+        timing[Timing_Events.ERRORED.value] = errored
+
+        state.cholesky_L = cholesky_L
+        state.reference_residual = float(
+            torch.norm(flat_constraints.detach())
+        )
+        state.reference_step = None
+        state.steps_since_refresh = 0
+    else:
+        timing[Timing_Events.COMPUTE_JF.value] = -999.0
+        timing[Timing_Events.COMPUTE_JG.value] = -999.0
+        timing[Timing_Events.COMPUTE_GRAM.value] = -999.0
+        timing[Timing_Events.CHOLESKY.value] = -999.0
+        timing[Timing_Events.CHOLESKY_SOLVE.value] = -999.0
+        timing[Timing_Events.ERRORED.value] = False
+        state.steps_since_refresh += 1
+    timing[Timing_Events.REFRESHED.value] = refresh
+
+    state.multipliers = multipliers.detach()
+    state.last_parameters = [param.detach().clone() for param in parameters]
+
+    multipliers = state.multipliers.view(constraints.size())
+    if return_timing:
+        return multipliers, timing
+    else:
+        return multipliers
@@ -0,0 +1,362 @@
+"""Declarative specifications of PDE residuals in terms of the outputs u of a
+model, their derivatives with respect to the inputs x, and the
+parameterization of the PDE. A specification is compiled once into a flat
+evaluation plan which computes every needed derivative exactly once and every
+shared subexpression only once
+
+The names of the specification language (u, x, sin, ...) are deliberately
+not re-exported from src.pdes, so import them from this module
+
+Usage:
+    from src.pdes.spec import compile_residual, lap_u, param, u
+
+    residual = compile_residual(
+        [lap_u(0) + (2 * np.pi * param(1)) ** 2 * u(0)]
+    )
+    constraints = residual(outputs, inputs, parameterization)
+"""
+
+import math
+import numbers
+import torch
+
+from src.derivatives import DerivativeContext
+
+__all__ = [
+    "u",
+    "du",
+    "lap_u",
+    "x",
+    "param",
+    "scalar",
+    "sin",
+    "cos",
+    "exp",
+    "tanh",
+    "compile_residual",
+    "CompiledResidual",
+]
+
+
+# Leaves which index into a tensor, and the tensor they index into
+_LEAVES = {
+    "u": "outputs",
+    "du": "jacobian",
+    "lap": "laplacian",
+    "x": "inputs",
+    "param": "parameterization",
+}
+
+_FUNCTIONS = {
+    "sin": (torch.sin, math.sin),
+    "cos": (torch.cos, math.cos),
+    "exp": (torch.exp, math.exp),
+    "tanh": (torch.tanh, math.tanh),
+}
+
+_COMMUTATIVE = {"add", "mul"}
+
+
+class Expr(object):
+    """A node of a residual specification. Expressions are immutable and
+    structurally identical expressions have equal keys, which is what allows
+    common subexpressions to be shared"""
+
+    def __init__(self, op, args=(), value=None):
+        self.op = op
+        self.args = tuple(args)
+        self.value = value
+        arg_keys = tuple(arg.key for arg in self.args)
+        if op in _COMMUTATIVE:
+            arg_keys = tuple(sorted(arg_keys, key=repr))
+        self.key = (op, value, arg_keys)
+
+    def __add__(self, other):
+        return _binary("add", self, other)
+
+    def __radd__(self, other):
+        return _binary("add", other, self)
+
+    def __sub__(self, other):
+        return _binary("sub", self, other)
+
+    def __rsub__(self, other):
+        return _binary("sub", other, self)
+
+    def __mul__(self, other):
+        return _binary("mul", self, other)
+
+    def __rmul__(self, other):
+        return _binary("mul", other, self)
+
+    def __truediv__(self, other):
+        return _binary("div", self, other)
+
+    def __rtruediv__(self, other):
+        return _binary("div", other, self)
+
+    def __neg__(self):
+        return _binary("mul", -1.0, self)
+
+    def __pow__(self, exponent):
+        if not isinstance(exponent, numbers.Number):
+            raise ValueError("Only constant exponents are supported")
+        if exponent == 1:
+            return self
+        if self.op == "const":
+            return _const(self.value ** exponent)
+        return Expr("pow", [self], value=float(exponent))
+
+    def __repr__(self):
+        if len(self.args) == 0:
+            return f"{self.op}({self.value})"
+        args = ", ".join(repr(arg) for arg in self.args)
+        if self.value is None:
+            return f"{self.op}({args})"
+        return f"{self.op}[{self.value}]({args})"
+
+
+def _const(value):
+    return Expr("const", value=float(value))
+
+
+def _wrap(value):
+    if isinstance(value, Expr):
+        return value
+    if isinstance(value, numbers.Number):
+        return _const(value)
+    raise ValueError(f"Cannot use {value} in a residual specification")
+
+
+def _binary(op, a, b):
+    """Builds a binary expression, folding constants and identities"""
+    a = _wrap(a)
+    b = _wrap(b)
+    if a.op == "const" and b.op == "const":
+        x, y = a.value, b.value
+        return _const(
+            {"add": x + y, "sub": x - y, "mul": x * y, "div": x / y}[op]
+        )
+    if op == "add":
+        if a.op == "const" and a.value == 0:
+            return b
+        if b.op == "const" and b.value == 0:
+            return a
+    elif op == "sub":
+        if b.op == "const" and b.value == 0:
+            return a
+    elif op == "mul":
+        if a.op == "const" and a.value == 1:
+            return b
+        if b.op == "const" and b.value == 1:
+            return a
+        if (a.op == "const" and a.value == 0) or (
+            b.op == "const" and b.value == 0
+        ):
+            return _const(0)
+    elif op == "div":
+        if b.op == "const" and b.value == 1:
+            return a
+    return Expr(op, [a, b])
+
+
+def u(i):
+    """The i-th output of the model"""
+    return Expr("u", value=(i,))
+
+
+def du(i, j):
+    """The derivative of the i-th output with respect to the j-th input"""
+    return Expr("du", value=(i, j))
+
+
+def lap_u(i):
+    """The laplacian of the i-th output with respect to the inputs"""
+    return Expr("lap", value=(i,))
+
+
+def x(i):
+    """The i-th input of the model"""
+    return Expr("x", value=(i,))
+
+
+def param(i):
+    """The i-th entry of the parameterization of the PDE"""
+    return Expr("param", value=(i,))
+
+
+def scalar(name):
+    """A scalar which is provided as a keyword argument at evaluation time"""
+    return Expr("scalar", value=name)
+
+
+def _function(name, arg):
+    arg = _wrap(arg)
+    if arg.op == "const":
+        return _const(_FUNCTIONS[name][1](arg.value))
+    return Expr(name, [arg])
+
+
+def sin(arg):
+    return _function("sin", arg)
+
+
+def cos(arg):
+    return _function("cos", arg)
+
+
+def exp(arg):
+    return _function("exp", arg)
+
+
+def tanh(arg):
+    return _function("tanh", arg)
+
+
+class CompiledResidual(object):
+    """A residual specification compiled into a flat list of operations, in
+    which every distinct subexpression appears exactly once. Calling it
+    evaluates the residual, computing only the derivatives which it needs"""
+
+    def __init__(self, residuals, defaults=None):
+        """
+        :param residuals: a list of expressions, one per component of the
+            residual
+        :param defaults: optional dictionary of default values of scalars
+        """
+        self.defaults = dict() if defaults is None else dict(defaults)
+        self._plan = list()
+        index = dict()
+
+        def visit(expr):
+            if expr.key in index:
+                return index[expr.key]
+            args = [visit(arg) for arg in expr.args]
+            index[expr.key] = len(self._plan)
+            self._plan.append((expr.op, expr.value, args))
+            return index[expr.key]
+
+        self._outputs = [visit(_wrap(residual)) for residual in residuals]
+        ops = set(op for op, __, __ in self._plan)
+        self.needs_jacobian = "du" in ops
+        self.needs_laplacian = "lap" in ops
+        self.needs_parameterization = "param" in ops
+        self.scalars = set(
+            value for op, value, __ in self._plan if op == "scalar"
+        )
+
+    def __len__(self):
+        """Number of distinct operations after eliminating common
+        subexpressions"""
+        return len(self._plan)
+
+    def __call__(
+        self,
+        outputs,
+        inputs,
+        parameterization=None,
+        return_diagnostics=False,
+        num_probes=None,
+        distribution="rademacher",
+        context=None,
+        **scalars,
+    ):
+        """Evaluates the residual
+
+        :param outputs: output of some network
+        :param inputs: inputs to some network
+        :param parameterization: parameterization of the PDE, if needed
+        :param return_diagnostics: whether to also return the derivatives
+        :param num_probes: if provided, the laplacian is estimated with this
+            many random probes (Hutchinson's estimator) instead of computed
+            exactly
+        :param distribution: distribution of the random probes. See
+            src.derivatives.jacobian_and_estimated_laplacian
+        :param context: optional src.derivatives.DerivativeContext shared with
+            any other functions of the same outputs and inputs
+        :param scalars: values of the scalars of the specification, which
+            override the defaults
+        :returns: tensor of the residual components stacked along the last
+            dimension (, (jacobian, laplacian)), where derivatives which are
+            not needed are None
+        :throws: ValueError if a needed parameterization or scalar is missing
+        """
+        if self.needs_parameterization and parameterization is None:
+            raise ValueError("This residual requires the parameterization")
+        values = dict(self.defaults)
+        values.update(scalars)
+        missing = self.scalars - set(values.keys())
+        if len(missing) > 0:
+            raise ValueError(f"Missing values for scalars {missing}")
+
+        batched = len(inputs.size()) > 1
+        if context is None:
+            context = DerivativeContext()
+        tensors = {
+            "outputs": outputs,
+            "inputs": inputs,
+            "parameterization": parameterization,
+            "jacobian": None,
+            "laplacian": None,
+        }
+        # Every derivative is computed at most once
+        if self.needs_jacobian:
+            tensors["jacobian"] = context.jacobian(
+                outputs, inputs, batched=batched
+            )
+        if self.needs_laplacian:
+            tensors["laplacian"] = context.laplacian(
+                outputs,
+                inputs,
+                batched=batched,
+                num_probes=num_probes,
+                distribution=distribution,
+            )
+
+        results = list()
+        for op, value, args in self._plan:
+            args = [results[arg] for arg in args]
+            if op in _LEAVES:
+                result = tensors[_LEAVES[op]][(Ellipsis, *value)]
+            elif op == "const":
+                result = value
+            elif op == "scalar":
+                result = values[value]
+            elif op == "add":
+                result = args[0] + args[1]
+            elif op == "sub":
+                result = args[0] - args[1]
+            elif op == "mul":
+                result = args[0] * args[1]
+            elif op == "div":
+                result = args[0] / args[1]
+            elif op == "pow":
+                result = args[0] ** value
+            else:
+                result = _FUNCTIONS[op][0](args[0])
+            results.append(result)
+
+        # Constant components are broadcast to the batch
+        batch_zeros = outputs.new_zeros(outputs.size()[:-1])
+        residual = torch.stack(
+            [results[i] + batch_zeros for i in self._outputs], dim=-1
+        )
+        if return_diagnostics:
+            return residual, (tensors["jacobian"], tensors["laplacian"])
+        else:
+            return residual
+
+
+def compile_residual(residuals, defaults=None):
+    """Compiles a residual specification. See CompiledResidual
+
+    :param residuals: an expression or a list of expressions, one per
+        component of the residual, built from u(), du(), lap_u(), x(), param(),
+        scalar(), numbers, arithmetic operators and the functions of this
+        module
+    :param defaults: optional dictionary of default values of scalars
+    :returns: a CompiledResidual
+    """
+    if isinstance(residuals, (Expr, numbers.Number)):
+        residuals = [residuals]
+    return CompiledResidual(residuals, defaults=defaults)
@@ -2,12 +2,21 @@
 
 import torch
 
-from src.derivatives import jacobian_and_laplacian, divergence
+from src.derivatives import DerivativeContext
+from src.pdes.spec import compile_residual, du, lap_u, scalar, u
 
-__all__ = ["steady_state_turbulence"]
+__all__ = ["steady_state_turbulence", "compiled_steady_state_turbulence"]
 
 
-def steady_state_turbulence(outputs, inputs, nu=0.01, return_diagnostics=False):
+def steady_state_turbulence(
+    outputs,
+    inputs,
+    nu=0.01,
+    return_diagnostics=False,
+    num_probes=None,
+    distribution="rademacher",
+    context=None,
+):
     """Computes the steady-state turbulence PDE value, given that the model
     has inputs x,y,z and outputs v_x, v_y, v_z
     
@@ -16,18 +25,36 @@ def steady_state_turbulence(outputs, inputs, nu=0.01, return_diagnostics=False):
     :param nu: parameter to weight the laplacian of the network
     :param return_diagnostics: whether to return an object containing 
         diagnostics information
+    :param num_probes: if provided, the laplacian is estimated with this many
+        random probes (Hutchinson's estimator) instead of computed exactly. The
+        divergence is always exact, since it is free given the jacobian
+    :param distribution: distribution of the random probes. See
+        src.derivatives.jacobian_and_estimated_laplacian
+    :param context: optional src.derivatives.DerivativeContext shared with
+        any other functions of the same outputs and inputs (and possibly
+        already holding their derivatives)
     :return PDE value (, diagnostics tuple)
     """
 
     batched = len(inputs.size()) > 1
+    if context is None:
+        context = DerivativeContext()
 
-    jac, lap = jacobian_and_laplacian(
-        outputs, inputs, batched=batched, create_graph=True, allow_unused=False
-    )
+    # The exact divergence and laplacian need the full jacobian anyway, so it
+    # is computed once and shared through the context
     # r$ \nabla \cdot u = 0 $
-    div = divergence(outputs, inputs, jacobian=jac, batched=batched)
+    div = context.divergence(outputs, inputs, batched=batched)
+    lap = context.laplacian(
+        outputs,
+        inputs,
+        batched=batched,
+        num_probes=num_probes,
+        distribution=distribution,
+    )
+    jac = context.jacobian(outputs, inputs, batched=batched)
 
-    lhs = torch.einsum("...j,...jk->...k", outputs, jac)
+    # r$ (u \cdot \nabla) u $ is the jacobian-vector product with tangent u
+    lhs = context.jvp(outputs, inputs, outputs, batched=batched)
     rhs = nu * lap
     # r$ u \cdot \nabla u - \nu \nabla^2 u = 0 $
     sst = lhs - rhs
@@ -36,3 +63,18 @@ def steady_state_turbulence(outputs, inputs, nu=0.01, return_diagnostics=False):
         return torch.cat([div.unsqueeze(-1), sst], dim=-1), (lhs, rhs, jac)
     else:
         return torch.cat([div.unsqueeze(-1), sst], dim=-1)
+
+
+# The same equation as a compiled specification, with nu as a keyword argument.
+# The diagonal of the jacobian is shared between the divergence and the
+# convective term. See src.pdes.spec
+compiled_steady_state_turbulence = compile_residual(
+    # r$ \nabla \cdot u = 0 $
+    [sum(du(i, i) for i in range(3))]
+    # r$ u \cdot \nabla u - \nu \nabla^2 u = 0 $
+    + [
+        sum(u(k) * du(j, k) for k in range(3)) - scalar("nu") * lap_u(j)
+        for j in range(3)
+    ],
+    defaults={"nu": 0.01},
+)
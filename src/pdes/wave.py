@@ -3,13 +3,25 @@
 import numpy as np
 import torch
 
-from src.derivatives import jacobian, jacobian_and_laplacian
+from src.derivatives import DerivativeContext
+from src.pdes.spec import compile_residual, du, lap_u, param, u
 
-__all__ = ["helmholtz_equation", "pythagorean_equation"]
+__all__ = [
+    "helmholtz_equation",
+    "pythagorean_equation",
+    "compiled_helmholtz_equation",
+    "compiled_pythagorean_equation",
+]
 
 
 def helmholtz_equation(
-    outputs, inputs, parameterization, return_diagnostics=False
+    outputs,
+    inputs,
+    parameterization,
+    return_diagnostics=False,
+    num_probes=None,
+    distribution="rademacher",
+    context=None,
 ):
     """Computes the Helmholtz equation (time independent wave equation) value, 
     given the model inputs, outputs, and paramerization of the wave
@@ -20,11 +32,25 @@ def helmholtz_equation(
         follow: [amplitude, frequency, phase]
     :param return_diagnostics: whether to return an object containing 
         diagnostics information
+    :param num_probes: if provided, the laplacian is estimated with this many
+        random probes (Hutchinson's estimator) instead of computed exactly
+    :param distribution: distribution of the random probes. See
+        src.derivatives.jacobian_and_estimated_laplacian
+    :param context: optional src.derivatives.DerivativeContext shared with
+        any other functions of the same outputs and inputs (and possibly
+        already holding their derivatives)
     :return PDE value (, diagnostics tuple)
     """
     batched = len(inputs.size()) > 1
-    jac, lap = jacobian_and_laplacian(
-        outputs, inputs, batched=batched, create_graph=True, allow_unused=False
+    if context is None:
+        context = DerivativeContext()
+    jac = context.jacobian(outputs, inputs, batched=batched)
+    lap = context.laplacian(
+        outputs,
+        inputs,
+        batched=batched,
+        num_probes=num_probes,
+        distribution=distribution,
     )
 
     frequency = (2 * np.pi * parameterization[..., 1]).view(outputs.size())
@@ -39,7 +65,7 @@ def helmholtz_equation(
 
 
 def pythagorean_equation(
-    outputs, inputs, parameterization, return_diagnostics=False
+    outputs, inputs, parameterization, return_diagnostics=False, context=None
 ):
     """Computes the Pythagorean equation ((f * y)^2 + (y')^2 = f^2), assuming 
     that the network should satisfy that f * f * y = y'' (Helmholtz)
@@ -50,12 +76,14 @@ def pythagorean_equation(
         follow: [amplitude, frequency, phase]
     :param return_diagnostics: whether to return an object containing 
         diagnostics information
+    :param context: optional src.derivatives.DerivativeContext shared with
+        any other functions of the same outputs and inputs
     :return PDE value (, diagnostics tuple)
     """
     batched = len(inputs.size()) > 1
-    jac = jacobian(
-        outputs, inputs, batched=batched, create_graph=True, allow_unused=False
-    )
+    if context is None:
+        context = DerivativeContext()
+    jac = context.jacobian(outputs, inputs, batched=batched)
 
     frequency = (2 * np.pi * parameterization[..., 1]).view(outputs.size())
     # r$ (f * y)^2 + (y')^2 = 1$
@@ -65,3 +93,17 @@ def pythagorean_equation(
         return lhs - rhs, (lhs, rhs, jac)
     else:
         return lhs - rhs
+
+
+# The same equations as compiled specifications. See src.pdes.spec
+_frequency = 2 * np.pi * param(1)
+
+# r$ \nabla^2 u + k^2 u = 0 $
+compiled_helmholtz_equation = compile_residual(
+    lap_u(0) + _frequency ** 2 * u(0)
+)
+
+# r$ (f * y)^2 + (y')^2 - f^2 = 0 $
+compiled_pythagorean_equation = compile_residual(
+    (_frequency * u(0)) ** 2 + du(0, 0) ** 2 - _frequency ** 2
+)
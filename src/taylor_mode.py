@@ -0,0 +1,123 @@
+"""Tools for propagating the input jacobian and laplacian of a network forward
+alongside its activations ("Taylor mode"). For networks which are stacks of
+linear layers and pointwise activations, this computes the first and second
+derivatives with respect to the input in a single augmented forward pass,
+rather than by repeatedly differentiating through autograd
+
+Throughout, the derivatives of a batch of values of size (batchsize, features)
+with respect to an input of size (batchsize, in_size) are stored as
+    jacobian: (batchsize, features, in_size)
+    laplacian: (batchsize, features)
+"""
+
+import torch
+from torch import autograd
+import torch.nn as nn
+
+__all__ = [
+    "activation_derivatives",
+    "taylor_input",
+    "taylor_linear",
+    "taylor_activation",
+    "taylor_scale",
+]
+
+
+def activation_derivatives(activation, z):
+    """Computes a pointwise activation function and its first and second
+    derivatives. Activations may provide their own derivatives by implementing
+    a method taylor_derivatives(z) -> (value, first, second). Otherwise, any
+    unrecognized activation falls back to (pointwise) autograd
+
+    :param activation: pointwise activation function
+    :param z: input to the activation
+    :returns: activation(z), activation'(z), activation''(z)
+    """
+    if hasattr(activation, "taylor_derivatives"):
+        return activation.taylor_derivatives(z)
+    elif isinstance(activation, nn.Tanh):
+        value = torch.tanh(z)
+        first = 1 - value * value
+        return value, first, -2 * value * first
+    elif isinstance(activation, nn.Sigmoid):
+        value = torch.sigmoid(z)
+        first = value * (1 - value)
+        return value, first, first * (1 - 2 * value)
+    elif isinstance(activation, nn.ReLU):
+        first = (z > 0).to(z.dtype)
+        return torch.relu(z), first, z.new_zeros(z.size())
+    elif isinstance(activation, nn.LeakyReLU):
+        positive = (z > 0).to(z.dtype)
+        first = positive + activation.negative_slope * (1 - positive)
+        return activation(z), first, z.new_zeros(z.size())
+    else:
+        # Since the activation is pointwise, the derivative of the sum gives
+        # the elementwise derivatives
+        if not z.requires_grad:
+            z = z.requires_grad_()
+        value = activation(z)
+        first = autograd.grad(torch.sum(value), z, create_graph=True)[0]
+        second = autograd.grad(
+            torch.sum(first), z, create_graph=True, allow_unused=True
+        )[0]
+        if second is None:
+            second = z.new_zeros(z.size())
+        return value, first, second
+
+
+def taylor_input(xb):
+    """Initializes the derivatives of the input with respect to itself
+
+    :param xb: input tensor of size (batchsize, in_size)
+    :returns: xb, jacobian, laplacian
+    """
+    batchsize, in_size = xb.size()
+    jac = torch.eye(in_size, dtype=xb.dtype, device=xb.device).expand(
+        batchsize, in_size, in_size
+    )
+    lap = xb.new_zeros(xb.size())
+    return xb, jac, lap
+
+
+def taylor_linear(layer, value, jac, lap):
+    """Applies a linear layer to the value and its derivatives
+
+    :param layer: an nn.Linear layer
+    :param value: input to the layer. Size (batchsize, in_features)
+    :param jac: jacobian of the input. Size (batchsize, in_features, in_size)
+    :param lap: laplacian of the input. Size (batchsize, in_features)
+    :returns: value, jacobian, laplacian of the layer output
+    """
+    value = layer(value)
+    jac = torch.einsum("oi,bid->bod", layer.weight, jac)
+    lap = torch.einsum("oi,bi->bo", layer.weight, lap)
+    return value, jac, lap
+
+
+def taylor_activation(activation, value, jac, lap):
+    """Applies a pointwise activation to the value and its derivatives
+
+    :param activation: a pointwise activation function
+    :param value: input to the activation. Size (batchsize, features)
+    :param jac: jacobian of the input. Size (batchsize, features, in_size)
+    :param lap: laplacian of the input. Size (batchsize, features)
+    :returns: value, jacobian, laplacian of the activation output
+    """
+    value, first, second = activation_derivatives(activation, value)
+    # r$ \nabla^2 f(z) = f''(z) |\nabla z|^2 + f'(z) \nabla^2 z $
+    lap = second * torch.sum(jac * jac, dim=-1) + first * lap
+    jac = first.unsqueeze(-1) * jac
+    return value, jac, lap
+
+
+def taylor_scale(scale, value, jac, lap):
+    """Multiplies the value and its derivatives by a scaling which is constant
+    with respect to the input
+
+    :param scale: scaling of size (batchsize, features)
+    :param value: value of size (batchsize, features)
+    :param jac: jacobian of the value. Size (batchsize, features, in_size)
+    :param lap: laplacian of the value. Size (batchsize, features)
+    :returns: value, jacobian, laplacian of the scaled value
+    """
+    return scale * value, scale.unsqueeze(-1) * jac, scale * lap
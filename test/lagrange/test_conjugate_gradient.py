@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+import torch
+
+from src.lagrange.conjugate_gradient import compute_cg_multipliers
+from src.lagrange.exact import compute_exact_multipliers
+
+
+def test_compute_cg_multipliers():
+
+    rand_size = np.random.randint(4, 10)
+    num_constraints = np.random.randint(1, 4)
+
+    ins = torch.rand(rand_size, requires_grad=True)
+    other = torch.rand(3, requires_grad=True)
+    factor = torch.rand(num_constraints, rand_size)
+    loss = torch.sum(ins ** 2) + torch.sum(other)
+    constraints = torch.sin(factor @ ins)
+
+    expected = compute_exact_multipliers(loss, constraints, [ins, other])
+    multipliers, timing = compute_cg_multipliers(
+        loss, constraints, [ins, other], return_timing=True, warn="error"
+    )
+    assert multipliers.size() == constraints.size()
+    assert torch.allclose(multipliers, expected, rtol=1e-3, atol=1e-4)
+    assert not timing["multipliers: errored"]
+
+    # Warm-starting from the solution converges immediately
+    multipliers, timing = compute_cg_multipliers(
+        loss,
+        constraints,
+        [ins, other],
+        return_timing=True,
+        tolerance=1e-3,
+        initial_multipliers=expected,
+    )
+    assert timing["multipliers: conjugate gradient iterations"] == 0
+
+    # Unused parameters
+    unused = torch.rand(2, requires_grad=True)
+    multipliers = compute_cg_multipliers(
+        loss, constraints, [ins, other, unused], allow_unused=True
+    )
+    assert torch.allclose(multipliers, expected, rtol=1e-3, atol=1e-4)
+
+    # The loss must be reduced
+    with pytest.raises(ValueError):
+        compute_cg_multipliers(ins, constraints, [ins])
@@ -2,7 +2,9 @@ import numpy as np
 import pytest
 import torch
 
+from src.lagrange import exact
 from src.lagrange.exact import compute_exact_multipliers
+from src.lagrange.linalg import _selected_solve
 
 
 def test_compute_exact_multipliers():
@@ -90,3 +92,147 @@ def test_compute_exact_multipliers():
         multipliers = compute_exact_multipliers(
             loss, constraint, [ins], warn="error"
         )
+
+
+def test_compute_exact_multipliers_chunked():
+
+    rand_size = np.random.randint(2, 10)
+    batch_size = np.random.randint(2, 10)
+
+    ins = torch.rand(batch_size, rand_size, requires_grad=True)
+    loss = torch.sum(ins ** 2, dim=-1)
+    constraint = torch.sin(ins[:, :2])
+
+    expected = compute_exact_multipliers(loss, constraint, [ins])
+    multipliers, timing = compute_exact_multipliers(
+        loss, constraint, [ins], return_timing=True, chunk_size=1
+    )
+    assert torch.allclose(multipliers, expected)
+    # The increase of the peak resident memory of the process on the CPU
+    assert timing["multipliers: peak memory (bytes)"] >= 0
+    # The loss and constraint jacobians are computed in a single pass, which
+    # has no separate timings
+    assert timing["multipliers: compute jacobians"] >= 0
+    assert "multipliers: compute loss jacobian" not in timing
+    assert "multipliers: compute constraint jacobian" not in timing
+
+
+def test_compute_exact_multipliers_graph_free():
+
+    rand_size = np.random.randint(2, 10)
+    batch_size = np.random.randint(2, 10)
+
+    ins = torch.rand(batch_size, rand_size, requires_grad=True)
+    loss = torch.sum(ins ** 3, dim=-1)
+    constraint = torch.sin(ins[:, :2])
+
+    expected = compute_exact_multipliers(loss, constraint, [ins])
+    assert expected.requires_grad
+    multipliers = compute_exact_multipliers(
+        loss, constraint, [ins], create_graph=False
+    )
+    assert not multipliers.requires_grad
+    assert torch.allclose(multipliers, expected)
+
+
+def test_compute_exact_multipliers_fallback():
+
+    rand_size = np.random.randint(2, 10)
+    batch_size = np.random.randint(2, 10)
+
+    # Duplicated constraints have a singular gram matrix. The minimum norm
+    # solution splits the multiplier of a single constraint evenly
+    ins = torch.rand(batch_size, rand_size, requires_grad=True)
+    loss = torch.sum(ins, dim=-1)
+    single = compute_exact_multipliers(loss, ins[:, 0], [ins])
+    constraint = torch.stack([ins[:, 0], ins[:, 0]], dim=-1)
+    multipliers, timing = compute_exact_multipliers(
+        loss, constraint, [ins], return_timing=True, warn=False
+    )
+    assert timing["multipliers: errored"]
+    assert multipliers.size() == constraint.size()
+    assert torch.allclose(
+        multipliers, (single / 2).unsqueeze(-1).expand(-1, 2), atol=1e-5
+    )
+
+
+def test_compute_exact_multipliers_error(monkeypatch):
+
+    def failing_eig(matrix):
+        assert False, "The eigendecomposition should not be computed"
+
+    monkeypatch.setattr(exact, "_symmetric_eig", failing_eig)
+
+    # The singular gram matrix raises before any diagnostics are computed
+    ins = torch.rand(3, 4, requires_grad=True)
+    loss = torch.sum(ins, dim=-1)
+    constraint = torch.stack([ins[:, 0], ins[:, 0]], dim=-1)
+    with pytest.raises(RuntimeError):
+        compute_exact_multipliers(
+            loss, constraint, [ins], warn="error", closed_form=False
+        )
+
+
+def test_compute_exact_multipliers_selection():
+
+    rand_size = np.random.randint(2, 10)
+    batch_size = np.random.randint(2, 10)
+
+    # Only one of each pair of duplicated constraints is kept
+    ins = torch.rand(batch_size, rand_size, requires_grad=True)
+    loss = torch.sum(ins, dim=-1)
+    single = compute_exact_multipliers(loss, ins[:, 0], [ins])
+    constraint = torch.stack([ins[:, 0], ins[:, 0]], dim=-1)
+    multipliers, timing = compute_exact_multipliers(
+        loss,
+        constraint,
+        [ins],
+        return_timing=True,
+        select_constraints=True,
+    )
+    assert not timing["multipliers: errored"]
+    assert timing["multipliers: mean kept constraints per sample"] == 1
+    assert torch.allclose(torch.sum(multipliers, dim=-1), single, atol=1e-5)
+    assert torch.all(torch.min(torch.abs(multipliers), dim=-1)[0] == 0)
+
+
+def test_selected_solve():
+
+    # Samples of different rank are pivoted together
+    jac = torch.rand(3, 4, 6, dtype=torch.float64)
+    jac[1, 2] = 2 * jac[1, 0]
+    jac[2, 1:] = jac[2, :1]
+    gram = jac @ jac.transpose(-1, -2)
+    rhs = torch.rand(3, 4, 1, dtype=torch.float64)
+    solution, kept = _selected_solve(gram, rhs, 1e-8)
+    assert kept.tolist() == [4, 3, 1]
+    assert torch.allclose(
+        solution[0], torch.cholesky_solve(rhs[:1], torch.cholesky(gram[:1]))[0]
+    )
+    # Every sample solves the system of its kept rows exactly
+    for i, num_kept in enumerate(kept.tolist()):
+        rows = torch.nonzero(solution[i, :, 0]).view(-1)
+        assert len(rows) == num_kept
+        assert torch.allclose(
+            gram[i][rows][:, rows] @ solution[i, rows], rhs[i, rows]
+        )
+
+
+def test_compute_exact_multipliers_closed_form():
+
+    rand_size = np.random.randint(4, 10)
+    batch_size = np.random.randint(2, 10)
+
+    ins = torch.rand(batch_size, rand_size, requires_grad=True)
+    loss = torch.sum(ins ** 2, dim=-1)
+    for num_constraints in [1, 2, 3]:
+        constraint = torch.sin(ins[:, :num_constraints])
+        expected = compute_exact_multipliers(
+            loss, constraint, [ins], closed_form=False
+        )
+        multipliers, timing = compute_exact_multipliers(
+            loss, constraint, [ins], return_timing=True
+        )
+        assert torch.allclose(multipliers, expected, rtol=1e-4, atol=1e-5)
+        assert timing["multipliers: closed-form solve"] >= 0
+        assert timing["multipliers: cholesky"] == -999.0
@@ -0,0 +1,47 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from src.lagrange.loss_constraining import constrain_loss
+from src.lagrange.parameter_selection import select_parameters
+
+
+def test_select_parameters():
+
+    model = nn.Sequential(
+        nn.Linear(2, 5), nn.Tanh(), nn.Linear(5, 5), nn.Tanh(), nn.Linear(5, 1)
+    )
+    parameters = list(model.parameters())
+
+    assert select_parameters(model) == parameters
+    assert select_parameters(model, "2") == parameters[2:4]
+    assert select_parameters(model, ["2", "4"]) == parameters[-4:]
+    assert select_parameters(model, ["0", "4.bias"]) == [
+        parameters[0],
+        parameters[1],
+        parameters[5],
+    ]
+    assert select_parameters(
+        model.named_parameters(), lambda name, param: "weight" in name
+    ) == parameters[::2]
+    with pytest.raises(ValueError):
+        select_parameters(model, "missing")
+    # Layers are selected by name, not by position
+    with pytest.raises(ValueError):
+        select_parameters(model, 1)
+    # Names are needed to select the parameters
+    with pytest.raises(TypeError):
+        select_parameters(model.parameters(), "2")
+    with pytest.raises(TypeError):
+        select_parameters([(parameters[0], parameters[1])])
+
+    # Only the selected parameters enter the multipliers
+    ins = torch.rand(7, 2)
+    out = model(ins)
+    loss = torch.sum(out ** 2, dim=-1)
+    constraints = torch.sin(out)
+    expected = constrain_loss(loss, constraints, parameters[-2:])
+    constrained_loss = constrain_loss(
+        loss, constraints, model.named_parameters(), parameter_selector="4"
+    )
+    assert torch.allclose(constrained_loss, expected)
@@ -0,0 +1,192 @@
+import numpy as np
+import torch
+import torch.nn as nn
+
+from src.derivatives import jacobian
+from src.lagrange.exact import compute_exact_multipliers
+from src.lagrange.per_sample import PerSampleGradients
+
+
+def test_per_sample_gradients():
+
+    batch_size = np.random.randint(2, 10)
+    in_size = np.random.randint(1, 5)
+    out_size = np.random.randint(2, 5)
+
+    model = nn.Sequential(
+        nn.Linear(in_size, 7), nn.Tanh(), nn.Linear(7, out_size)
+    )
+    parameters = list(model.parameters())
+    assert PerSampleGradients.supports_model(model)
+    assert not PerSampleGradients.supports_model(
+        nn.Sequential(nn.Linear(in_size, 7), nn.BatchNorm1d(7))
+    )
+    per_sample_gradients = PerSampleGradients(model)
+
+    ins = torch.rand(batch_size, in_size, requires_grad=True)
+    per_sample_gradients.start()
+    out = model(ins)
+    per_sample_gradients.stop()
+
+    # batched scalars and batched vectors
+    for y in [torch.sum(out ** 2, dim=-1), out]:
+        expected = jacobian(y, parameters, batched=False)
+        jacs = per_sample_gradients.jacobian(y, parameters)
+        assert jacs is not None
+        for jac, exp in zip(jacs, expected):
+            assert jac.size() == exp.size()
+            assert torch.allclose(jac, exp, atol=1e-6)
+
+    # The weights also appear in the derivatives w.r.t. the inputs
+    jac_x = jacobian(out[:, 0], ins, batched=True, create_graph=True)
+    assert per_sample_gradients.jacobian(jac_x, parameters) is None
+
+    # Parameters used outside of the layers are detected in any column, not
+    # only in the first
+    y = torch.stack(
+        [out[:, 0], out[:, 1] + torch.sum(parameters[0] ** 2)], dim=-1
+    )
+    assert per_sample_gradients.jacobian(y, parameters) is None
+
+    # Unrecorded forward passes are not recorded, but any tensor may depend on
+    # them, so everything is rejected until recording restarts
+    model(ins)
+    assert len(per_sample_gradients._records) == 2
+    assert per_sample_gradients.unrecorded_calls == 2
+    assert per_sample_gradients.jacobian(out, parameters) is None
+    per_sample_gradients.start()
+    out = model(ins)
+    per_sample_gradients.stop()
+
+    # The multipliers are unchanged
+    loss = torch.sum((out - 1) ** 2, dim=-1)
+    constraints = out[:, :2]
+    expected = compute_exact_multipliers(loss, constraints, parameters)
+    multipliers = compute_exact_multipliers(
+        loss,
+        constraints,
+        parameters,
+        per_sample_gradients=per_sample_gradients,
+    )
+    assert torch.allclose(multipliers, expected, atol=1e-5)
+
+    per_sample_gradients.remove()
+    per_sample_gradients.start()
+    model(ins)
+    assert len(per_sample_gradients._records) == 0
+
+
+def test_linear_gram_matrix():
+
+    batch_size = np.random.randint(2, 10)
+    in_size = np.random.randint(1, 5)
+
+    model = nn.Sequential(nn.Linear(in_size, 7), nn.Tanh(), nn.Linear(7, 3))
+    parameters = list(model.parameters())
+    per_sample_gradients = PerSampleGradients(model)
+
+    ins = torch.rand(batch_size, in_size)
+    per_sample_gradients.start()
+    # The first layer is called twice on the same batch
+    out = model(ins) + model[0](ins ** 2).sum(dim=-1, keepdim=True)
+    per_sample_gradients.stop()
+    loss = torch.sum((out - 1) ** 2, dim=-1)
+    constraints = torch.sin(out[:, :2])
+
+    # Batched gram matrices
+    jac_g = torch.cat(
+        [
+            jac.reshape(batch_size, 2, -1)
+            for jac in jacobian(constraints, parameters)
+        ],
+        dim=-1,
+    )
+    jac_f = torch.cat(
+        [jac.reshape(batch_size, -1) for jac in jacobian(loss, parameters)],
+        dim=-1,
+    )
+    gram, cross = per_sample_gradients.gram_matrix(
+        loss, constraints, parameters
+    )
+    assert torch.allclose(
+        gram, torch.einsum("bij,bkj->bik", jac_g, jac_g), atol=1e-5
+    )
+    assert torch.allclose(
+        cross, torch.einsum("bij,bj->bi", jac_g, jac_f), atol=1e-5
+    )
+
+    # Batchwise gram matrix
+    mean_loss = torch.mean(loss)
+    flat_constraints = constraints.view(1, -1)
+    jac_g = torch.cat(
+        [
+            jac.reshape(flat_constraints.numel(), -1)
+            for jac in jacobian(flat_constraints, parameters)
+        ],
+        dim=-1,
+    )
+    jac_f = torch.cat(
+        [jac.reshape(-1) for jac in jacobian(mean_loss, parameters)], dim=-1
+    )
+    gram, cross = per_sample_gradients.gram_matrix(
+        mean_loss.view(1), flat_constraints, parameters
+    )
+    assert torch.allclose(gram[0], jac_g @ jac_g.t(), atol=1e-5)
+    assert torch.allclose(cross[0], jac_g @ jac_f, atol=1e-5)
+
+    # The multipliers are unchanged
+    expected = compute_exact_multipliers(loss, constraints, parameters)
+    multipliers, timing = compute_exact_multipliers(
+        loss,
+        constraints,
+        parameters,
+        return_timing=True,
+        per_sample_gradients=per_sample_gradients,
+        linear_gram=True,
+    )
+    assert timing["multipliers: compute constraint jacobian"] == -999.0
+    assert torch.allclose(multipliers, expected, atol=1e-4)
+
+
+def test_per_sample_loss_jacobian():
+
+    batch_size = np.random.randint(2, 10)
+
+    model = nn.Sequential(nn.Linear(1, 7), nn.Tanh(), nn.Linear(7, 1))
+    parameters = list(model.parameters())
+    per_sample_gradients = PerSampleGradients(model)
+
+    ins = torch.rand(batch_size, 1, requires_grad=True)
+    per_sample_gradients.start()
+    out = model(ins)
+    per_sample_gradients.stop()
+    loss = torch.sum((out - 1) ** 2, dim=-1)
+    # The constraint differentiates the model w.r.t. its inputs
+    constraints = jacobian(out, ins, batched=True, create_graph=True).view(
+        batch_size, 1
+    ) - 1
+
+    # Record which jacobians used the per-sample gradients
+    used = list()
+    per_sample_jacobian = per_sample_gradients.jacobian
+
+    def recording_jacobian(y, parameters, create_graph=False):
+        jacs = per_sample_jacobian(y, parameters, create_graph=create_graph)
+        used.append(jacs is not None)
+        return jacs
+
+    per_sample_gradients.jacobian = recording_jacobian
+
+    expected = compute_exact_multipliers(loss, constraints, parameters)
+    multipliers, timing = compute_exact_multipliers(
+        loss,
+        constraints,
+        parameters,
+        return_timing=True,
+        per_sample_gradients=per_sample_gradients,
+    )
+    assert torch.allclose(multipliers, expected, atol=1e-4)
+    # The loss keeps its fast path even though the constraints can't use it
+    assert used == [True, False]
+    assert timing["multipliers: compute loss jacobian"] >= 0
+    assert timing["multipliers: compute constraint jacobian"] >= 0
@@ -0,0 +1,61 @@
+import numpy as np
+import torch
+import torch.nn as nn
+
+from src.lagrange.loss_constraining import constrain_loss
+from src.lagrange.projected_optimizer import (
+    ProjectedOptimizer,
+    compute_projected_gradients,
+)
+
+
+def test_compute_projected_gradients():
+
+    batch_size = np.random.randint(2, 10)
+    in_size = np.random.randint(1, 5)
+
+    model = nn.Sequential(nn.Linear(in_size, 7), nn.Tanh(), nn.Linear(7, 3))
+    parameters = list(model.parameters())
+
+    ins = torch.rand(batch_size, in_size)
+    out = model(ins)
+    loss = torch.sum((out - 1) ** 2, dim=-1)
+    constraints = torch.sin(out[:, :2])
+
+    for kwargs in [dict(), {"batchwise": True}]:
+        model.zero_grad()
+        constrained_loss, expected_multipliers = constrain_loss(
+            loss, constraints, parameters, return_multipliers=True, **kwargs
+        )
+        torch.mean(constrained_loss).backward(retain_graph=True)
+        expected = [param.grad.clone() for param in parameters]
+
+        gradients, multipliers = compute_projected_gradients(
+            loss, constraints, parameters, **kwargs
+        )
+        assert torch.allclose(multipliers, expected_multipliers, atol=1e-5)
+        for gradient, exp in zip(gradients, expected):
+            assert gradient.size() == exp.size()
+            assert torch.allclose(gradient, exp, atol=1e-5)
+
+
+def test_projected_optimizer():
+
+    ins = torch.rand(5, 4)
+    model = nn.Linear(4, 3)
+    optimizer = ProjectedOptimizer(
+        torch.optim.SGD(model.parameters(), lr=0.5)
+    )
+
+    # The loss is projected out of the direction of a linear constraint, whose
+    # violation is halved by every step
+    target = torch.rand(1)
+    for __ in range(20):
+        optimizer.zero_grad()
+        out = model(ins)
+        loss = torch.mean(out ** 2).view(1)
+        constraints = (torch.sum(out) - target).view(1, 1)
+        optimizer.step(loss, constraints)
+    out = model(ins)
+    assert torch.allclose(torch.sum(out), target, atol=1e-2)
+    assert len(optimizer.state_dict()["param_groups"]) == 1
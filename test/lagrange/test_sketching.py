@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+import torch
+
+from src.lagrange.exact import compute_exact_multipliers
+from src.lagrange.sketching import compute_sketched_multipliers
+
+
+def test_compute_sketched_multipliers():
+
+    rand_size = np.random.randint(4, 10)
+    batch_size = np.random.randint(2, 10)
+
+    ins = torch.rand(batch_size, rand_size, requires_grad=True)
+    factor = torch.rand(rand_size, 2)
+    loss = torch.sum(ins ** 2, dim=-1)
+    constraints = torch.sin(ins @ factor)
+    expected = compute_exact_multipliers(loss, constraints, [ins])
+
+    # Subsampling every parameter is exact
+    multipliers = compute_sketched_multipliers(
+        loss,
+        constraints,
+        [ins],
+        sketch_size=batch_size * rand_size,
+        sketch="subsample",
+    )
+    assert multipliers.size() == constraints.size()
+    assert torch.allclose(multipliers, expected, rtol=1e-4, atol=1e-5)
+
+    # Gaussian sketches converge as the sketch grows
+    torch.manual_seed(0)
+    errors = list()
+    for sketch_size in [20, 5000]:
+        multipliers = compute_sketched_multipliers(
+            loss, constraints, [ins], sketch_size=sketch_size, warn=False
+        )
+        errors.append(torch.norm(multipliers - expected) / torch.norm(expected))
+    assert errors[-1] < errors[0]
+    assert errors[-1] < 0.1
+
+    with pytest.raises(ValueError):
+        compute_sketched_multipliers(loss, constraints, [ins], sketch="other")
@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+import torch
+
+from src.lagrange.exact import compute_exact_multipliers
+from src.lagrange.linalg import _pseudoinverse_solve, _symmetric_eig
+from src.lagrange.structured import solve_structured_gram
+
+
+def test_solve_structured_gram():
+
+    block_size = np.random.randint(1, 4)
+    num_blocks = np.random.randint(2, 6)
+    n = block_size * num_blocks
+    rhs = torch.rand(1, n, 1, dtype=torch.float64)
+
+    # Full rank and coupled between blocks
+    jac = torch.rand(1, n, n + 5, dtype=torch.float64)
+    gram = jac @ jac.transpose(-1, -2)
+    expected = torch.cholesky_solve(rhs, torch.cholesky(gram))
+    solution, info = solve_structured_gram(
+        rhs, jac_g=jac, block_size=block_size
+    )
+    assert info["structure"] == "block-preconditioned"
+    assert torch.allclose(solution, expected, atol=1e-5)
+    # The same as with the gram matrix itself
+    solution, info = solve_structured_gram(
+        rhs, gram_matrix=gram, block_size=block_size
+    )
+    assert info["structure"] == "block-preconditioned"
+    assert torch.allclose(solution, expected, atol=1e-5)
+
+    # Fewer parameters than constraints
+    jac = torch.rand(1, n, n - 1, dtype=torch.float64)
+    gram = jac @ jac.transpose(-1, -2)
+    eigenvalues, eigenvectors = _symmetric_eig(gram)
+    expected = _pseudoinverse_solve(eigenvalues, eigenvectors, rhs)
+    solution, info = solve_structured_gram(
+        rhs, jac_g=jac, block_size=block_size
+    )
+    assert info["structure"] == "low-rank"
+    assert torch.allclose(solution, expected, atol=1e-5)
+
+    # Block diagonal, i.e. the blocks of constraints depend on disjoint
+    # parameters
+    num_block_parameters = block_size + 2
+    jac = torch.zeros(1, n, num_blocks * num_block_parameters).double()
+    for i in range(num_blocks):
+        rows = slice(i * block_size, (i + 1) * block_size)
+        columns = slice(
+            i * num_block_parameters, (i + 1) * num_block_parameters
+        )
+        jac[0, rows, columns] = torch.rand(block_size, num_block_parameters)
+    gram = jac @ jac.transpose(-1, -2)
+    expected = torch.cholesky_solve(rhs, torch.cholesky(gram))
+    solution, info = solve_structured_gram(
+        rhs, jac_g=jac, block_size=block_size
+    )
+    assert info["structure"] == "block-diagonal"
+    assert info["block_residual"] < 1e-10
+    assert info["iterations"] == 0
+    assert torch.allclose(solution, expected, atol=1e-5)
+
+    # Nearly block diagonal: the small coupling is not dropped
+    gram = gram + torch.eye(n, dtype=torch.float64)
+    coupling = torch.rand(1, n, n, dtype=torch.float64)
+    coupling = 1e-5 * (coupling + coupling.transpose(-1, -2))
+    gram = gram + coupling
+    expected = torch.cholesky_solve(rhs, torch.cholesky(gram))
+    solution, info = solve_structured_gram(
+        rhs, gram_matrix=gram, block_size=block_size, tolerance=1e-10
+    )
+    assert info["structure"] == "block-diagonal"
+    assert info["block_residual"] > 0
+    assert torch.allclose(solution, expected, rtol=1e-8, atol=1e-10)
+
+    with pytest.raises(ValueError):
+        solve_structured_gram(rhs)
+
+
+def test_compute_exact_multipliers_structured():
+
+    batch_size = np.random.randint(2, 10)
+
+    ins = torch.rand(batch_size, 3, dtype=torch.float64)
+    weight = torch.rand(3, 20, dtype=torch.float64, requires_grad=True)
+    output_weight = torch.rand(20, 2, dtype=torch.float64, requires_grad=True)
+    out = torch.tanh(ins @ weight) @ output_weight
+    loss = torch.mean(out ** 2).view(1)
+    constraints = torch.sin(out).view(1, -1)
+    parameters = [weight, output_weight]
+
+    expected = compute_exact_multipliers(loss, constraints, parameters)
+    multipliers, timing = compute_exact_multipliers(
+        loss,
+        constraints,
+        parameters,
+        return_timing=True,
+        gram_solver="structured",
+        block_size=2,
+    )
+    assert torch.allclose(multipliers, expected, rtol=1e-3, atol=1e-4)
+    assert timing["multipliers: structured solve"] >= 0
+    assert timing["multipliers: cholesky"] == -999.0
+    # The gram matrix is never formed
+    assert timing["multipliers: compute gram matrix"] == -999.0
+    # 100 parameters for 2 * batch_size <= 18 constraints
+    assert timing["multipliers: block-preconditioned structure"] or timing[
+        "multipliers: block-diagonal structure"
+    ]
+    assert not timing["multipliers: low-rank structure"]
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+import torch
+
+from src.lagrange.exact import compute_exact_multipliers
+from src.lagrange.warm_start import (
+    Warm_Start_State,
+    compute_warm_started_multipliers,
+)
+
+
+def test_compute_warm_started_multipliers():
+
+    rand_size = np.random.randint(4, 10)
+    num_constraints = np.random.randint(1, 4)
+
+    ins = torch.rand(rand_size, requires_grad=True)
+    factor = torch.rand(num_constraints, rand_size)
+
+    def problem():
+        loss = torch.sum(ins ** 2)
+        constraints = torch.sin(factor @ ins)
+        return loss, constraints
+
+    state = Warm_Start_State(
+        refresh_interval=5, max_corrections=5, min_constraints=1
+    )
+
+    # The first step is always exact
+    loss, constraints = problem()
+    expected = compute_exact_multipliers(loss, constraints, [ins])
+    multipliers, timing = compute_warm_started_multipliers(
+        loss, constraints, [ins], state, return_timing=True
+    )
+    assert multipliers.size() == constraints.size()
+    assert timing["multipliers: refreshed"]
+    assert torch.allclose(multipliers, expected, rtol=1e-3, atol=1e-4)
+
+    # Small steps are corrected without recomputing
+    with torch.no_grad():
+        ins.add_(1e-3 * torch.rand(rand_size))
+    loss, constraints = problem()
+    expected = compute_exact_multipliers(loss, constraints, [ins])
+    multipliers, timing = compute_warm_started_multipliers(
+        loss, constraints, [ins], state, return_timing=True
+    )
+    assert not timing["multipliers: refreshed"]
+    assert torch.allclose(multipliers, expected, rtol=1e-2, atol=1e-3)
+
+    # Resetting forces a recomputation
+    state.reset()
+    __, timing = compute_warm_started_multipliers(
+        loss, constraints, [ins], state, return_timing=True
+    )
+    assert timing["multipliers: refreshed"]
+
+    # Few constraints are always recomputed exactly
+    state = Warm_Start_State(min_constraints=num_constraints + 1)
+    for __ in range(2):
+        multipliers, timing = compute_warm_started_multipliers(
+            loss, constraints, [ins], state, return_timing=True
+        )
+        assert timing["multipliers: refreshed"]
+    assert torch.allclose(multipliers, expected, rtol=1e-3, atol=1e-4)
+
+    # The loss must be reduced
+    with pytest.raises(ValueError):
+        compute_warm_started_multipliers(ins, constraints, [ins], state)
@@ -0,0 +1,82 @@
+import torch
+
+from src.derivatives import DerivativeContext
+from src.pdes import (
+    compiled_helmholtz_equation,
+    compiled_pythagorean_equation,
+    compiled_steady_state_turbulence,
+    helmholtz_equation,
+    pythagorean_equation,
+    steady_state_turbulence,
+)
+from src.pdes.spec import compile_residual, du, lap_u, sin, u, x
+
+
+def test_compile_residual_common_subexpressions():
+
+    # Structurally identical subexpressions (up to the order of commutative
+    # operands) are evaluated only once
+    residual = compile_residual(
+        [u(0) * du(0, 0) + sin(x(0)), sin(x(0)) + du(0, 0) * u(0)]
+    )
+    # u, du, x, mul, sin, add
+    assert len(residual) == 6
+    assert residual.needs_jacobian
+    assert not residual.needs_laplacian
+
+    xb = torch.rand(4, 1, requires_grad=True)
+    out = xb ** 2
+    value = residual(out, xb)
+    expected = out * 2 * xb + torch.sin(xb)
+    assert value.size() == (4, 2)
+    assert torch.allclose(value, torch.cat([expected, expected], dim=-1))
+
+
+def test_compiled_wave_equations():
+
+    xb = torch.rand(5, 1, requires_grad=True)
+    parameterization = torch.rand(5, 3)
+    out = torch.sin(3 * xb) * xb
+
+    assert torch.allclose(
+        compiled_helmholtz_equation(out, xb, parameterization),
+        helmholtz_equation(out, xb, parameterization),
+        atol=1e-5,
+    )
+    assert torch.allclose(
+        compiled_pythagorean_equation(out, xb, parameterization),
+        pythagorean_equation(out, xb, parameterization),
+        atol=1e-5,
+    )
+
+    # unbatched
+    xb = torch.rand(1, requires_grad=True)
+    out = torch.sin(3 * xb) * xb
+    assert torch.allclose(
+        compiled_helmholtz_equation(out, xb, parameterization[0]),
+        helmholtz_equation(out, xb, parameterization[0]),
+        atol=1e-5,
+    )
+
+
+def test_compiled_steady_state_turbulence():
+
+    xb = torch.rand(5, 3, requires_grad=True)
+    x0, x1, x2 = xb[:, 0], xb[:, 1], xb[:, 2]
+    out = torch.stack([x1 * x2, x0 * x2 ** 2, torch.sin(x0) * x1], dim=-1)
+
+    context = DerivativeContext()
+    value, (jac, lap) = compiled_steady_state_turbulence(
+        out, xb, nu=0.1, return_diagnostics=True, context=context
+    )
+    assert value.size() == (5, 4)
+    # The derivatives were shared through the context
+    assert context.jacobian(out, xb) is jac
+    assert torch.allclose(
+        value, steady_state_turbulence(out, xb, nu=0.1), atol=1e-5
+    )
+    assert torch.allclose(
+        compiled_steady_state_turbulence(out, xb),
+        steady_state_turbulence(out, xb),
+        atol=1e-5,
+    )
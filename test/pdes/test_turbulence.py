@@ -21,3 +21,24 @@ def test_steady_state_turbulence():
 
     assert torch.allclose(single_loss, batch_loss)
     assert torch.allclose(batch_loss, very_batch_loss)
+
+
+def test_steady_state_turbulence_convection():
+
+    # u = (x1 x2, x0 x2, x0^2) has
+    # (u . grad) u = (x0 x2^2 + x1 x0^2, x1 x2^2 + x0^3, 2 x0 x1 x2)
+    xb = torch.rand(5, 3, requires_grad=True)
+    x0, x1, x2 = xb[:, 0], xb[:, 1], xb[:, 2]
+    out = torch.stack([x1 * x2, x0 * x2, x0 ** 2], dim=-1)
+    __, (lhs, __, __) = steady_state_turbulence(
+        out, xb, return_diagnostics=True
+    )
+    expected = torch.stack(
+        [
+            x0 * x2 ** 2 + x1 * x0 ** 2,
+            x1 * x2 ** 2 + x0 ** 3,
+            2 * x0 * x1 * x2,
+        ],
+        dim=-1,
+    )
+    assert torch.allclose(lhs, expected, atol=1e-6)
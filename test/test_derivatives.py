@@ -1,7 +1,18 @@
 import numpy as np
 import torch
 
-from src.derivatives import jacobian, trace
+from src.derivatives import (
+    DerivativeContext,
+    divergence,
+    estimate_divergence,
+    finite_difference_jacobian_and_laplacian,
+    jacobian,
+    jacobian_and_hessian,
+    jacobian_and_laplacian,
+    jacobian_and_estimated_laplacian,
+    jvp,
+    trace,
+)
 
 
 def test_jacobian():
@@ -102,3 +113,260 @@ def test_trace():
     ans = trace(ins)
     for b in range(batchsize):
         assert torch.allclose(ans[b], trc)
+
+
+def test_vectorized_jacobian():
+
+    batchsize = int(np.random.randint(1, 10))
+    rand_lengths = np.random.randint(1, 7, 3)
+
+    # Unbatched
+    ins = torch.rand(tuple(list(rand_lengths)), requires_grad=True)
+    out = torch.sin(ins).sum(dim=-1) * torch.cos(ins[..., 0])
+    vec_jac = jacobian(out, ins, vectorize=True)
+    loop_jac = jacobian(out, ins, vectorize=False)
+    assert vec_jac.size() == loop_jac.size()
+    assert torch.allclose(vec_jac, loop_jac)
+
+    # Batched
+    ins = torch.rand(
+        batchsize, *tuple(list(rand_lengths)), requires_grad=True
+    )
+    out = torch.sin(ins).sum(dim=-1) * torch.cos(ins[..., 0])
+    vec_jac = jacobian(out, ins, batched=True, vectorize=True)
+    loop_jac = jacobian(out, ins, batched=True, vectorize=False)
+    assert vec_jac.size() == loop_jac.size()
+    assert torch.allclose(vec_jac, loop_jac)
+
+    # Differentiable and with lists
+    vec_jacs = jacobian(
+        out, [ins, ins], batched=True, create_graph=True, vectorize=True
+    )
+    loop_jacs = jacobian(
+        out, [ins, ins], batched=True, create_graph=True, vectorize=False
+    )
+    for vec_jac, loop_jac in zip(vec_jacs, loop_jacs):
+        assert vec_jac.requires_grad
+        assert torch.allclose(vec_jac, loop_jac)
+
+
+def test_forward_jacobian():
+
+    batchsize = int(np.random.randint(1, 10))
+    rand_lengths = np.random.randint(1, 7, 2)
+    factor = torch.rand(tuple(list(rand_lengths)))
+
+    # Unbatched
+    ins = torch.rand(rand_lengths[-1], requires_grad=True)
+    out = torch.sin(factor @ ins)
+    fwd_jac = jacobian(out, ins, mode="forward")
+    rev_jac = jacobian(out, ins, mode="reverse")
+    assert fwd_jac.size() == rev_jac.size()
+    assert torch.allclose(fwd_jac, rev_jac)
+
+    # Batched and differentiable
+    ins = torch.rand(batchsize, rand_lengths[-1], requires_grad=True)
+    out = torch.sin(torch.einsum("ij,kj->ki", factor, ins))
+    fwd_jac, fwd_hes = jacobian_and_hessian(
+        out, ins, batched=True, create_graph=True, mode="forward"
+    )
+    rev_jac, rev_hes = jacobian_and_hessian(
+        out, ins, batched=True, create_graph=True, mode="reverse"
+    )
+    assert torch.allclose(fwd_jac, rev_jac)
+    assert torch.allclose(fwd_hes, rev_hes, atol=1e-6)
+    assert fwd_hes.requires_grad
+
+    # Auto mode picks forward when there are many more outputs than inputs
+    out = torch.sin(ins).sum(dim=-1, keepdim=True) * torch.rand(1, 20)
+    auto_jac = jacobian(out, ins, batched=True, mode="auto")
+    rev_jac = jacobian(out, ins, batched=True, mode="reverse")
+    assert torch.allclose(auto_jac, rev_jac)
+
+
+def test_jvp():
+
+    batchsize = int(np.random.randint(1, 10))
+    rand_lengths = np.random.randint(1, 7, 2)
+    factor = torch.rand(tuple(list(rand_lengths)))
+
+    ins = torch.rand(batchsize, rand_lengths[-1], requires_grad=True)
+    tangent = torch.rand(batchsize, rand_lengths[-1])
+    out = torch.tanh(torch.einsum("ij,kj->ki", factor, ins))
+    jac = jacobian(out, ins, batched=True)
+    expected = torch.einsum("bij,bj->bi", jac, tangent)
+    product = jvp(out, ins, tangent)
+    assert product.size() == out.size()
+    assert torch.allclose(product, expected)
+
+
+def test_jacobian_and_laplacian():
+
+    batchsize = int(np.random.randint(1, 10))
+    rand_lengths = np.random.randint(1, 7, 2)
+    factor = torch.rand(tuple(list(rand_lengths)))
+
+    # Unbatched
+    ins = torch.rand(rand_lengths[-1], requires_grad=True)
+    out = torch.sin(factor @ ins)
+    diag_jac, diag_lap = jacobian_and_laplacian(out, ins, method="diagonal")
+    hes_jac, hes_lap = jacobian_and_laplacian(out, ins, method="hessian")
+    assert torch.allclose(diag_jac, hes_jac)
+    assert diag_lap.size() == hes_lap.size()
+    assert torch.allclose(diag_lap, hes_lap, atol=1e-6)
+
+    # Batched and differentiable
+    ins = torch.rand(batchsize, rand_lengths[-1], requires_grad=True)
+    out = torch.sin(torch.einsum("ij,kj->ki", factor, ins))
+    diag_jac, diag_lap = jacobian_and_laplacian(
+        out, ins, batched=True, create_graph=True, method="diagonal"
+    )
+    hes_jac, hes_lap = jacobian_and_laplacian(
+        out, ins, batched=True, create_graph=True, method="hessian"
+    )
+    assert torch.allclose(diag_jac, hes_jac)
+    assert diag_lap.size() == hes_lap.size()
+    assert torch.allclose(diag_lap, hes_lap, atol=1e-6)
+    assert diag_lap.requires_grad
+
+    # Analytic check: laplacian of sin(a . x) is -|a|^2 sin(a . x)
+    expected = -torch.sum(factor * factor, dim=-1) * out
+    assert torch.allclose(diag_lap, expected, atol=1e-5)
+
+    # A single input and output (e.g. Helmholtz)
+    ins = torch.rand(batchsize, 1, requires_grad=True)
+    out = torch.sin(3 * ins)
+    __, lap = jacobian_and_laplacian(out, ins, batched=True, create_graph=True)
+    assert lap.size() == (batchsize, 1)
+    assert torch.allclose(lap, -9 * out, atol=1e-5)
+    assert lap.requires_grad
+
+
+def test_trace_estimators():
+
+    batchsize = int(np.random.randint(1, 10))
+    rand_length = int(np.random.randint(1, 7))
+
+    # Rademacher probes are exact for diagonal matrices
+    ins = torch.rand(batchsize, rand_length, requires_grad=True)
+    out = torch.sin(ins)
+    jac = jacobian(out, ins, batched=True)
+    expected = trace(jac)
+    estimate = estimate_divergence(
+        out, ins, num_probes=2, batched=True, create_graph=True
+    )
+    assert estimate.size() == expected.size()
+    assert torch.allclose(estimate, expected)
+    assert estimate.requires_grad
+
+    out = torch.sum(torch.sin(ins), dim=-1, keepdim=True)
+    __, expected = jacobian_and_laplacian(out, ins, batched=True)
+    __, estimate = jacobian_and_estimated_laplacian(
+        out, ins, num_probes=2, batched=True, create_graph=True
+    )
+    assert estimate.size() == expected.size()
+    assert torch.allclose(estimate, expected, atol=1e-6)
+    assert estimate.requires_grad
+
+    # Gaussian probes are unbiased in general
+    factor = torch.rand(rand_length, rand_length)
+    ins = torch.rand(rand_length, requires_grad=True)
+    out = factor @ ins
+    estimate = estimate_divergence(
+        out, ins, num_probes=10000, distribution="gaussian"
+    )
+    assert torch.allclose(estimate, torch.trace(factor), rtol=0.1, atol=0.1)
+
+
+def test_finite_difference_jacobian_and_laplacian():
+
+    batchsize = int(np.random.randint(1, 10))
+    rand_length = int(np.random.randint(1, 5))
+    factor = torch.rand(rand_length, 3)
+    shift = torch.rand(batchsize, 3)
+
+    def fn(xb, shift):
+        return torch.sin(xb @ factor + shift)
+
+    ins = torch.rand(batchsize, rand_length, requires_grad=True)
+    out = fn(ins, shift)
+    expected_jac, expected_lap = jacobian_and_laplacian(out, ins, batched=True)
+
+    for order in [2, 4]:
+        value, jac, lap = finite_difference_jacobian_and_laplacian(
+            fn, ins, args=(shift,), step=1e-2, order=order
+        )
+        assert torch.allclose(value, out)
+        assert jac.size() == expected_jac.size()
+        assert lap.size() == expected_lap.size()
+        assert torch.allclose(jac, expected_jac, atol=1e-3)
+        assert torch.allclose(lap, expected_lap, atol=1e-2)
+
+
+def test_derivative_context():
+
+    batchsize = int(np.random.randint(1, 10))
+    rand_length = int(np.random.randint(1, 5))
+    factor = torch.rand(rand_length, rand_length)
+
+    ins = torch.rand(batchsize, rand_length, requires_grad=True)
+    out = torch.sin(ins @ factor)
+    expected_jac, expected_lap = jacobian_and_laplacian(out, ins, batched=True)
+
+    context = DerivativeContext()
+    assert not context.has_laplacian(out, ins)
+    jac = context.jacobian(out, ins)
+    assert torch.allclose(jac, expected_jac)
+    # Repeated requests are served from the cache
+    assert context.jacobian(out, ins) is jac
+    assert torch.allclose(context.divergence(out, ins), trace(expected_jac))
+    lap = context.laplacian(out, ins)
+    assert torch.allclose(lap, expected_lap)
+    assert context.has_laplacian(out, ins)
+    # Exact laplacians take precedence over estimates
+    assert context.laplacian(out, ins, num_probes=1) is lap
+
+    # Externally computed derivatives are used as-is
+    context = DerivativeContext()
+    context.set_derivatives(out, ins, jacobian=expected_jac, laplacian=lap)
+    assert context.jacobian(out, ins) is expected_jac
+    assert context.laplacian(out, ins) is lap
+
+    # Jacobian-vector products with and without the cached jacobian agree
+    tangent = torch.rand(batchsize, rand_length)
+    expected_jvp = torch.einsum("bjk,bk->bj", expected_jac, tangent)
+    assert torch.allclose(context.jvp(out, ins, tangent), expected_jvp)
+    context = DerivativeContext()
+    assert torch.allclose(
+        context.jvp(out, ins, tangent), expected_jvp, atol=1e-6
+    )
+
+
+def test_chunked_jacobian():
+
+    batchsize = int(np.random.randint(1, 10))
+    in_size = int(np.random.randint(1, 5))
+    out_size = int(np.random.randint(2, 8))
+    factor = torch.rand(in_size, out_size)
+
+    for batched in [True, False]:
+        ins = torch.rand(batchsize, in_size, requires_grad=True)
+        out = torch.sin(ins @ factor)
+        expected = jacobian(out, ins, batched=batched)
+        for vectorize in [True, False]:
+            for chunk_size in [1, out_size - 1]:
+                jac = jacobian(
+                    out,
+                    ins,
+                    batched=batched,
+                    create_graph=True,
+                    vectorize=vectorize,
+                    chunk_size=chunk_size,
+                )
+                assert jac.size() == expected.size()
+                assert torch.allclose(jac, expected)
+                assert jac.requires_grad
+
+        # A tiny memory budget degrades to one row at a time
+        jac = jacobian(out, ins, batched=batched, max_memory=1)
+        assert torch.allclose(jac, expected)
@@ -0,0 +1,83 @@
+import numpy as np
+import torch
+import torch.nn as nn
+
+from src.derivatives import jacobian_and_laplacian
+from src.taylor_mode import (
+    activation_derivatives,
+    taylor_activation,
+    taylor_input,
+    taylor_linear,
+    taylor_scale,
+)
+
+
+class Softplus(object):
+    """An activation which must fall back to autograd"""
+
+    def __call__(self, x):
+        return torch.log(1 + torch.exp(x))
+
+
+def test_activation_derivatives():
+
+    z = torch.linspace(-3, 3, 50)
+    for activation in [
+        nn.Tanh(),
+        nn.Sigmoid(),
+        nn.ReLU(),
+        nn.LeakyReLU(0.1),
+        Softplus(),
+    ]:
+        value, first, second = activation_derivatives(activation, z)
+
+        xs = z.clone().requires_grad_()
+        expected_value = activation(xs)
+        expected_first = torch.autograd.grad(
+            torch.sum(expected_value), xs, create_graph=True
+        )[0]
+        assert torch.allclose(value, expected_value)
+        assert torch.allclose(first, expected_first)
+        if expected_first.requires_grad:
+            expected_second = torch.autograd.grad(
+                torch.sum(expected_first), xs, allow_unused=True
+            )[0]
+        else:
+            expected_second = None
+        if expected_second is None:
+            # piecewise linear activation
+            expected_second = torch.zeros_like(z)
+        assert torch.allclose(second, expected_second, atol=1e-6)
+
+
+def test_taylor_mode():
+
+    batchsize = int(np.random.randint(1, 10))
+    in_size = int(np.random.randint(1, 5))
+    layers = [nn.Linear(in_size, 10), nn.Linear(10, 10), nn.Linear(10, 2)]
+    act = nn.Tanh()
+    scale = torch.rand(batchsize, 10)
+
+    xb = torch.rand(batchsize, in_size, requires_grad=True)
+
+    # Plain forward pass
+    out = xb
+    for layer in layers[:-1]:
+        out = scale * act(layer(out))
+    out = layers[-1](out)
+    expected_jac, expected_lap = jacobian_and_laplacian(
+        out, xb, batched=True, create_graph=True
+    )
+
+    # Taylor-mode forward pass
+    value, jac, lap = taylor_input(xb)
+    for layer in layers[:-1]:
+        value, jac, lap = taylor_linear(layer, value, jac, lap)
+        value, jac, lap = taylor_activation(act, value, jac, lap)
+        value, jac, lap = taylor_scale(scale, value, jac, lap)
+    value, jac, lap = taylor_linear(layers[-1], value, jac, lap)
+
+    assert torch.allclose(value, out)
+    assert torch.allclose(jac, expected_jac, atol=1e-6)
+    assert torch.allclose(lap, expected_lap, atol=1e-5)
+    assert lap.requires_grad